@@ -1,12 +1,12 @@
-import base64
 import configparser
 import re
 import time
-from decimal import Decimal
 
 import boto3
 from boto3.dynamodb.conditions import Attr
 
+from user_data_builder import render_user_data, user_data_config
+
 # Initialize the parser and read the ini file
 config = configparser.ConfigParser()
 config.read('./conf.ini')
@@ -42,6 +42,9 @@ s3_client = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb', region_name=Region_DynamodbForSpotPrice)
 table = dynamodb.Table('SpotPriceCostTable')
 
+# Status code of a spot request closed because its instance terminated itself after reporting its completion
+INSTANCE_TERMINATED_BY_USER = 'instance-terminated-by-user'
+
 
 def extract_value(pattern, content):
     return match[1] if (match := re.search(pattern, content)) else None
@@ -70,114 +73,7 @@ def get_values_from_file(filename):
 
 
 def generate_user_data_script(aws_credentials, sleep_time, complete_bucket_name):
-    script = f"""#!/bin/bash
-
-                # Exporting AWS credentials for use in subsequent AWS CLI commands
-                export AWS_ACCESS_KEY_ID="{aws_credentials['AWS_ACCESS_KEY_ID']}"
-                export AWS_SECRET_ACCESS_KEY="{aws_credentials['AWS_SECRET_ACCESS_KEY']}"
-
-
-                # Initializing the log
-                echo "Starting script" >/var/log/user-data.log                
-                
-                # Appending all standard output and error messages to the log file
-                exec > >(tee -a /var/log/user-data.log) 2>&1                                
-                
-                # Set the HOME environment variable
-                export HOME=/home/ec2-user
-                
-                git config --global --add safe.directory /home/ec2-user/galaxy
-                
-                # Custom log file for the Galaxy server
-                GALAXY_LOG="/var/log/galaxy-server.log"
-                
-                # Ensure the log directory exists
-                mkdir -p /var/log
-                
-                # Run the Galaxy server, redirecting its output to the custom log file
-                sh $HOME/galaxy/run.sh > $GALAXY_LOG 2>&1 &
-                echo "Running the Galaxy server in the background... Output is being logged to $GALAXY_LOG"
-                
-                echo "Sleeping for 5 minutes to allow the server to start..."
-                sleep 300
-                
-                cd /home/ec2-user/ngs_analysis || exit
-                ./run_all_batches.sh
-
-                # Retrieve the instance ID using the ec2-metadata command
-                echo "Retrieving the instance ID using ec2-metadata..."
-                INSTANCE_ID=$(ec2-metadata -i | cut -d " " -f 2)
-                echo "Instance ID retrieved: $INSTANCE_ID"
-
-                # Retrieve the Spot Instance Request ID associated with this instance
-                SPOT_REQUEST_ID=$(aws ec2 describe-instances --instance-id $INSTANCE_ID --query "Reservations[0].Instances[0].SpotInstanceRequestId" --output text)
-                echo "Spot Instance Request ID retrieved: $SPOT_REQUEST_ID"
-
-                # Extract the region from the Availability Zone using ec2-metadata
-                REGION=$(ec2-metadata -z | cut -d " " -f 2 | sed 's/.$//')
-                echo "Region retrieved: $REGION"
-
-                # Check if the specific file exists in the S3 bucket for spot instance interruptions
-                CHECK_KEY="open/${{REGION}}|${{SPOT_REQUEST_ID}}.txt"
-                echo "Checking if file $CHECK_KEY exists in bucket {spot_tracking_s3_bucket_name}..."
-                if aws s3api head-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY" 2>/dev/null; then
-                    echo "File $CHECK_KEY exists in bucket. No further action required."
-                    aws s3api delete-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY"
-                else
-                    echo "File $CHECK_KEY does not exist in bucket {spot_tracking_s3_bucket_name}. Skipping..."
-                fi
-
-                # Retrieve instance details such as instance type, availability zone, and launch time
-                INSTANCE_TYPE=$(ec2-metadata -t | cut -d " " -f 2)
-                AVAILABILITY_ZONE=$(ec2-metadata -z | cut -d " " -f 2)
-                LAUNCH_TIME=$(aws ec2 describe-instances \
-                  --instance-id $INSTANCE_ID \
-                  --query "Reservations[0].Instances[0].LaunchTime" \
-                  --output text)
-                # Fetch the current spot price for the instance type in the specific availability zone
-                CURRENT_SPOT_PRICE=$(aws ec2 describe-spot-price-history \
-                  --instance-types $INSTANCE_TYPE \
-                  --availability-zone $AVAILABILITY_ZONE \
-                  --product-descriptions "Linux/UNIX" \
-                  --max-results 1 \
-                  --query "SpotPriceHistory[0].SpotPrice" \
-                  --output text)
-                CURRENT_TIME=$(date --utc +'%Y-%m-%dT%H:%M:%S+00:00')
-
-                # Write all the retrieved information to a temporary file
-                echo "Instance ID: $INSTANCE_ID" > /tmp/instance_info.txt
-                echo "Availability Zone: $AVAILABILITY_ZONE" >> /tmp/instance_info.txt
-                echo "Instance Launch Time: $LAUNCH_TIME" >> /tmp/instance_info.txt
-                echo "Current Time: $CURRENT_TIME" >> /tmp/instance_info.txt
-                echo "Current Spot Price: $CURRENT_SPOT_PRICE" >> /tmp/instance_info.txt
-
-                # Define the S3 object key as the instance ID followed by .txt
-                KEY="$INSTANCE_ID.txt"
-
-                # Check if the S3 bucket for completed instance information exists, create it if not
-                echo "Checking if bucket {complete_bucket_name} exists..."
-                if aws s3api head-bucket --bucket "{complete_bucket_name}" &>/dev/null; then
-                  echo "Bucket {complete_bucket_name} exists"
-                else
-                  echo "Bucket {complete_bucket_name} does not exist. Creating..."
-                  aws s3api create-bucket --bucket "{complete_bucket_name}"
-                  echo "Bucket {complete_bucket_name} created."
-                fi
-
-                # Upload the instance information file to the S3 bucket
-                echo "Uploading the file with the name $INSTANCE_ID.txt to the S3 bucket {complete_bucket_name}..."
-                aws s3api put-object --bucket {complete_bucket_name} --key $KEY --body /tmp/instance_info.txt
-                # Remove the temporary file after uploading
-                rm -f /tmp/instance_info.txt
-                echo "Upload completed. Please check the S3 bucket for the file."
-
-                # Terminate the instance after completing all tasks
-                echo "Terminating instance $INSTANCE_ID"
-                aws ec2 terminate-instances --instance-ids $INSTANCE_ID
-
-                """
-    # Return the generated script, base64 encoded for use in the EC2 user data
-    return base64.b64encode(script.encode()).decode()
+    return render_user_data(user_data_config(aws_credentials, complete_bucket_name, workload='galaxy'))
 
 
 def save_spot_request_to_s3(s3_client, bucket_name, folder, request_id, region, check_count=0):
@@ -291,7 +187,7 @@ def fetch_highest_sps_score(region: str) -> int:
     try:
         # Scan the table for the specific region
         response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr('Region').eq(region)
+            FilterExpression=Attr('Region').eq(region)
         )
         items = response.get('Items', [])
         if items:
@@ -325,7 +221,7 @@ def fetch_interruption_free_score(region: str) -> int:
     try:
         # Scan the table for the specific region
         response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr('Region').eq(region)
+            FilterExpression=Attr('Region').eq(region)
         )
         items = response.get('Items', [])
         if items:
@@ -547,7 +443,7 @@ def get_spot_request_state_with_metadata(request_id, region):
     :param region: The AWS region where the request was made.
     :param bucket_name: The name of the S3 bucket.
     :param folder: The folder in the S3 bucket where the request is stored.
-    :return: A tuple of the state of the spot request and the check_count metadata.
+    :return: A tuple of the state and status code of the spot request and the check_count metadata.
     """
     # Create an EC2 client
     ec2_client = boto3.client('ec2', region_name=region)
@@ -560,10 +456,11 @@ def get_spot_request_state_with_metadata(request_id, region):
     # Try to fetch the state of the spot request from EC2
     try:
         response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-        state = response['SpotInstanceRequests'][0].get('State') if response.get('SpotInstanceRequests') else None
+        request = response['SpotInstanceRequests'][0] if response.get('SpotInstanceRequests') else {}
+        state, status_code = request.get('State'), request.get('Status', {}).get('Code')
     except Exception as e:
         print(f"Error fetching state for spot request ID {request_id}. Error: {e}")
-        state = None
+        state, status_code = None, None
 
     # If the request is open, then retrieve the check_count metadata from S3
     if state == 'open':
@@ -575,8 +472,8 @@ def get_spot_request_state_with_metadata(request_id, region):
         except Exception as e:
             print(f"Error retrieving metadata for spot request ID {request_id} from S3. Error: {e}")
 
-    # Return the state and check_count
-    return state, check_count
+    # Return the state, status code and check_count
+    return state, status_code, check_count
 
 
 def increment_check_count(request_id, region, check_count):
@@ -628,7 +525,7 @@ def lambda_handler(event, context):  # We don't need the event and context param
 
             for request_id in request_ids:
                 try:
-                    current_state, check_count = get_spot_request_state_with_metadata(request_id, region)
+                    current_state, status_code, check_count = get_spot_request_state_with_metadata(request_id, region)
                     print()
                     print(f"State for request ID {request_id}: {current_state}")
 
@@ -651,6 +548,11 @@ def lambda_handler(event, context):  # We don't need the event and context param
                             increment_check_count(request_id, region, check_count)
                             print(f"Incremented check count for request ID {request_id}.")
 
+                    elif current_state == 'closed' and status_code == INSTANCE_TERMINATED_BY_USER:
+                        # The instance finished and terminated itself before the request was seen active
+                        move_to_folder(request_id, region, 'open', 'successful')
+                        print(f"Request ID {request_id} completed. Moved it to 'successful' folder.")
+
                     elif current_state in ['failed', 'terminated']:
                         launch_count += 1
                         print(f"State for request ID {request_id} is {current_state}. Moving to 'failed' folder.")
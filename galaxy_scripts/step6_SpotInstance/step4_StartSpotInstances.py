@@ -1,4 +1,3 @@
-import base64
 import concurrent.futures
 import configparser
 import itertools
@@ -14,6 +13,8 @@ from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError
 from colorama import Fore, init
 
+from user_data_builder import render_user_data, user_data_config
+
 inst_id = None
 
 import re
@@ -224,106 +225,7 @@ def launch_spot_instance(ec2_client, spot_price, ami_id, inst_type, key_name, se
     """
     global inst_id
 
-    user_data_script = f"""#!/bin/bash
-
-                export AWS_ACCESS_KEY_ID="{aws_credentials['AWS_ACCESS_KEY_ID']}"
-                export AWS_SECRET_ACCESS_KEY="{aws_credentials['AWS_SECRET_ACCESS_KEY']}"
-
-                # Initializing the log
-                echo "Starting script" >/var/log/user-data.log                
-                
-                # Appending all standard output and error messages to the log file
-                exec > >(tee -a /var/log/user-data.log) 2>&1                                
-                
-                # Set the HOME environment variable
-                export HOME=/home/ec2-user
-                
-                # Custom log file for the Galaxy server
-                GALAXY_LOG="/var/log/galaxy-server.log"
-                
-                # Ensure the log directory exists
-                mkdir -p /var/log
-                
-                git config --global --add safe.directory /home/ec2-user/galaxy
-                
-                # Run the Galaxy server, redirecting its output to the custom log file
-                sh $HOME/galaxy/run.sh > $GALAXY_LOG 2>&1 &
-                echo "Running the Galaxy server in the background... Output is being logged to $GALAXY_LOG"
-                
-                echo "Sleeping for 5 minutes to allow the server to start..."
-                sleep 300
-                
-                cd /home/ec2-user/ngs_analysis || exit
-                ./run_all_batches.sh
-
-                echo "Retrieving the instance ID using ec2-metadata..."
-                INSTANCE_ID=$(ec2-metadata -i | cut -d " " -f 2)
-                echo "Instance ID retrieved: $INSTANCE_ID"
-
-                # Get the Spot Instance Request ID
-                SPOT_REQUEST_ID=$(aws ec2 describe-instances --instance-id $INSTANCE_ID --query "Reservations[0].Instances[0].SpotInstanceRequestId" --output text)
-                echo "Spot Instance Request ID retrieved: $SPOT_REQUEST_ID"
-
-                # Get the region from the Availability Zone
-                REGION=$(ec2-metadata -z | cut -d " " -f 2 | sed 's/.$//')
-                echo "Region retrieved: $REGION"
-
-                # Check if the file exists in the spot_check_interruption bucket
-                CHECK_KEY="open/${{REGION}}|${{SPOT_REQUEST_ID}}.txt"
-                echo "Checking if file $CHECK_KEY exists in bucket {spot_tracking_s3_bucket_name}..."
-                if aws s3api head-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY" 2>/dev/null; then
-                    echo "File $CHECK_KEY exists in bucket. No further action required."
-                    aws s3api delete-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY"
-                else
-                    echo "File $CHECK_KEY does not exist in bucket {spot_tracking_s3_bucket_name}. Skipping..."
-                fi
-
-                # Retrieve instance details and spot price information
-                INSTANCE_TYPE=$(ec2-metadata -t | cut -d " " -f 2)
-                AVAILABILITY_ZONE=$(ec2-metadata -z | cut -d " " -f 2)
-                LAUNCH_TIME=$(aws ec2 describe-instances \
-                  --instance-id $INSTANCE_ID \
-                  --query "Reservations[0].Instances[0].LaunchTime" \
-                  --output text)
-                CURRENT_SPOT_PRICE=$(aws ec2 describe-spot-price-history \
-                  --instance-types $INSTANCE_TYPE \
-                  --availability-zone $AVAILABILITY_ZONE \
-                  --product-descriptions "Linux/UNIX" \
-                  --max-results 1 \
-                  --query "SpotPriceHistory[0].SpotPrice" \
-                  --output text)
-                CURRENT_TIME=$(date --utc +'%Y-%m-%dT%H:%M:%S+00:00')
-
-                # Write the information to a file
-                echo "Instance ID: $INSTANCE_ID" > /tmp/instance_info.txt
-                echo "Availability Zone: $AVAILABILITY_ZONE" >> /tmp/instance_info.txt
-                echo "Instance Launch Time: $LAUNCH_TIME" >> /tmp/instance_info.txt
-                echo "Current Time: $CURRENT_TIME" >> /tmp/instance_info.txt
-                echo "Current Spot Price: $CURRENT_SPOT_PRICE" >> /tmp/instance_info.txt
-
-                KEY="$INSTANCE_ID.txt"
-
-                echo "Checking if bucket {complete_bucket_name} exists..."
-                if aws s3api head-bucket --bucket "{complete_bucket_name}" &>/dev/null; then
-                  echo "Bucket {complete_bucket_name} exists"
-                else
-                  echo "Bucket {complete_bucket_name} does not exist. Creating..."
-                  aws s3api create-bucket --bucket "{complete_bucket_name}"
-                  echo "Bucket {complete_bucket_name} created."
-                fi
-
-                echo "Uploading the file with the name $INSTANCE_ID.txt to the S3 bucket {complete_bucket_name}..."
-                aws s3api put-object --bucket {complete_bucket_name} --key $KEY --body /tmp/instance_info.txt
-                rm -f /tmp/instance_info.txt
-                echo "Upload completed. Please check the S3 bucket for the file."
-
-                echo "Terminating instance $INSTANCE_ID"
-                aws ec2 terminate-instances --instance-ids $INSTANCE_ID
-
-                """
-
-    # Base64 encode the user data script
-    user_data_encoded = base64.b64encode(user_data_script.encode()).decode()
+    user_data_encoded = render_user_data(user_data_config(aws_credentials, complete_bucket_name, workload='galaxy'))
 
     print(f"Using On Demand Price: {on_demand_price}")
     # Request spot instance
@@ -0,0 +1,204 @@
+"""
+Columnar store of the instance records.
+
+step_1 parses every complete and interruption record once and saves one NumPy array per column under
+data/instance_records. The later steps memory-map the arrays instead of unpickling a dict of Instance objects, so
+loading an experiment takes milliseconds whatever its size:
+
+- instance_id: instance IDs (fixed-width bytes)
+- zone: index into the zones list kept in meta.json
+- start, end: launch and end time in epoch seconds, NaN when the record has none
+- price: spot price per hour written in the record, NaN when the record has none
+- outcome: index into OUTCOMES (complete or interruption)
+"""
+import json
+import logging
+import os
+import re
+from datetime import datetime, timezone
+
+import numpy as np
+
+from utils import FileType, Instance
+
+STORE_DIR = 'instance_records'
+META_FILE = 'meta.json'
+COLUMNS = ('instance_id', 'zone', 'start', 'end', 'price', 'outcome')
+OUTCOMES = (FileType.COMPLETE, FileType.INTERRUPTION)
+
+# One pass over a record picks up every field the analysis uses
+RECORD_FIELD = re.compile(r'^(Instance ID|Availability Zone|Instance Launch Time|Current Time|'
+                          r'Spot Interruption Warning Time|Current Spot Price): *(.*?)\s*$', re.MULTILINE)
+
+# Field holding the end time of the records of each outcome
+END_FIELD = {FileType.COMPLETE: 'Current Time', FileType.INTERRUPTION: 'Spot Interruption Warning Time'}
+
+
+def to_epoch(value):
+    """Convert an ISO 8601 time (naive times are UTC) to epoch seconds, NaN if it is missing or invalid."""
+    if not value:
+        return np.nan
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return np.nan
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def to_datetime(epoch):
+    """Convert epoch seconds to a UTC datetime, None for NaN."""
+    return None if np.isnan(epoch) else datetime.fromtimestamp(float(epoch), timezone.utc)
+
+
+def parse_record(content: str, file_type: FileType) -> tuple:
+    """
+    Parse a complete or interruption record.
+
+    :return: (instance ID, availability zone, start epoch, end epoch, price)
+    """
+    fields = dict(RECORD_FIELD.findall(content))
+    try:
+        price = float(fields['Current Spot Price'])
+    except (KeyError, ValueError):
+        price = np.nan
+    return (fields.get('Instance ID'), fields.get('Availability Zone', ''),
+            to_epoch(fields.get('Instance Launch Time')), to_epoch(fields.get(END_FIELD[file_type])), price)
+
+
+class InstanceRecords:
+    """
+    Columns of the instance records, one NumPy array (memory-mapped when loaded) per column.
+    """
+
+    def __init__(self, instance_id, zone, start, end, price, outcome, zones):
+        self.instance_id = instance_id
+        self.zone = zone
+        self.start = start
+        self.end = end
+        self.price = price
+        self.outcome = outcome
+        self.zones = list(zones)
+
+    def __len__(self):
+        return len(self.outcome)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build the columns from parsed records; a later record of the same instance and outcome replaces an earlier one.
+
+        :param rows: (file type, instance ID, availability zone, start epoch, end epoch, price) tuples
+        """
+        unique_rows = {}
+        for file_type, instance_id, zone, start, end, price in rows:
+            unique_rows[(OUTCOMES.index(file_type), instance_id)] = (zone, start, end, price)
+
+        zones = sorted({zone for zone, _, _, _ in unique_rows.values()})
+        zone_codes = {zone: code for code, zone in enumerate(zones)}
+        instance_ids = [instance_id.encode() for _, instance_id in unique_rows]
+        values = list(unique_rows.values())
+        return cls(
+            instance_id=np.array(instance_ids, dtype=f"S{max(map(len, instance_ids), default=1)}"),
+            zone=np.array([zone_codes[zone] for zone, _, _, _ in values], dtype=np.int16),
+            start=np.array([start for _, start, _, _ in values], dtype=np.float64),
+            end=np.array([end for _, _, end, _ in values], dtype=np.float64),
+            price=np.array([price for _, _, _, price in values], dtype=np.float64),
+            outcome=np.array([outcome for outcome, _ in unique_rows], dtype=np.int8),
+            zones=zones,
+        )
+
+    def save(self, directory):
+        """Save every column to <directory>/<column>.npy and the zones to meta.json."""
+        os.makedirs(directory, exist_ok=True)
+        for name in COLUMNS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, META_FILE), 'w') as f:
+            json.dump({'zones': self.zones, 'count': len(self)}, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Memory-map the columns saved by save."""
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        columns = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode if meta['count'] else None)
+                   for name in COLUMNS}
+        return cls(zones=meta['zones'], **columns)
+
+    def select(self, file_type: FileType):
+        """Return the records of one outcome."""
+        mask = self.outcome == OUTCOMES.index(file_type)
+        return InstanceRecords(*(getattr(self, name)[mask] for name in COLUMNS), zones=self.zones)
+
+    def availability_zones(self):
+        """Availability zone of every record."""
+        return np.array(self.zones, dtype=object)[self.zone] if self.zones else np.array([], dtype=object)
+
+    def _first_and_second(self, times, latest):
+        """(time, instance ID) of the earliest (or latest) time and of the next distinct one."""
+        valid = np.flatnonzero(~np.isnan(times))
+        order = valid[np.argsort(times[valid], kind='stable')]
+        if latest:
+            order = order[::-1]
+        if not len(order):
+            return (None, None), (None, None)
+        others = order[times[order] != times[order[0]]]
+        first = (to_datetime(times[order[0]]), self.instance_id[order[0]].decode())
+        second = (to_datetime(times[others[0]]), self.instance_id[others[0]].decode()) if len(others) else (None, None)
+        return first, second
+
+    def summary(self) -> dict:
+        """
+        Zone and region distributions and the earliest start and latest end times, under the keys of the former
+        distribution dictionaries.
+        """
+        zone_counts = np.bincount(self.zone, minlength=len(self.zones))
+        zone_distribution = {zone: int(count) for zone, count in zip(self.zones, zone_counts) if zone and count}
+        region_distribution = {}
+        for zone, count in zone_distribution.items():
+            region_distribution[zone[:-1]] = region_distribution.get(zone[:-1], 0) + count
+
+        (min_start, min_start_id), (second_min_start, second_min_start_id) = self._first_and_second(self.start, False)
+        (max_end, max_end_id), (second_max_end, second_max_end_id) = self._first_and_second(self.end, True)
+        return {
+            "zone": zone_distribution,
+            "region": region_distribution,
+            "instance_count": len(self),
+            "global_min_start_time": min_start,
+            "global_max_end_time": max_end,
+            "min_start_instance_id": min_start_id,
+            "max_end_instance_id": max_end_id,
+            "second_min_start_time": second_min_start,
+            "second_max_end_time": second_max_end,
+            "second_min_start_instance_id": second_min_start_id,
+            "second_max_end_instance_id": second_max_end_id,
+        }
+
+    def iter_instances(self):
+        """Yield (instance ID, Instance) for every record, for code that works on one instance at a time."""
+        zones = self.availability_zones()
+        hours = (self.end - self.start) / 3600
+        for i in range(len(self)):
+            completion_hours = None if np.isnan(hours[i]) else float(hours[i])
+            cost_per_hour = None if np.isnan(self.price[i]) else float(self.price[i])
+            total_cost = completion_hours * cost_per_hour \
+                if completion_hours is not None and cost_per_hour is not None else None
+            yield self.instance_id[i].decode(), Instance(to_datetime(self.start[i]), to_datetime(self.end[i]), zones[i],
+                                                         cost_per_hour, completion_hours, total_cost)
+
+
+def load_instance_records(data_dir):
+    """
+    Memory-map the instance records saved by step_1 in the data directory.
+
+    :return: InstanceRecords, or None if step_1 has not been run
+    """
+    store_path = os.path.join(data_dir, STORE_DIR)
+    try:
+        records = InstanceRecords.load(store_path)
+    except (FileNotFoundError, ValueError) as e:
+        logging.error(f"Error loading instance records from {store_path}: {str(e)}")
+        return None
+    logging.debug(f"Loaded {len(records)} instance records from {store_path}")
+    return records
@@ -0,0 +1,345 @@
+"""
+Local spot price history warehouse.
+
+Keeps every spot price fetched on this machine, so the analysis can read any time window and the launcher can look at
+price trends without calling the API again. The history is indexed by instance type and availability zone, and
+partitioned by month:
+
+    <warehouse dir>/<instance type>/<availability zone>/<YYYY-MM>.npy   (timestamp, price) records sorted by time
+    <warehouse dir>/<instance type>/<availability zone>/coverage.json   time ranges fetched completely
+
+Prices are only ever added. An ingest merges the new entries into the partitions they fall in, drops the ones already
+stored, and rewrites only those partitions. The coverage tells which ranges can be answered without the API.
+
+It is fed by step_2 of the analysis, which fetches the ranges the coverage lacks, and by the sync command, which
+collects the history of whole regions since their last sync:
+
+    python3 spot_price_warehouse.py sync --regions us-east-1 us-west-2 --instance-types m5.xlarge
+    python3 spot_price_warehouse.py latest --instance-type m5.xlarge
+    python3 spot_price_warehouse.py stats --instance-type m5.xlarge --availability-zone us-east-1a --window-hours 24
+
+The same file is shipped with the launcher and with the analysis scripts.
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+import boto3
+import numpy as np
+
+DEFAULT_WAREHOUSE_DIR = os.path.join(Path.home(), '.spotverse', 'spot_price_warehouse')
+PRODUCT_DESCRIPTION = 'Linux/UNIX'
+COVERAGE_FILE = 'coverage.json'
+RECORD_DTYPE = np.dtype([('timestamp', '<i8'), ('price', '<f8')])
+
+# Days of history fetched by the first sync of a region (the API keeps 90)
+DEFAULT_SYNC_DAYS = 7
+
+
+def missing_ranges(covered, start, end):
+    """
+    Parts of [start, end] that the covered ranges do not cover.
+
+    :param covered: Sorted, disjoint (start, end) ranges
+    :return: List of (start, end) ranges to fetch
+    """
+    if start == end:
+        return [] if any(covered_start <= start <= covered_end for covered_start, covered_end in covered) \
+            else [(start, end)]
+
+    missing = []
+    cursor = start
+    for covered_start, covered_end in covered:
+        if covered_end < cursor:
+            continue
+        if covered_start > end:
+            break
+        if covered_start > cursor:
+            missing.append((cursor, covered_start))
+        cursor = max(cursor, covered_end)
+    if cursor < end:
+        missing.append((cursor, end))
+    return missing
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or touching ranges into sorted, disjoint ones."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def fetch_spot_price_history(ec2_client, instance_types, start_time, end_time, availability_zone=None):
+    """
+    Fetch the spot price history of a region, or of one of its availability zones, following every page.
+
+    :return: List of entries, including the ones in effect at start_time
+    """
+    paginate_kwargs = {'StartTime': start_time, 'EndTime': end_time, 'InstanceTypes': list(instance_types),
+                       'ProductDescriptions': [PRODUCT_DESCRIPTION], 'PaginationConfig': {'PageSize': 1000}}
+    if availability_zone:
+        paginate_kwargs['AvailabilityZone'] = availability_zone
+
+    spot_price_history = []
+    for page in ec2_client.get_paginator('describe_spot_price_history').paginate(**paginate_kwargs):
+        spot_price_history.extend(page['SpotPriceHistory'])
+    return spot_price_history
+
+
+def to_utc(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc)
+
+
+def month_of(epoch):
+    return to_utc(epoch).strftime('%Y-%m')
+
+
+def cumulative_integral(timestamps, values, times):
+    """
+    Integral of a step function (each value holds from its timestamp to the next one) from the first timestamp to
+    each time, NaN for times before it.
+    """
+    cumulative = np.concatenate(([0.0], np.cumsum(values[:-1] * np.diff(timestamps))))
+    index = np.searchsorted(timestamps, times, side='right') - 1
+    known = np.maximum(index, 0)
+    integral = cumulative[known] + values[known] * (times - timestamps[known])
+    return np.where(index >= 0, integral, np.nan)
+
+
+class SpotPriceWarehouse:
+    """
+    Spot price history per instance type and availability zone, partitioned by month.
+    """
+
+    def __init__(self, warehouse_dir=DEFAULT_WAREHOUSE_DIR):
+        self.warehouse_dir = warehouse_dir
+
+    def _pool_dir(self, availability_zone, instance_type):
+        return os.path.join(self.warehouse_dir, instance_type, availability_zone)
+
+    def availability_zones(self, instance_type):
+        """Availability zones with a stored history of an instance type."""
+        try:
+            return sorted(os.listdir(os.path.join(self.warehouse_dir, instance_type)))
+        except FileNotFoundError:
+            return []
+
+    def partitions(self, availability_zone, instance_type):
+        """Months (YYYY-MM) stored for an availability zone and instance type, oldest first."""
+        try:
+            names = os.listdir(self._pool_dir(availability_zone, instance_type))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len('.npy')] for name in names if name.endswith('.npy'))
+
+    def _read_partition(self, availability_zone, instance_type, month):
+        path = os.path.join(self._pool_dir(availability_zone, instance_type), f"{month}.npy")
+        try:
+            return np.load(path)
+        except FileNotFoundError:
+            return np.empty(0, dtype=RECORD_DTYPE)
+
+    def _write_atomically(self, path, write):
+        # Written to a temporary file first, so an interrupted run never leaves a truncated file
+        with open(f"{path}.tmp", 'wb') as f:
+            write(f)
+        os.replace(f"{path}.tmp", path)
+
+    def coverage(self, availability_zone, instance_type):
+        """
+        :return: Sorted, disjoint (start, end) epoch ranges whose history is stored completely
+        """
+        try:
+            with open(os.path.join(self._pool_dir(availability_zone, instance_type), COVERAGE_FILE)) as f:
+                return [tuple(covered) for covered in json.load(f)]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+    def ingest(self, availability_zone, instance_type, entries, covered=None):
+        """
+        Add spot price entries of one availability zone and instance type.
+
+        :param entries: Entries as returned by describe_spot_price_history (Timestamp, SpotPrice)
+        :param covered: Optional (start, end) epoch range the entries cover completely
+        :return: Number of entries that were not stored yet
+        """
+        records = np.array([(int(entry['Timestamp'].timestamp()), float(entry['SpotPrice'])) for entry in entries],
+                           dtype=RECORD_DTYPE)
+        pool_dir = self._pool_dir(availability_zone, instance_type)
+        os.makedirs(pool_dir, exist_ok=True)
+
+        added = 0
+        months = records['timestamp'].astype('datetime64[s]').astype('datetime64[M]').astype(str)
+        for month in np.unique(months):
+            stored = self._read_partition(availability_zone, instance_type, month)
+            merged = np.concatenate([stored, records[months == month]])
+            # np.unique keeps the first occurrence of a timestamp, so a stored entry is never replaced
+            _, first = np.unique(merged['timestamp'], return_index=True)
+            merged = merged[first]
+            if len(merged) > len(stored):
+                self._write_atomically(os.path.join(pool_dir, f"{month}.npy"), lambda f: np.save(f, merged))
+                added += len(merged) - len(stored)
+
+        if covered:
+            ranges = merge_ranges(self.coverage(availability_zone, instance_type) + [tuple(covered)])
+            self._write_atomically(os.path.join(pool_dir, COVERAGE_FILE),
+                                   lambda f: f.write(json.dumps([list(r) for r in ranges]).encode()))
+        return added
+
+    def query(self, availability_zone, instance_type, start_time, end_time):
+        """
+        Stored spot prices between start_time and end_time, preceded by the one in effect at start_time.
+
+        :return: (timestamps in epoch seconds, prices), sorted by time
+        """
+        start, end = start_time.timestamp(), end_time.timestamp()
+        months = self.partitions(availability_zone, instance_type)
+        in_range = [month for month in months if month_of(start) <= month <= month_of(end)]
+        records = np.concatenate([np.empty(0, dtype=RECORD_DTYPE)] +
+                                 [self._read_partition(availability_zone, instance_type, month) for month in in_range])
+
+        window = records[(records['timestamp'] >= start) & (records['timestamp'] <= end)]
+        earlier = records[records['timestamp'] < start]
+        # The price in effect at start_time may have been set in an earlier month
+        for month in reversed([month for month in months if month < month_of(start)]):
+            if len(earlier):
+                break
+            earlier = self._read_partition(availability_zone, instance_type, month)
+        if len(earlier):
+            window = np.concatenate([earlier[-1:], window])
+        return window['timestamp'], window['price']
+
+    def latest(self, instance_type, availability_zones=None):
+        """
+        :return: Dictionary of availability zone to (time, price) of its latest stored price
+        """
+        latest_prices = {}
+        for availability_zone in availability_zones or self.availability_zones(instance_type):
+            months = self.partitions(availability_zone, instance_type)
+            if months:
+                last = self._read_partition(availability_zone, instance_type, months[-1])[-1]
+                latest_prices[availability_zone] = (to_utc(int(last['timestamp'])), float(last['price']))
+        return latest_prices
+
+    def rolling_stats(self, availability_zone, instance_type, times, window):
+        """
+        Time-weighted mean and standard deviation of the price over the window before each time, computed from the
+        cumulative integrals of the price and of its square.
+
+        :param times: Epoch seconds to compute the statistics at
+        :param window: Length of the window in seconds
+        :return: (means, standard deviations), NaN where the stored history starts after the window does
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if not len(times):
+            return np.empty(0), np.empty(0)
+        timestamps, prices = self.query(availability_zone, instance_type,
+                                        to_utc(times.min() - window), to_utc(times.max()))
+        if not len(timestamps):
+            return np.full(len(times), np.nan), np.full(len(times), np.nan)
+
+        timestamps = timestamps.astype(np.float64)
+        mean = (cumulative_integral(timestamps, prices, times) -
+                cumulative_integral(timestamps, prices, times - window)) / window
+        mean_square = (cumulative_integral(timestamps, prices ** 2, times) -
+                       cumulative_integral(timestamps, prices ** 2, times - window)) / window
+        return mean, np.sqrt(np.maximum(mean_square - mean ** 2, 0))
+
+    def price_trend(self, availability_zone, instance_type, window_hours=24):
+        """
+        Latest stored price of an availability zone next to its mean and standard deviation over the last hours.
+
+        :return: Dictionary with latest_time, latest_price, mean and std, or None if nothing is stored
+        """
+        latest = self.latest(instance_type, [availability_zone]).get(availability_zone)
+        if latest is None:
+            return None
+        now = datetime.now(timezone.utc).timestamp()
+        (mean,), (std,) = self.rolling_stats(availability_zone, instance_type, [now], window_hours * 3600)
+        return {'latest_time': latest[0], 'latest_price': latest[1], 'mean': float(mean), 'std': float(std)}
+
+    def fetch_missing(self, ec2_client, availability_zone, instance_type, start_time, end_time):
+        """
+        Fetch the parts of [start_time, end_time] the coverage lacks.
+
+        :return: Number of ranges fetched from the API
+        """
+        gaps = missing_ranges(self.coverage(availability_zone, instance_type),
+                              start_time.timestamp(), end_time.timestamp())
+        for gap_start, gap_end in gaps:
+            entries = fetch_spot_price_history(ec2_client, [instance_type], to_utc(gap_start), to_utc(gap_end),
+                                               availability_zone)
+            self.ingest(availability_zone, instance_type, entries, covered=(gap_start, gap_end))
+        return len(gaps)
+
+    def _last_synced(self, region, instance_type):
+        """End of the coverage of an instance type in a region, the earliest one among its availability zones."""
+        coverage_ends = [ranges[-1][1] for ranges in (self.coverage(availability_zone, instance_type)
+                                                      for availability_zone in self.availability_zones(instance_type)
+                                                      if availability_zone[:-1] == region) if ranges]
+        return min(coverage_ends) if coverage_ends else None
+
+    def sync_region(self, ec2_client, region, instance_types, days=DEFAULT_SYNC_DAYS):
+        """
+        Fetch the history of every availability zone of a region since its last sync, with one paginated call.
+
+        :return: Number of new entries stored
+        """
+        end = datetime.now(timezone.utc).timestamp()
+        last_synced = [self._last_synced(region, instance_type) for instance_type in instance_types]
+        start = end - days * 86400 if None in last_synced else min(last_synced)
+
+        entries_by_pool = {}
+        for entry in fetch_spot_price_history(ec2_client, instance_types, to_utc(start), to_utc(end)):
+            entries_by_pool.setdefault((entry['AvailabilityZone'], entry['InstanceType']), []).append(entry)
+        return sum(self.ingest(availability_zone, instance_type, entries, covered=(start, end))
+                   for (availability_zone, instance_type), entries in entries_by_pool.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local spot price history warehouse.")
+    parser.add_argument('--warehouse-dir', default=DEFAULT_WAREHOUSE_DIR, help="Directory of the warehouse")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = subparsers.add_parser('sync', help="Fetch the history of regions since their last sync")
+    sync_parser.add_argument('--regions', nargs='+', required=True)
+    sync_parser.add_argument('--instance-types', nargs='+', required=True)
+    sync_parser.add_argument('--days', type=int, default=DEFAULT_SYNC_DAYS,
+                             help="Days of history fetched by the first sync of a region")
+
+    latest_parser = subparsers.add_parser('latest', help="Print the latest stored price of every availability zone")
+    latest_parser.add_argument('--instance-type', required=True)
+
+    stats_parser = subparsers.add_parser('stats', help="Print the price trend of an availability zone")
+    stats_parser.add_argument('--instance-type', required=True)
+    stats_parser.add_argument('--availability-zone', required=True)
+    stats_parser.add_argument('--window-hours', type=float, default=24)
+
+    args = parser.parse_args()
+    warehouse = SpotPriceWarehouse(args.warehouse_dir)
+
+    if args.command == 'sync':
+        for region in args.regions:
+            added = warehouse.sync_region(boto3.client('ec2', region_name=region), region, args.instance_types,
+                                          args.days)
+            print(f"{region}: {added} new spot prices stored")
+    elif args.command == 'latest':
+        for availability_zone, (time, price) in warehouse.latest(args.instance_type).items():
+            print(f"{availability_zone}: {price} at {time}")
+    else:
+        trend = warehouse.price_trend(args.availability_zone, args.instance_type, args.window_hours)
+        if trend is None:
+            print(f"No spot prices stored for {args.instance_type} in {args.availability_zone}")
+        else:
+            print(f"{args.availability_zone}: latest {trend['latest_price']} at {trend['latest_time']}, "
+                  f"{args.window_hours}h mean {trend['mean']:.6f}, std {trend['std']:.6f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 """ Download all contents of an S3 bucket to a local folder. """
+import concurrent.futures
 import configparser
+import json
 import os
 from pathlib import Path
 import boto3
+from botocore.config import Config
 
 
 def find_config_file(filename='conf.ini'):
@@ -31,57 +34,134 @@ interrupt_s3_bucket_name = config.get('settings', 'interrupt_s3_bucket_name')
 print(f"complete_bucket_name: {complete_bucket_name}")
 print(f"interrupt_bucket_name: {interrupt_s3_bucket_name}")
 
+# Objects fetched at the same time; the records are small, so the time goes into the round trips
+DOWNLOAD_WORKERS = 32
+
 
 class S3Downloader:
     """
     Class to download all contents of an S3 bucket to a local folder.
+
+    The listing is paginated, the objects are fetched by a pool of threads, and a manifest of the ETag and
+    LastModified of every downloaded object is kept next to the folder, so a rerun only fetches the objects that
+    are new or changed. stream_bucket reads the objects without writing them to files.
     """
 
-    def __init__(self, aws_region):
-        self.s3_client = boto3.client('s3', region_name=aws_region)
+    def __init__(self, aws_region, max_workers=DOWNLOAD_WORKERS):
+        self.max_workers = max_workers
+        # One pooled connection per worker thread
+        self.s3_client = boto3.client('s3', region_name=aws_region,
+                                      config=Config(max_pool_connections=max_workers))
 
-    def download_bucket(self, bucket_name):
+    def list_objects(self, bucket_name):
         """
-        Download all contents of an S3 bucket to a folder in the 'data' directory named after the bucket.
+        List every object of a bucket, past the 1000 keys of a single call.
 
         :param bucket_name: str, Name of the S3 bucket.
+        :return: list, Objects of the bucket (Key, ETag, LastModified, ...), without the folder placeholders.
         """
-        # Ensure the 'data' folder exists
-        data_folder = os.path.join(os.getcwd(), 'data')
-        if not os.path.exists(data_folder):
-            os.makedirs(data_folder)
-
-        # Set the local folder path within the 'data' folder
-        local_folder = os.path.join(data_folder, bucket_name)
+        objects = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name):
+            objects.extend(obj for obj in page.get('Contents', []) if not obj['Key'].endswith('/'))
+        return objects
 
-        if not os.path.exists(local_folder):
-            os.makedirs(local_folder)
+    @staticmethod
+    def manifest_path(local_folder):
+        return f"{local_folder}.manifest.json"
 
-        objects = self.s3_client.list_objects(Bucket=bucket_name)
+    def load_manifest(self, local_folder):
+        """
+        :return: dict, Key -> {'etag', 'last_modified'} of the objects downloaded by an earlier run.
+        """
+        try:
+            with open(self.manifest_path(local_folder)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_manifest(self, local_folder, manifest):
+        # Written to a temporary file first, so an interrupted run never leaves a truncated manifest
+        temporary_path = f"{self.manifest_path(local_folder)}.tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.manifest_path(local_folder))
+
+    def _download_object(self, bucket_name, file_key, file_local_path):
+        os.makedirs(os.path.dirname(file_local_path), exist_ok=True)
+        self.s3_client.download_file(bucket_name, file_key, file_local_path)
 
-        if 'Contents' not in objects:
-            print(f"No objects available in bucket: {bucket_name}")
-            return
+    def download_bucket(self, bucket_name):
+        """
+        Download all contents of an S3 bucket to a folder in the 'data' directory named after the bucket.
+        Objects whose ETag and LastModified match the manifest of an earlier run are skipped.
 
-        for obj in objects['Contents']:
-            file_key = obj['Key']
-            file_local_path = os.path.join(local_folder, file_key)
+        :param bucket_name: str, Name of the S3 bucket.
+        :return: int, Number of objects downloaded.
+        """
+        # Set the local folder path within the 'data' folder
+        local_folder = os.path.join(os.getcwd(), 'data', bucket_name)
+        os.makedirs(local_folder, exist_ok=True)
 
-            # Ensure local folder structure exists
-            if '/' in file_key:
-                file_folder = os.path.dirname(file_local_path)
-                os.makedirs(file_folder, exist_ok=True)
+        objects = self.list_objects(bucket_name)
+        if not objects:
+            print(f"No objects available in bucket: {bucket_name}")
+            return 0
+
+        manifest = self.load_manifest(local_folder)
+        pending = []
+        for obj in objects:
+            entry = {'etag': obj['ETag'], 'last_modified': obj['LastModified'].isoformat()}
+            file_local_path = os.path.join(local_folder, obj['Key'])
+            if manifest.get(obj['Key']) != entry or not os.path.exists(file_local_path):
+                pending.append((obj['Key'], file_local_path, entry))
+
+        downloaded = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._download_object, bucket_name, file_key, file_local_path): (file_key, entry)
+                       for file_key, file_local_path, entry in pending}
+            for future in concurrent.futures.as_completed(futures):
+                file_key, entry = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Failed to download {file_key} from {bucket_name}: {e}")
+                    continue
+                manifest[file_key] = entry
+                downloaded += 1
+
+        self.save_manifest(local_folder, manifest)
+        print(f"Downloaded {downloaded} new or changed objects of {len(objects)} in bucket: {bucket_name} "
+              f"({len(objects) - len(pending)} up to date)")
+        return downloaded
+
+    def _read_object(self, bucket_name, file_key):
+        return self.s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read().decode('utf-8')
+
+    def stream_bucket(self, bucket_name):
+        """
+        Read every object of an S3 bucket without writing it to a file.
 
-            # Download the file
-            self.s3_client.download_file(bucket_name, file_key, file_local_path)
+        :param bucket_name: str, Name of the S3 bucket.
+        :return: generator, (key, body) pairs in the order the objects arrive.
+        """
+        objects = self.list_objects(bucket_name)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._read_object, bucket_name, obj['Key']): obj['Key'] for obj in objects}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    print(f"Failed to read {futures[future]} from {bucket_name}: {e}")
 
 
-# Usage
 aws_region = 'us-east-1'  # If you made bucket in a different region, change this
 
-# Initialize downloader
-downloader = S3Downloader(aws_region)
+# Usage
+if __name__ == "__main__":
+    # Initialize downloader
+    downloader = S3Downloader(aws_region)
 
-# Download bucket contents
-downloader.download_bucket(complete_bucket_name)
-downloader.download_bucket(interrupt_s3_bucket_name)
+    # Download bucket contents
+    downloader.download_bucket(complete_bucket_name)
+    downloader.download_bucket(interrupt_s3_bucket_name)
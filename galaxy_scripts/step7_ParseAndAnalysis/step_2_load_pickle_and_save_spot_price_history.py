@@ -1,21 +1,26 @@
 """
-This script is responsible for loading the original distributions, updating times, zones,
-and saving the filtered distributions. It also retrieves spot price history for each availability zone
-and stores it in a JSON file.
+This script is responsible for loading the instance records saved by step_1 and finding the time range of each
+availability zone. It retrieves spot price history for each availability zone and stores it in a JSON file.
+
+The zones are fetched concurrently, every page of the results is followed, and the history goes through the local
+spot price warehouse (spot_price_warehouse.py), so ranges fetched by an earlier run or by a sync are not fetched again.
 """
+import argparse
+import concurrent.futures
 import configparser
-import copy
 import json
 import logging
 import os
-import pickle
-from collections import Counter
 from datetime import datetime
 from pathlib import Path
 
 import boto3
+import numpy as np
+from botocore.config import Config
 
+from instance_store import OUTCOMES, load_instance_records, to_datetime
 from my_logger import LoggerSetup
+from spot_price_warehouse import DEFAULT_WAREHOUSE_DIR, PRODUCT_DESCRIPTION, SpotPriceWarehouse, to_utc
 
 logger = LoggerSetup.setup_logger()
 logging.getLogger('boto3').setLevel(logging.WARNING)
@@ -47,43 +52,28 @@ TARGET_NUMBER_OF_INSTANCES = int(config.get('settings', 'number_of_spot_instance
 print(f"instance_type: {INSTANCE_TYPE}")
 print(f"number_of_spot_instances: {TARGET_NUMBER_OF_INSTANCES}")
 
-
-def load_distributions(file_path: str) -> dict:
-    """Load and return distributions from a pickle file."""
-    try:
-        with open(file_path, 'rb') as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        logger.error(f"No such file: '{file_path}'")
-        return {}
-    except pickle.UnpicklingError:
-        logger.error("Could not unpickle file")
-        return {}
+# Availability zones fetched at the same time
+FETCH_WORKERS = 16
 
 
-def get_min_max_times_by_zone(loaded_distributions):
+def get_min_max_times_by_zone(records):
     """
     Calculates the minimum start time and maximum end time per availability zone.
 
     Args:
-    - loaded_distributions (dict): A dictionary containing instances data.
+    - records (InstanceRecords): The instance records of both outcomes.
 
     Returns:
     dict: A dictionary mapping availability zones to their min start time and max end time.
     """
     zone_times = {}
+    timed = ~np.isnan(records.start) & ~np.isnan(records.end)
 
-    for key, content in loaded_distributions.items():
-        for instance_id, instance_data in content["instances"].items():
-            zone = instance_data.availability_zone
-            start_time = instance_data.start_time
-            end_time = instance_data.end_time
-
-            if zone not in zone_times:
-                zone_times[zone] = {"min_start_time": start_time, "max_end_time": end_time}
-            else:
-                zone_times[zone]["min_start_time"] = min(start_time, zone_times[zone]["min_start_time"])
-                zone_times[zone]["max_end_time"] = max(end_time, zone_times[zone]["max_end_time"])
+    for code, zone in enumerate(records.zones):
+        in_zone = timed & (records.zone == code)
+        if zone and in_zone.any():
+            zone_times[zone] = {"min_start_time": to_datetime(records.start[in_zone].min()),
+                                "max_end_time": to_datetime(records.end[in_zone].max())}
 
     return zone_times
 
@@ -109,42 +99,46 @@ def extract_region_from_availability_zone(availability_zone):
     return availability_zone[:-1]
 
 
-def get_spot_price_history(start_time, end_time, availability_zone, instance_type):
-    region_name = extract_region_from_availability_zone(availability_zone)
-    session = boto3.Session(region_name=region_name)
-    ec2 = session.client('ec2')
-
+def get_spot_price_history(ec2_client, warehouse, start_time, end_time, availability_zone, instance_type):
+    """
+    Get the spot price history of an availability zone from the warehouse, fetching the ranges it does not cover.
+    """
     try:
-        result = ec2.describe_spot_price_history(
-            StartTime=start_time,
-            EndTime=end_time,
-            InstanceTypes=[instance_type],
-            ProductDescriptions=['Linux/UNIX'],
-            AvailabilityZone=availability_zone,
-            MaxResults=1000
-        )
+        fetched_ranges = warehouse.fetch_missing(ec2_client, availability_zone, instance_type, start_time, end_time)
+    except Exception as e:
+        logger.error(f"An error occurred for {availability_zone}: {str(e)}")
+        return None
 
-        spot_price_history = result['SpotPriceHistory']
+    timestamps, prices = warehouse.query(availability_zone, instance_type, start_time, end_time)
+    spot_price_history = [
+        {'AvailabilityZone': availability_zone, 'InstanceType': instance_type,
+         'ProductDescription': PRODUCT_DESCRIPTION, 'SpotPrice': str(price), 'Timestamp': to_utc(int(timestamp))}
+        for timestamp, price in zip(timestamps, prices)
+    ]
 
-        filtered_spot_price_history = [
-            entry for entry in spot_price_history
-            if start_time <= entry['Timestamp'] <= end_time
-        ]
+    logger.info(f"Got {len(spot_price_history)} spot prices for {availability_zone}, "
+                f"{fetched_ranges} ranges fetched from the API")
+    return spot_price_history
 
-        if before_start_time_entries := [
-            entry
-            for entry in spot_price_history
-            if entry['Timestamp'] < start_time
-        ]:
-            most_recent_before_start = max(before_start_time_entries, key=lambda x: x['Timestamp'])
-            if most_recent_before_start not in filtered_spot_price_history:
-                filtered_spot_price_history.insert(0, most_recent_before_start)
 
-        return filtered_spot_price_history
+def collect_spot_price_histories(zone_times, instance_type, warehouse, max_workers=FETCH_WORKERS):
+    """
+    Get the spot price history of every availability zone concurrently.
 
-    except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
-        return None
+    :return: generator, (zone, spot price history) pairs in the order they complete; the history is None on error
+    """
+    # One client per region, created up front since creating clients is not thread-safe
+    clients = {region: boto3.client('ec2', region_name=region, config=Config(max_pool_connections=max_workers))
+               for region in {extract_region_from_availability_zone(zone) for zone in zone_times}}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(get_spot_price_history, clients[extract_region_from_availability_zone(zone)], warehouse,
+                            times["min_start_time"], times["max_end_time"], zone, instance_type): zone
+            for zone, times in zone_times.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
 
 
 def datetime_serializer(obj):
@@ -187,126 +181,30 @@ def store_spot_price_history(spot_price_history, filename, subdirectory_path):
         logger.error(f"Failed to store data: {str(e)}")
 
 
-def update_times_zones_and_regions(loaded_distributions):
-    for key in ['complete', 'interruption']:
-        instances = loaded_distributions[key]['instances']
-
-        global_min_start_time = min(
-            instances.values(), key=lambda x: x.start_time).start_time if instances else None
-        global_max_end_time = max(
-            instances.values(), key=lambda x: x.end_time).end_time if instances else None
-
-        loaded_distributions[key]['global_min_start_time'] = global_min_start_time
-        loaded_distributions[key]['global_max_end_time'] = global_max_end_time
-
-        instances_without_extremes = {
-            k: v for k, v in instances.items()
-            if v.start_time != global_min_start_time and v.end_time != global_max_end_time
-        }
-
-        second_min_start_time = min(
-            instances_without_extremes.values(), key=lambda x: x.start_time, default=None)
-        second_min_start_time = second_min_start_time.start_time if second_min_start_time else None
-        second_max_end_time = max(
-            instances_without_extremes.values(), key=lambda x: x.end_time, default=None)
-        second_max_end_time = second_max_end_time.end_time if second_max_end_time else None
-
-        loaded_distributions[key]['second_min_start_time'] = second_min_start_time
-        loaded_distributions[key]['second_max_end_time'] = second_max_end_time
-
-        loaded_distributions[key]['min_start_instance_id'] = (
-            next((id_ for id_, inst in instances.items() if inst.start_time == global_min_start_time), None))
-        loaded_distributions[key]['max_end_instance_id'] = (
-            next((id_ for id_, inst in instances.items() if inst.end_time == global_max_end_time), None))
-        loaded_distributions[key]['second_min_start_instance_id'] = (
-            next((id_ for id_, inst in instances_without_extremes.items() if inst.start_time == second_min_start_time),
-                 None))
-        loaded_distributions[key]['second_max_end_instance_id'] = (
-            next((id_ for id_, inst in instances_without_extremes.items() if inst.end_time == second_max_end_time),
-                 None))
-
-        all_zones = [instance_data.availability_zone for instance_data in instances.values()]
-        all_regions = [zone[:-1] for zone in all_zones]
-
-        zone_distribution = Counter(all_zones)
-        region_distribution = Counter(all_regions)
-
-        loaded_distributions[key]['zone'] = zone_distribution
-        loaded_distributions[key]['region'] = region_distribution
-
-    return loaded_distributions
-
-
-def print_dict_without_instances(input_dict):
-    dict_copy = copy.deepcopy(input_dict)
-
-    for key in dict_copy.keys():
-        if 'instances' in dict_copy[key]:
-            instance_count = len(dict_copy[key]['instances'])
-            dict_copy[key]['instances'] = f"{instance_count} instances"
-
-    print(json.dumps(dict_copy, indent=4, default=str))
-
-
-def save_distributions(dist_info, file_name, sub_directory):
-    os.makedirs(sub_directory, exist_ok=True)
-
-    file_path = os.path.join(sub_directory, file_name)
-    logging.info("=========================================")
-    logging.info(f"Saving distributions to {file_path}...")
-
-    with open(file_path, 'wb') as f:
-        pickle.dump(dist_info, f)
-
-
-def main():
+def main(warehouse_dir=DEFAULT_WAREHOUSE_DIR):
     BaseDir = os.getcwd()
     base_dir = BaseDir
     target_name = 'data'
     selected_dir_path = os.path.join(base_dir, target_name)
     logger.debug(f"Selected directory path: {selected_dir_path}")
-    loaded_distributions = load_distributions(os.path.join(selected_dir_path, 'original_distribution.pkl'))
-
-    logger.debug("Original distributions:")
-    logger.debug("Global min start time for complete: %s", loaded_distributions['complete']['global_min_start_time'])
-    logger.debug("Global min start time for interruption: %s",
-                 loaded_distributions['interruption']['global_min_start_time'])
-    logger.info("Global max end time for complete: %s", loaded_distributions['complete']['global_max_end_time'])
-    logger.debug("Global max end time for interruption: %s",
-                 loaded_distributions['interruption']['global_max_end_time'])
-
-    logger.debug("Number of instances in original complete bucket: %s",
-                 len(loaded_distributions['complete']['instances']))
-
-    file_name = "filtered_distributions.pkl"
-
-    logger.info("Updating times, zones, and regions...")
-    filtered_distributions = update_times_zones_and_regions(loaded_distributions)
-    logger.debug(filtered_distributions)
+    records = load_instance_records(selected_dir_path)
+    if records is None:
+        return
 
-    logger.debug("Updated distributions:")
-    logger.debug("Global min start time for complete: %s", filtered_distributions['complete']['global_min_start_time'])
-    logger.debug("Global min start time for interruption: %s",
-                 filtered_distributions['interruption']['global_min_start_time'])
-    logger.debug("Global max end time for complete: %s", filtered_distributions['complete']['global_max_end_time'])
-    logger.debug("Global max end time for interruption: %s",
-                 filtered_distributions['interruption']['global_max_end_time'])
-
-    logger.info("Saving filtered distributions...")
-
-    save_distributions(filtered_distributions, file_name, selected_dir_path)
+    for file_type in OUTCOMES:
+        distribution = records.select(file_type).summary()
+        logger.debug("Number of instances in %s bucket: %s", file_type.value, distribution['instance_count'])
+        logger.debug("Global min start time for %s: %s", file_type.value, distribution['global_min_start_time'])
+        logger.info("Global max end time for %s: %s", file_type.value, distribution['global_max_end_time'])
 
     logger.info("Getting min and max end time per availability zone...")
-    zone_times = get_min_max_times_by_zone(filtered_distributions)
+    zone_times = get_min_max_times_by_zone(records)
     print_zone_times(zone_times)
 
-    for zone, times in zone_times.items():
-        start_time = times["min_start_time"]
-        end_time = times["max_end_time"]
-
-        logger.info(f"Retrieving spot price history for {zone} from {start_time} to {end_time}...")
-        spot_price_history = get_spot_price_history(start_time, end_time, zone, INSTANCE_TYPE)
-
+    logger.info("Retrieving spot price history of every availability zone...")
+    for zone, spot_price_history in collect_spot_price_histories(zone_times, INSTANCE_TYPE, SpotPriceWarehouse(warehouse_dir)):
+        start_time = zone_times[zone]["min_start_time"]
+        end_time = zone_times[zone]["max_end_time"]
         spot_price_history = convert_datetimes(spot_price_history)
 
         logger.info(f"Storing spot price history for {zone} from {start_time} to {end_time}...")
@@ -316,4 +214,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Save the spot price history of every availability zone.")
+    parser.add_argument('--warehouse-dir', default=DEFAULT_WAREHOUSE_DIR,
+                        help="Directory of the spot price history warehouse shared by the experiments")
+    args = parser.parse_args()
+    main(args.warehouse_dir)
@@ -1,12 +1,14 @@
 import configparser
-import pickle
 import warnings
 import logging
 import os
 import matplotlib.pyplot as plt
+import numpy as np
 from pathlib import Path
 
+from instance_store import load_instance_records
 from my_logger import LoggerSetup
+from utils import FileType
 
 # Suppress warnings judiciously
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -42,34 +44,20 @@ print(f"instance_type: {INSTANCE_TYPE}")
 print(f"number_of_spot_instances: {NUMBER_OF_INSTANCES}")
 
 
-def load_distributions(file_path: str) -> dict:
-    """Load and return distributions from a pickle file."""
-    try:
-        with open(file_path, 'rb') as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        logging.error(f"No such file: '{file_path}'")
-        return {}
-    except pickle.UnpicklingError:
-        logging.error("Could not unpickle file")
-        return {}
-
-
-def sort_instances_by_end_time(instances):
-    """Sort instances by end time."""
-    return sorted(instances, key=lambda x: x.end_time)
+def sorted_end_times(records):
+    """Sorted end times (epoch seconds) of the records that have one."""
+    return np.sort(records.end[~np.isnan(records.end)])
 
 
 def append_max_end_time(times, max_end_time):
-    """Append max end time to the list of times if needed."""
-    while len(times) < NUMBER_OF_INSTANCES:
-        times.append(max_end_time)
-    return times[:NUMBER_OF_INSTANCES]
+    """Append max end time to the array of times if needed."""
+    padding = np.full(max(NUMBER_OF_INSTANCES - len(times), 0), max_end_time.timestamp())
+    return np.concatenate([times, padding])[:NUMBER_OF_INSTANCES]
 
 
 def convert_to_relative_times_hours(times, reference_time):
-    """Convert times to relative times in hours based on the reference time."""
-    return [(t - reference_time).total_seconds() / 3600 for t in times]
+    """Convert epoch times to relative times in hours based on the reference time."""
+    return ((np.asarray(times) - reference_time.timestamp()) / 3600).tolist()
 
 
 def plot_cumulative_completions(relative_times, cumulative_counts, max_end_time, min_start_time, save_dir,
@@ -104,14 +92,14 @@ def main():
     selected_dir_path = os.path.join(os.getcwd(), 'data')
     logger.info(f"Selected directory path: {selected_dir_path}")
 
-    file_to_use = 'filtered_distributions.pkl'
-    loaded_distributions = load_distributions(os.path.join(selected_dir_path, file_to_use))
-
-    complete_information = loaded_distributions.get('complete')
-    if complete_information is None:
-        logger.error(f"Failed to load 'complete' data from {file_to_use}.")
+    records = load_instance_records(selected_dir_path)
+    if records is None:
+        logger.error("Failed to load 'complete' data from the instance records.")
         return
 
+    complete_records = records.select(FileType.COMPLETE)
+    complete_information = complete_records.summary()
+
     min_start_time = complete_information.get('global_min_start_time')
     max_end_time = complete_information.get('global_max_end_time')
 
@@ -119,10 +107,7 @@ def main():
         logger.error("Global start and end times are missing.")
         return
 
-    instances = complete_information['instances'].values()
-    instances_sorted = sort_instances_by_end_time(instances)
-
-    completion_times = [instance.end_time for instance in instances_sorted]
+    completion_times = sorted_end_times(complete_records)
     completion_times = append_max_end_time(completion_times, max_end_time)
 
     cumulative_counts = list(range(1, len(completion_times) + 1))
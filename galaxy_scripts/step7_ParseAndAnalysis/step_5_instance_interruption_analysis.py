@@ -1,11 +1,12 @@
 import logging
 import os
-import pickle
 import warnings
 
 import matplotlib.pyplot as plt
+import numpy as np
 from matplotlib.ticker import MaxNLocator
 
+from instance_store import load_instance_records
 from my_logger import LoggerSetup
 from utils import FileType
 
@@ -19,24 +20,14 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 
 
-def load_distributions(file_path: str) -> dict:
-    """Load and return distributions from a pickle file."""
-    try:
-        with open(file_path, 'rb') as f:
-            return pickle.load(f)
-    except (FileNotFoundError, pickle.UnpicklingError) as e:
-        logger.error(f"Error loading distributions: {str(e)}")
-        return {}
-
-
-def sort_instances_by_end_time(instances):
-    """Sort instances by end time."""
-    return sorted(instances, key=lambda x: x.end_time)
+def sorted_end_times(records):
+    """Sorted end times (epoch seconds) of the records that have one."""
+    return np.sort(records.end[~np.isnan(records.end)])
 
 
 def convert_to_relative_times_hours(times, reference_time):
-    """Convert times to relative times in hours based on the reference time."""
-    return [(t - reference_time).total_seconds() / 3600 for t in times]
+    """Convert epoch times to relative times in hours based on the reference time."""
+    return ((np.asarray(times) - reference_time.timestamp()) / 3600).tolist()
 
 
 def plot_cumulative_counts(relative_times, cumulative_counts, max_end_time, min_start_time, save_dir,
@@ -74,35 +65,33 @@ def main():
     selected_dir_path = os.path.join(base_dir, 'data')
     logger.info(f"Selected directory path: {selected_dir_path}")
 
-    file_to_use = 'filtered_distributions.pkl'
-    loaded_distributions = load_distributions(os.path.join(selected_dir_path, file_to_use))
-
-    complete_information = loaded_distributions.get(FileType.COMPLETE.value)
-    if complete_information is None:
+    records = load_instance_records(selected_dir_path)
+    if records is None:
         logger.error("Failed to load 'complete' data.")
         return
 
+    complete_information = records.select(FileType.COMPLETE).summary()
+
     max_end_time = complete_information.get('global_max_end_time')
     if max_end_time is None:
         logger.error("Global max end time is missing.")
         return
 
-    interruption_information = loaded_distributions.get(FileType.INTERRUPTION.value)
-    if interruption_information is None:
+    interruption_records = records.select(FileType.INTERRUPTION)
+    if not len(interruption_records):
         logger.warning("No 'interruption' data found. Creating default zero-interruption graph.")
         min_start_time = max_end_time
         relative_times_hours = [0, (max_end_time - min_start_time).total_seconds() / 3600]
         cumulative_counts = [0, 0]
     else:
-        min_start_time = interruption_information.get('global_min_start_time')
+        min_start_time = interruption_records.summary().get('global_min_start_time')
         if min_start_time is None:
             logger.warning("Min start time is missing, using max end time as a fallback.")
             min_start_time = max_end_time
 
-        instances = interruption_information['instances'].values()
-        instances_sorted = sort_instances_by_end_time(instances)
+        interruption_times = sorted_end_times(interruption_records)
 
-        if not instances_sorted:
+        if not len(interruption_times):
             logger.info("No interruption instances found. Creating default zero-interruption graph.")
             relative_times_hours = [0, (max_end_time - min_start_time).total_seconds() / 3600]
             cumulative_counts = [0, 0]
@@ -110,8 +99,7 @@ def main():
             logger.debug(f"min_start_time: {min_start_time}")
             logger.debug(f"max_end_time: {max_end_time}")
 
-            cumulative_counts = list(range(1, len(instances_sorted) + 1))
-            interruption_times = [instance.end_time for instance in instances_sorted]
+            cumulative_counts = list(range(1, len(interruption_times) + 1))
             logger.debug(f"Interruption times: {interruption_times}")
 
             relative_times_hours = convert_to_relative_times_hours(interruption_times, min_start_time)
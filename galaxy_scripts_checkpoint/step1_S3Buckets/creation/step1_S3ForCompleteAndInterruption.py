@@ -4,7 +4,7 @@
 Single region deployment script
 
 This script is used to create S3 buckets for the experiment.
-S3 Buckets are used for storing spot instances that are complete or interrupted.
+S3 Buckets are used for storing spot instances that are complete or interrupted, and the checkpointed batch outputs.
 Also, Setting Lambda Deployment S3 Bucket Name.
 The bucket names are saved to ../conf.ini.
 """
@@ -82,11 +82,13 @@ def save_to_config(config_path, bucket_names):
     print("Saving Below Information to conf.ini")
     print(f"Interrupt S3 Bucket Name: {bucket_names['interrupt']}")
     print(f"Complete S3 Bucket Name: {bucket_names['complete']}")
+    print(f"Checkpoint S3 Bucket Name: {bucket_names['checkpoint']}")
     print(f"Lambda Deployment S3 Bucket Name: {bucket_names['lambda_deployment']}")
     print(f"Lambda Deployment Name would later be used when making bucket in step3 in this folder.")
 
     config['settings']['interrupt_s3_bucket_name'] = bucket_names['interrupt']
     config['settings']['complete_s3_bucket_name'] = bucket_names['complete']
+    config['settings']['checkpoint_s3_bucket_name'] = bucket_names['checkpoint']
     config['settings']['lambda_deployment_bucket_name'] = bucket_names['lambda_deployment']
 
     with open(config_path, 'w') as configfile:
@@ -114,6 +116,7 @@ def generate_bucket_names(experiment_default_region):
     prefixes = {
         'interrupt': "xx-interruption",
         'complete': "xx-complete",
+        'checkpoint': "xx-checkpoint",
         'lambda_deployment': "xx-lambda-codes"
     }
     return {key: generate_bucket_name(prefix, experiment_default_region) for key, prefix in prefixes.items()}
@@ -152,7 +155,7 @@ def main():
     s3_client = initialize_s3_client()
 
     # Create the required S3 buckets
-    for key in ['interrupt', 'complete']:
+    for key in ['interrupt', 'complete', 'checkpoint']:
         create_bucket(s3_client, bucket_names[key], default_region)
 
     # Save the generated bucket names to configuration
@@ -83,6 +83,7 @@ def load_from_config(config_path):
     return {
         'interrupt': config.get('settings', 'interrupt_s3_bucket_name'),
         'complete': config.get('settings', 'complete_s3_bucket_name'),
+        'checkpoint': config.get('settings', 'checkpoint_s3_bucket_name'),
     }
 
 
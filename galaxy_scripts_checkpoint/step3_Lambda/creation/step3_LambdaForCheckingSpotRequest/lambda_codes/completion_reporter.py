@@ -0,0 +1,140 @@
+"""
+Completion reporter
+
+Runs at the end of the user data of every spot instance and reports its completion from one Python process,
+without any describe call:
+
+- The instance ID, type, AZ, region and launch time (pendingTime) come from the instance identity document,
+  read with one IMDSv2 request.
+- The record is written with one PutObject to the complete bucket. The bucket is only created if that write
+  fails because it does not exist.
+- With --ledger-region, the spot request of the instance is moved to completed in the ledger with one Query on its
+  InstanceIndex and one conditional UpdateItem.
+- The instance terminates itself, also when reporting failed. If the identity document cannot be read, the instance
+  ID and AZ come from the ec2-metadata tool instead.
+
+The spot price is not looked up on the instance. step7_ParseAndAnalysis prices every instance from the spot price
+history it fetches in bulk for all the AZs of a run.
+
+The spot request ID is not in the instance metadata, so the ledger row is found by instance ID. A request the
+ledger does not know the instance of yet is left to the open-request checker, which moves a request whose instance
+terminated itself to completed instead of launching it again.
+
+The file is shipped to every instance by user_data_builder.py:
+
+    python3 completion_reporter.py --complete-bucket <bucket> [--ledger-region us-east-1]
+"""
+
+import argparse
+import json
+import subprocess
+import urllib.request
+from datetime import datetime, timezone
+
+import boto3
+from botocore.exceptions import ClientError
+
+METADATA_URL = 'http://169.254.169.254'
+
+
+def instance_identity(timeout=2):
+    """
+    :return: Instance identity document (instanceId, instanceType, availabilityZone, region, pendingTime, ...)
+    """
+    token_request = urllib.request.Request(f"{METADATA_URL}/latest/api/token", method='PUT',
+                                           headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+    with urllib.request.urlopen(token_request, timeout=timeout) as response:
+        token = response.read().decode()
+    document_request = urllib.request.Request(f"{METADATA_URL}/latest/dynamic/instance-identity/document",
+                                              headers={'X-aws-ec2-metadata-token': token})
+    with urllib.request.urlopen(document_request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def ec2_metadata_instance(timeout=10):
+    """
+    Fallback for the identity document, using the ec2-metadata tool of the AMI.
+    :return: (instance ID, region)
+    """
+    def value(option):
+        # ec2-metadata prints e.g. "instance-id: i-0123456789abcdef0"
+        output = subprocess.run(['ec2-metadata', option], capture_output=True, text=True, check=True,
+                                timeout=timeout).stdout
+        return output.split(':', 1)[1].strip()
+
+    return value('--instance-id'), value('--availability-zone')[:-1]
+
+
+def format_record(identity, current_time):
+    """
+    Completion record in the format parsed by step7_ParseAndAnalysis.
+    """
+    return (f"Instance ID: {identity['instanceId']}\n"
+            f"Region: {identity['region']}\n"
+            f"Availability Zone: {identity['availabilityZone']}\n"
+            f"Instance Type: {identity['instanceType']}\n"
+            f"Instance Launch Time: {identity['pendingTime']}\n"
+            f"Current Time: {current_time}\n")
+
+
+def put_record(s3_client, bucket, key, body):
+    """
+    Write the record, creating the bucket only if it does not exist.
+    """
+    try:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode())
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchBucket':
+            raise e
+        print(f"Bucket {bucket} does not exist. Creating...")
+        s3_client.create_bucket(Bucket=bucket)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode())
+    print(f"Uploaded {key} to {bucket}.")
+
+
+def mark_completed(instance_id, ledger_region):
+    """
+    Move the spot request of this instance to completed in the ledger.
+    """
+    # Only shipped to the instance when the ledger is used
+    from spot_request_ledger import LEDGER_TABLE_NAME, SpotRequestLedger
+    table = boto3.resource('dynamodb', region_name=ledger_region).Table(LEDGER_TABLE_NAME)
+    SpotRequestLedger(table).complete_instance(instance_id)
+
+
+def report(complete_bucket, ledger_region=None):
+    """
+    Report the completion of this instance, then terminate it.
+    """
+    instance_id = region = None
+    try:
+        identity = instance_identity()
+        instance_id, region = identity['instanceId'], identity['region']
+        print(f"Instance ID: {instance_id}, Region: {region}")
+
+        record = format_record(identity, datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+        put_record(boto3.client('s3'), complete_bucket, f"{instance_id}.txt", record)
+
+        if ledger_region:
+            # Best effort: the open-request checker also completes the requests of terminated instances
+            try:
+                mark_completed(instance_id, ledger_region)
+            except Exception as e:
+                print(f"Failed to mark the spot request of {instance_id} as completed: {e}")
+    finally:
+        if instance_id is None:
+            instance_id, region = ec2_metadata_instance()
+        print(f"Terminating instance {instance_id}")
+        boto3.client('ec2', region_name=region).terminate_instances(InstanceIds=[instance_id])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--complete-bucket', required=True, help='Bucket the completion records are written to')
+    parser.add_argument('--ledger-region', help='Region of SpotRequestLedgerTable, if the spot requests are tracked in it')
+    args = parser.parse_args()
+    report(args.complete_bucket, args.ledger_region)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,489 @@
+"""
+Checkpoint-aware work queue
+
+Turns CheckpointingTable into a work queue for the batch workload. Every batch is a row (InstanceIndex is the
+batch number) that instances lease, instead of every instance running a fixed set of batch folders:
+
+- claim: one conditional write takes a pending row, or a leased row whose lease expired because its instance
+  was interrupted, so two instances never run the same batch.
+- renew: the lease is renewed while the batch runs. A lease that is not renewed expires after lease_seconds
+  and the batch goes to the next instance that asks for work, e.g. the replacement of an interrupted one.
+- checkpoint: the batch command records its progress on the row, and a re-leased batch resumes from it.
+- complete / release: the batch is marked done, or handed back right away.
+- fail: a batch whose command failed is handed back after a backoff that doubles with every failure, and is
+  marked failed once it has failed max_attempts times. Interrupted runs do not count as failures.
+- record_flush: the checkpoint agent records where it flushed the outputs of a batch, and hands the batch back
+  when the instance is about to be interrupted.
+
+Every write on a leased row is conditional on its lease token, so an instance whose lease expired can no
+longer touch a batch that was re-leased to another instance.
+
+The same file is shipped with the launcher and the Lambdas, and user_data_builder.py writes it to /opt/spotverse
+on every instance. On an instance:
+
+    python3 work_queue.py run --region us-east-1 --max-attempts 3 --command ./run_batch_checkpoint.sh
+    python3 work_queue.py checkpoint --region us-east-1 --index "$WORK_ITEM_INDEX" \
+        --token "$WORK_LEASE_TOKEN" --progress part_003
+"""
+
+import argparse
+import json
+import os
+import shlex
+import signal
+import subprocess
+import time
+import uuid
+from dataclasses import dataclass
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+CHECKPOINT_TABLE_NAME = 'CheckpointingTable'
+STATUS_INDEX_NAME = 'QueueStatusIndex'
+
+# Row states
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LEASE_SECONDS = 300
+# Failed runs of a batch before it is marked failed
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds before a batch that failed once can be claimed again, doubled with every further failure
+DEFAULT_RETRY_BACKOFF_SECONDS = 60
+DEFAULT_BATCH_PREFIX = 'batch'
+# The running batch, shared with the checkpoint agent
+DEFAULT_LEASE_FILE = '/tmp/work_queue_lease.json'
+# Exit code of a worker stopped with SIGTERM
+STOPPED_EXIT_CODE = 143
+# Exit code recorded for a batch command that could not be started, as in the shell
+COMMAND_NOT_FOUND_EXIT_CODE = 127
+
+
+@dataclass
+class Lease:
+    """
+    A batch leased by this worker.
+    """
+    index: int
+    token: str
+    batch: str = ''
+    progress: str = ''
+    attempts: int = 0
+    failures: int = 0
+    output_uri: str = ''
+
+
+class WorkerStopped(Exception):
+    """
+    Raised in the worker when it receives SIGTERM, e.g. from the checkpoint agent.
+    """
+
+
+class WorkQueue:
+    """
+    Batch rows of CheckpointingTable, leased with conditional writes.
+    """
+
+    def __init__(self, table, worker_id='', lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_backoff_seconds=DEFAULT_RETRY_BACKOFF_SECONDS):
+        """
+        :param table: DynamoDB Table resource of CheckpointingTable
+        :param worker_id: Identifier of this worker (e.g. the instance ID), stored on the leased rows
+        :param lease_seconds: Seconds a lease lasts without being renewed
+        :param max_attempts: Failed runs of a batch before it is marked failed
+        :param retry_backoff_seconds: Seconds before a batch that failed once can be claimed again
+        """
+        self.table = table
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+
+    def seed(self, batches, reset=False):
+        """
+        Create one pending row per batch.
+        :param batches: Batch names, the row of the n-th batch has InstanceIndex n (starting at 1)
+        :param reset: Delete every row first (new experiment); otherwise existing rows and their progress are kept
+        :return: Number of rows created
+        """
+        if reset:
+            self.clear()
+
+        created = 0
+        for index, batch in enumerate(batches, start=1):
+            try:
+                self.table.put_item(
+                    Item={'InstanceIndex': index, 'batch': batch, 'queue_status': PENDING, 'lease_expires_at': 0,
+                          'progress': '', 'attempts': 0},
+                    ConditionExpression='attribute_not_exists(InstanceIndex)')
+                created += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
+        print(f"Seeded {created} of {len(batches)} batches into {self.table.name}.")
+        return created
+
+    def clear(self):
+        """
+        Delete every row of the table.
+        """
+        scan_kwargs = {'ProjectionExpression': 'InstanceIndex'}
+        with self.table.batch_writer() as batch:
+            while True:
+                response = self.table.scan(**scan_kwargs)
+                for item in response.get('Items', []):
+                    batch.delete_item(Key={'InstanceIndex': item['InstanceIndex']})
+                if 'LastEvaluatedKey' not in response:
+                    break
+                scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _query_status(self, key_condition, select=None):
+        query_kwargs = {'IndexName': STATUS_INDEX_NAME, 'KeyConditionExpression': key_condition}
+        if select:
+            query_kwargs['Select'] = select
+        items, count = [], 0
+        while True:
+            response = self.table.query(**query_kwargs)
+            items.extend(response.get('Items', []))
+            count += response.get('Count', 0)
+            if 'LastEvaluatedKey' not in response:
+                return items, count
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def claimable(self):
+        """
+        :return: Rows that can be claimed, pending ones first, then leases that expired the longest ago
+        """
+        # A pending row keeps the end of its retry backoff in lease_expires_at (0 when it has none)
+        now = int(time.time())
+        pending, _ = self._query_status(Key('queue_status').eq(PENDING) & Key('lease_expires_at').lt(now))
+        expired, _ = self._query_status(Key('queue_status').eq(LEASED) & Key('lease_expires_at').lt(now))
+        return pending + expired
+
+    def claim(self):
+        """
+        Lease the next pending or orphaned batch.
+        :return: Lease, or None when there is nothing to claim right now
+        """
+        for item in self.claimable():
+            now = int(time.time())
+            token = str(uuid.uuid4())
+            try:
+                response = self.table.update_item(
+                    Key={'InstanceIndex': item['InstanceIndex']},
+                    UpdateExpression='SET queue_status = :leased, lease_owner = :worker, lease_token = :token, '
+                                     'lease_expires_at = :expires, updated_at = :now '
+                                     'ADD attempts :one',
+                    # Still pending, or its lease ran out; a row another worker just claimed fails here
+                    ConditionExpression='queue_status IN (:pending, :leased) AND lease_expires_at < :now',
+                    ExpressionAttributeValues={
+                        ':leased': LEASED, ':pending': PENDING, ':worker': self.worker_id, ':token': token,
+                        ':expires': now + self.lease_seconds, ':now': now, ':one': 1,
+                    },
+                    ReturnValues='ALL_NEW')
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
+                continue
+
+            row = response['Attributes']
+            lease = Lease(index=int(row['InstanceIndex']), token=token, batch=row.get('batch', ''),
+                          progress=row.get('progress', ''), attempts=int(row.get('attempts', 1)),
+                          failures=int(row.get('failures', 0)), output_uri=row.get('output_uri', ''))
+            resumed = f", resuming from '{lease.progress}'" if lease.progress else ''
+            print(f"Claimed batch {lease.batch} (index {lease.index}, attempt {lease.attempts}){resumed}.")
+            return lease
+        return None
+
+    def _leased_update(self, lease, update_expression, values):
+        """
+        Update a row only if this worker still holds its lease.
+        :return: True if the row was updated, False if the lease was lost
+        """
+        update_kwargs = {
+            'Key': {'InstanceIndex': lease.index},
+            'UpdateExpression': update_expression,
+            'ConditionExpression': 'queue_status = :leased AND lease_token = :token',
+            'ExpressionAttributeValues': {':leased': LEASED, ':token': lease.token, **values},
+        }
+        try:
+            self.table.update_item(**update_kwargs)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            print(f"Lease on batch index {lease.index} was lost.")
+            return False
+
+    def renew(self, lease):
+        """
+        Extend a lease by lease_seconds.
+        """
+        now = int(time.time())
+        return self._leased_update(lease, 'SET lease_expires_at = :expires, updated_at = :now',
+                                   {':expires': now + self.lease_seconds, ':now': now})
+
+    def checkpoint(self, lease, progress):
+        """
+        Record the progress of a leased batch and extend its lease.
+        :param progress: Resume point understood by the batch command (e.g. the last finished part)
+        """
+        now = int(time.time())
+        saved = self._leased_update(
+            lease, 'SET progress = :progress, checkpointed_at = :now, lease_expires_at = :expires, updated_at = :now',
+            {':progress': progress, ':now': now, ':expires': now + self.lease_seconds})
+        if saved:
+            lease.progress = progress
+            print(f"Checkpointed batch index {lease.index} at '{progress}'.")
+        return saved
+
+    def record_flush(self, lease, output_uri, flush_seconds, release=False):
+        """
+        Record where the outputs of a leased batch were flushed to.
+        :param output_uri: S3 prefix holding the outputs, the batch command restores them from there
+        :param flush_seconds: Seconds the flush took
+        :param release: Also hand the batch back, so the replacement instance can claim it right away
+        """
+        now = int(time.time())
+        update_expression = 'SET output_uri = :uri, flush_seconds = :seconds, flushed_at = :now, updated_at = :now'
+        values = {':uri': output_uri, ':seconds': Decimal(str(round(flush_seconds, 3))), ':now': now}
+        if release:
+            update_expression += ', queue_status = :pending, lease_expires_at = :zero REMOVE lease_token'
+            values.update({':pending': PENDING, ':zero': 0})
+        saved = self._leased_update(lease, update_expression, values)
+        if saved:
+            lease.output_uri = output_uri
+        return saved
+
+    def complete(self, lease):
+        """
+        Mark a leased batch as done.
+        """
+        now = int(time.time())
+        return self._leased_update(lease, 'SET queue_status = :done, lease_expires_at = :zero, updated_at = :now '
+                                          'REMOVE lease_token',
+                                   {':done': DONE, ':zero': 0, ':now': now})
+
+    def release(self, lease):
+        """
+        Hand a leased batch back so another worker can claim it right away; its progress is kept.
+        """
+        now = int(time.time())
+        return self._leased_update(lease, 'SET queue_status = :pending, lease_expires_at = :zero, updated_at = :now '
+                                          'REMOVE lease_token',
+                                   {':pending': PENDING, ':zero': 0, ':now': now})
+
+    def fail(self, lease, exit_code):
+        """
+        Hand a leased batch whose command failed back after a backoff, or mark it failed after max_attempts failures.
+        :param exit_code: Exit code of the batch command
+        :return: True if the row was updated, False if the lease was lost
+        """
+        now = int(time.time())
+        failures = lease.failures + 1
+        values = {':failures': failures, ':code': exit_code, ':now': now}
+        if failures >= self.max_attempts:
+            values.update({':failed': FAILED, ':zero': 0})
+            update_expression = ('SET queue_status = :failed, lease_expires_at = :zero, failures = :failures, '
+                                 'last_exit_code = :code, updated_at = :now REMOVE lease_token')
+            print(f"Batch index {lease.index} failed {failures} times, marking it failed.")
+        else:
+            backoff = self.retry_backoff_seconds * 2 ** (failures - 1)
+            values.update({':pending': PENDING, ':retry_at': now + backoff})
+            update_expression = ('SET queue_status = :pending, lease_expires_at = :retry_at, failures = :failures, '
+                                 'last_exit_code = :code, updated_at = :now REMOVE lease_token')
+            print(f"Batch index {lease.index} failed {failures} of {self.max_attempts} times, "
+                  f"it can be claimed again in {backoff} s.")
+        saved = self._leased_update(lease, update_expression, values)
+        if saved:
+            lease.failures = failures
+        return saved
+
+    def summary(self):
+        """
+        :return: Dictionary of row state to number of rows
+        """
+        return {status: self._query_status(Key('queue_status').eq(status), select='COUNT')[1]
+                for status in (PENDING, LEASED, DONE, FAILED)}
+
+
+def write_lease_file(lease, path):
+    """
+    Write the running batch to the lease file, replacing it atomically.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'index': lease.index, 'token': lease.token, 'batch': lease.batch, 'progress': lease.progress,
+                   'attempts': lease.attempts, 'failures': lease.failures, 'output_uri': lease.output_uri}, f)
+    os.replace(tmp_path, path)
+
+
+def read_lease_file(path):
+    """
+    :return: Lease of the running batch, or None when no batch is running
+    """
+    try:
+        with open(path) as f:
+            return Lease(**json.load(f))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _stop_batch(process, timeout=10):
+    """
+    Stop the batch command and everything it started.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def _raise_stopped(signum, frame):
+    raise WorkerStopped()
+
+
+def run_worker(queue, command, poll_seconds=None, lease_file=DEFAULT_LEASE_FILE):
+    """
+    Claim and run batches until every batch is done or failed.
+
+    The command is run with the batch name as its last argument and WORK_ITEM_INDEX, WORK_ITEM_BATCH,
+    WORK_ITEM_PROGRESS, WORK_ITEM_OUTPUT_URI and WORK_LEASE_TOKEN in its environment. The lease is renewed
+    while it runs; if the lease is lost the command is stopped, since another worker now owns the batch.
+
+    On SIGTERM the command is stopped and WorkerStopped is raised without touching the lease, which is left
+    to the checkpoint agent. A command that exits with a non-zero code fails the batch (see WorkQueue.fail).
+
+    :param queue: WorkQueue
+    :param command: Batch command
+    :param poll_seconds: Seconds between lease renewals, and between claims while other workers hold the
+                         remaining batches (defaults to a third of the lease)
+    :param lease_file: File holding the running batch, read by the checkpoint agent
+    :return: Number of batches completed by this worker
+    """
+    poll_seconds = poll_seconds or max(queue.lease_seconds // 3, 1)
+    completed = 0
+    signal.signal(signal.SIGTERM, _raise_stopped)
+
+    while True:
+        lease = queue.claim()
+        if lease is None:
+            summary = queue.summary()
+            if not summary[PENDING] and not summary[LEASED]:
+                print(f"Every batch is done ({summary[DONE]} batches, {completed} run by this worker, "
+                      f"{summary[FAILED]} failed).")
+                return completed
+            # The remaining batches are leased by other workers or wait out their retry backoff
+            print(f"Waiting for other workers: {summary}")
+            time.sleep(poll_seconds)
+            continue
+
+        write_lease_file(lease, lease_file)
+        env = {**os.environ, 'WORK_ITEM_INDEX': str(lease.index), 'WORK_ITEM_BATCH': lease.batch,
+               'WORK_ITEM_PROGRESS': lease.progress, 'WORK_ITEM_OUTPUT_URI': lease.output_uri,
+               'WORK_LEASE_TOKEN': lease.token}
+        try:
+            # Its own process group, so stopping it also stops the tools it started
+            process = subprocess.Popen(shlex.split(command) + [lease.batch], env=env, start_new_session=True)
+        except OSError as e:
+            # e.g. a missing batch command; the batch fails instead of staying leased to a crashed worker
+            print(f"Failed to start batch {lease.batch}: {e}")
+            os.remove(lease_file)
+            queue.fail(lease, COMMAND_NOT_FOUND_EXIT_CODE)
+            continue
+        started = time.monotonic()
+
+        lease_lost = False
+        try:
+            while True:
+                try:
+                    return_code = process.wait(timeout=poll_seconds)
+                    break
+                except subprocess.TimeoutExpired:
+                    if not queue.renew(lease):
+                        lease_lost = True
+                        _stop_batch(process)
+                        break
+        except WorkerStopped:
+            _stop_batch(process)
+            print(f"Stopped batch {lease.batch} after {time.monotonic() - started:.0f} s on SIGTERM.")
+            raise
+
+        os.remove(lease_file)
+
+        elapsed = time.monotonic() - started
+        if lease_lost:
+            print(f"Stopped batch {lease.batch} after {elapsed:.0f} s, it was re-leased to another worker.")
+        elif return_code == 0:
+            queue.complete(lease)
+            completed += 1
+            print(f"Completed batch {lease.batch} in {elapsed:.0f} s.")
+        else:
+            print(f"Batch {lease.batch} failed with exit code {return_code} after {elapsed:.0f} s.")
+            queue.fail(lease, return_code)
+
+
+def batch_names(number_of_batches, prefix=DEFAULT_BATCH_PREFIX):
+    """
+    Names of the batch folders created by the AMI installation script (batch1, batch2, ...).
+    """
+    return [f"{prefix}{i}" for i in range(1, number_of_batches + 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--region', required=True, help='Region of CheckpointingTable')
+    parser.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help='Failed runs of a batch before it is marked failed')
+    parser.add_argument('--retry-backoff-seconds', type=int, default=DEFAULT_RETRY_BACKOFF_SECONDS,
+                        help='Seconds before a batch that failed once can be claimed again')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Claim and run batches until every batch is done')
+    run_parser.add_argument('--command', required=True, help='Batch command, the batch name is appended')
+    run_parser.add_argument('--worker-id', default='')
+    run_parser.add_argument('--lease-file', default=DEFAULT_LEASE_FILE, help='File holding the running batch')
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help='Record the progress of a leased batch')
+    checkpoint_parser.add_argument('--index', type=int, required=True)
+    checkpoint_parser.add_argument('--token', required=True)
+    checkpoint_parser.add_argument('--progress', required=True)
+
+    seed_parser = subparsers.add_parser('seed', help='Create one pending row per batch')
+    seed_parser.add_argument('--batches', type=int, required=True)
+    seed_parser.add_argument('--prefix', default=DEFAULT_BATCH_PREFIX)
+    seed_parser.add_argument('--reset', action='store_true', help='Delete every row first')
+
+    subparsers.add_parser('status', help='Print the number of batches per state')
+
+    args = parser.parse_args()
+    table = boto3.resource('dynamodb', region_name=args.region).Table(CHECKPOINT_TABLE_NAME)
+    queue = WorkQueue(table, getattr(args, 'worker_id', ''), args.lease_seconds, args.max_attempts,
+                      args.retry_backoff_seconds)
+
+    if args.action == 'run':
+        try:
+            run_worker(queue, args.command, lease_file=args.lease_file)
+        except WorkerStopped:
+            raise SystemExit(STOPPED_EXIT_CODE)
+    elif args.action == 'checkpoint':
+        if not queue.checkpoint(Lease(index=args.index, token=args.token), args.progress):
+            raise SystemExit(1)
+    elif args.action == 'seed':
+        queue.seed(batch_names(args.batches, args.prefix), reset=args.reset)
+    else:
+        print(queue.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""
+Interruption-notice driven checkpoint agent
+
+Runs next to the work-queue worker on every instance and bounds the work lost per interruption by the time it takes
+to flush the running batch, instead of the length of the batch:
+
+- The instance metadata is polled for the spot interruption notice over one kept-alive connection with an IMDSv2
+  token that is reused until it is about to expire, so a poll is a single small local request.
+- While the batch runs, its partial Galaxy outputs are synced to S3 every flush_interval seconds, on a background
+  thread so the notice is still polled during the upload. Only files that changed since the last sync are uploaded,
+  large ones with parallel multipart uploads.
+- On the notice the worker is stopped (SIGTERM), the outputs that changed since the last sync are flushed, and the
+  S3 prefix is recorded on the batch row of CheckpointingTable, which is handed back in the same write so the
+  replacement instance can claim it right away. The flush latency is printed and stored on the row.
+
+The batch command gets the prefix of an earlier flush in WORK_ITEM_OUTPUT_URI and can restore it with:
+
+    python3 checkpoint_agent.py restore --uri "$WORK_ITEM_OUTPUT_URI" --output-dir output/batch3
+
+The same file is shipped with the launcher and the Lambdas, and user_data_builder.py writes it to /opt/spotverse on
+every instance. On an instance:
+
+    python3 checkpoint_agent.py watch --region us-east-1 --bucket <bucket> --worker-pid "$WORKER_PID" \
+        --output-dir 'output/{batch}'
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import signal
+import time
+from pathlib import Path
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from work_queue import (CHECKPOINT_TABLE_NAME, DEFAULT_LEASE_FILE, DEFAULT_LEASE_SECONDS, WorkQueue,
+                        read_lease_file)
+
+METADATA_HOST = '169.254.169.254'
+TOKEN_TTL_SECONDS = 21600
+SPOT_ACTION_PATH = '/latest/meta-data/spot/instance-action'
+
+CHECKPOINT_PREFIX = 'checkpoints'
+DEFAULT_POLL_SECONDS = 5
+DEFAULT_FLUSH_INTERVAL = 300
+# Seconds the worker gets to stop the batch command before the outputs are flushed anyway
+WORKER_STOP_SECONDS = 20
+UPLOAD_WORKERS = 8
+
+# Files above 8 MB go up in 8 MB parts, several at a time
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=10, use_threads=True)
+
+
+class InstanceMetadata:
+    """
+    Instance metadata client that keeps its connection and IMDSv2 token between polls.
+    """
+
+    def __init__(self, timeout=2):
+        self.timeout = timeout
+        self.connection = None
+        self.token = None
+        self.token_expires_at = 0
+
+    def _request(self, method, path, headers):
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(METADATA_HOST, timeout=self.timeout)
+            try:
+                self.connection.request(method, path, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, response.read().decode()
+            except (http.client.HTTPException, OSError):
+                # The kept-alive connection was closed, reconnect once
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+    def _token_header(self):
+        if time.monotonic() >= self.token_expires_at:
+            status, body = self._request('PUT', '/latest/api/token',
+                                         {'X-aws-ec2-metadata-token-ttl-seconds': str(TOKEN_TTL_SECONDS)})
+            if status != 200:
+                # IMDSv1 only
+                return {}
+            self.token = body
+            # Renewed well before it expires
+            self.token_expires_at = time.monotonic() + TOKEN_TTL_SECONDS - 60
+        return {'X-aws-ec2-metadata-token': self.token}
+
+    def spot_action(self):
+        """
+        :return: Interruption notice, e.g. {'action': 'terminate', 'time': '2024-01-01T00:02:00Z'}, or None
+        """
+        status, body = self._request('GET', SPOT_ACTION_PATH, self._token_header())
+        if status == 401:
+            # The token was revoked, fetch a new one next time
+            self.token_expires_at = 0
+            return None
+        if status != 200:
+            return None
+        return json.loads(body)
+
+
+class OutputSyncer:
+    """
+    Uploads the files of an output directory that changed since the last sync.
+    """
+
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.uploaded = {}
+        self.batch = None
+
+    def prefix(self, batch):
+        return f"{CHECKPOINT_PREFIX}/{batch}/"
+
+    def uri(self, batch):
+        return f"s3://{self.bucket}/{self.prefix(batch)}"
+
+    def _changed_files(self, output_dir):
+        changed = []
+        for path in output_dir.rglob('*'):
+            if not path.is_file():
+                continue
+            stat = path.stat()
+            if self.uploaded.get(path) != (stat.st_size, stat.st_mtime_ns):
+                changed.append((path, (stat.st_size, stat.st_mtime_ns)))
+        return changed
+
+    def _upload(self, output_dir, batch, path):
+        key = self.prefix(batch) + path.relative_to(output_dir).as_posix()
+        self.s3_client.upload_file(str(path), self.bucket, key, Config=TRANSFER_CONFIG)
+
+    def sync(self, output_dir, batch):
+        """
+        Upload the changed files of output_dir under the prefix of the batch.
+        :return: Number of files and bytes uploaded
+        """
+        if batch != self.batch:
+            self.uploaded, self.batch = {}, batch
+        output_dir = Path(output_dir)
+        if not output_dir.is_dir():
+            return 0, 0
+
+        changed = self._changed_files(output_dir)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            futures = {executor.submit(self._upload, output_dir, batch, path): (path, signature)
+                       for path, signature in changed}
+            for future in concurrent.futures.as_completed(futures):
+                path, signature = futures[future]
+                try:
+                    future.result()
+                    self.uploaded[path] = signature
+                except Exception as e:
+                    print(f"Failed to upload {path}: {e}")
+        return len(changed), sum(signature[0] for _, signature in changed)
+
+
+def restore(s3_client, uri, output_dir):
+    """
+    Download the files under an S3 prefix written by OutputSyncer.sync into output_dir.
+    :return: Number of files downloaded
+    """
+    bucket, _, prefix = uri[len('s3://'):].partition('/')
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+
+    def download(key):
+        destination = Path(output_dir) / key[len(prefix):]
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        s3_client.download_file(bucket, key, str(destination), Config=TRANSFER_CONFIG)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        list(executor.map(download, keys))
+    return len(keys)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+def stop_worker(pid, timeout=WORKER_STOP_SECONDS):
+    """
+    Send SIGTERM to the worker and wait for it to stop its batch command.
+    """
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    deadline = time.monotonic() + timeout
+    while process_alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.2)
+
+
+def flush(queue, syncer, lease, output_dir, release):
+    """
+    Sync the outputs of the leased batch and record them on its row.
+    :return: Seconds the flush took
+    """
+    started = time.monotonic()
+    files, size = syncer.sync(output_dir.format(batch=lease.batch), lease.batch)
+    flush_seconds = time.monotonic() - started
+    queue.record_flush(lease, syncer.uri(lease.batch), flush_seconds, release=release)
+    print(f"Flushed {files} files ({size / 1024 / 1024:.1f} MB) of batch {lease.batch} "
+          f"to {syncer.uri(lease.batch)} in {flush_seconds:.2f} s.")
+    return flush_seconds
+
+
+def periodic_flush(queue, syncer, lease, output_dir):
+    """
+    Flush the running batch without handing it back. A failure is printed and the next interval tries again.
+    """
+    try:
+        flush(queue, syncer, lease, output_dir, release=False)
+    except Exception as e:
+        print(f"Failed to flush batch {lease.batch}: {e}")
+
+
+def watch(queue, syncer, worker_pid, output_dir, lease_file=DEFAULT_LEASE_FILE,
+          poll_seconds=DEFAULT_POLL_SECONDS, flush_interval=DEFAULT_FLUSH_INTERVAL):
+    """
+    Poll for the interruption notice until the worker exits, syncing the running batch in between.
+    :param output_dir: Output directory of a batch, '{batch}' is replaced by the batch name
+    :return: The interruption notice, or None if the worker exited on its own
+    """
+    metadata = InstanceMetadata()
+    next_sync = time.monotonic() + flush_interval
+    # One periodic flush at a time, in the background
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    running_flush = None
+
+    try:
+        while process_alive(worker_pid):
+            try:
+                notice = metadata.spot_action()
+            except (http.client.HTTPException, OSError, ValueError) as e:
+                print(f"Failed to read the instance metadata: {e}")
+                notice = None
+
+            if notice:
+                noticed = time.monotonic()
+                print(f"Interruption notice: {notice}")
+                lease = read_lease_file(lease_file)
+                stop_worker(worker_pid)
+                if running_flush is not None:
+                    # The final flush only uploads what the running one did not
+                    running_flush.result()
+                if lease is None:
+                    print("No batch was running.")
+                else:
+                    flush(queue, syncer, lease, output_dir, release=True)
+                    print(f"Batch {lease.batch} handed back {time.monotonic() - noticed:.2f} s after the notice.")
+                return notice
+
+            if flush_interval and time.monotonic() >= next_sync and (running_flush is None or running_flush.done()):
+                lease = read_lease_file(lease_file)
+                if lease is not None:
+                    running_flush = executor.submit(periodic_flush, queue, syncer, lease, output_dir)
+                next_sync = time.monotonic() + flush_interval
+
+            time.sleep(poll_seconds)
+    finally:
+        executor.shutdown(wait=True)
+
+    print("The worker exited.")
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    watch_parser = subparsers.add_parser('watch', help='Flush the running batch on the interruption notice')
+    watch_parser.add_argument('--region', required=True, help='Region of CheckpointingTable')
+    watch_parser.add_argument('--bucket', required=True, help='Bucket the outputs are flushed to')
+    watch_parser.add_argument('--worker-pid', type=int, required=True)
+    watch_parser.add_argument('--output-dir', required=True, help="Output directory of a batch, with '{batch}'")
+    watch_parser.add_argument('--lease-file', default=DEFAULT_LEASE_FILE)
+    watch_parser.add_argument('--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS)
+    watch_parser.add_argument('--flush-interval', type=int, default=DEFAULT_FLUSH_INTERVAL,
+                              help='Seconds between syncs while the batch runs, 0 to flush only on the notice')
+
+    restore_parser = subparsers.add_parser('restore', help='Download the outputs of an earlier flush')
+    restore_parser.add_argument('--uri', required=True)
+    restore_parser.add_argument('--output-dir', required=True)
+
+    args = parser.parse_args()
+    s3_client = boto3.client('s3')
+
+    if args.action == 'watch':
+        table = boto3.resource('dynamodb', region_name=args.region).Table(CHECKPOINT_TABLE_NAME)
+        queue = WorkQueue(table, lease_seconds=DEFAULT_LEASE_SECONDS)
+        watch(queue, OutputSyncer(s3_client, args.bucket), args.worker_pid, args.output_dir, args.lease_file,
+              args.poll_seconds, args.flush_interval)
+    elif args.uri:
+        print(f"Restored {restore(s3_client, args.uri, args.output_dir)} files from {args.uri}.")
+    else:
+        print("Nothing to restore, the batch was never flushed.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,3 @@
-import base64
 import concurrent.futures
 import configparser
 import itertools
@@ -14,6 +13,9 @@ from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError
 from colorama import Fore, init
 
+from user_data_builder import render_user_data, user_data_config
+from work_queue import CHECKPOINT_TABLE_NAME, WorkQueue, batch_names
+
 inst_id = None
 
 import re
@@ -224,114 +226,11 @@ def launch_spot_instance(ec2_client, spot_price, ami_id, inst_type, key_name, se
     """
     global inst_id
 
-    user_data_script = f"""#!/bin/bash
-
-                export AWS_ACCESS_KEY_ID="{aws_credentials['AWS_ACCESS_KEY_ID']}"
-                export AWS_SECRET_ACCESS_KEY="{aws_credentials['AWS_SECRET_ACCESS_KEY']}"
-
-
-                # Exporting AWS credentials for use in subsequent AWS CLI commands
-                export AWS_ACCESS_KEY_ID="{aws_credentials['AWS_ACCESS_KEY_ID']}"
-                export AWS_SECRET_ACCESS_KEY="{aws_credentials['AWS_SECRET_ACCESS_KEY']}"
-                
-                # Initializing the log
-                echo "Starting script" >/var/log/user-data.log                
-                
-                # Appending all standard output and error messages to the log file
-                exec > >(tee -a /var/log/user-data.log) 2>&1                                
-                
-                # Set the HOME environment variable
-                export HOME=/home/ec2-user
-                
-                git config --global --add safe.directory /home/ec2-user/galaxy
-                
-                # Custom log file for the Galaxy server
-                GALAXY_LOG="/var/log/galaxy-server.log"
-                
-                # Ensure the log directory exists
-                mkdir -p /var/log
-                
-                # Run the Galaxy server, redirecting its output to the custom log file
-                sh $HOME/galaxy/run.sh > $GALAXY_LOG 2>&1 &
-                echo "Running the Galaxy server in the background... Output is being logged to $GALAXY_LOG"
-                
-                echo "Sleeping for 5 minutes to allow the server to start..."
-                sleep 300
-                
-                cd /home/ec2-user/ngs_analysis || exit
-                sh check_interruption_notice.sh > /var/log/check_interruption.log 2>&1 &
-                
-                echo "Running all batches..."
-                ./run_all_batches_checkpoint.sh
-                
-                echo "Retrieving the instance ID using ec2-metadata..."
-                INSTANCE_ID=$(ec2-metadata -i | cut -d " " -f 2)
-                echo "Instance ID retrieved: $INSTANCE_ID"
-
-                # Get the Spot Instance Request ID
-                SPOT_REQUEST_ID=$(aws ec2 describe-instances --instance-id $INSTANCE_ID --query "Reservations[0].Instances[0].SpotInstanceRequestId" --output text)
-                echo "Spot Instance Request ID retrieved: $SPOT_REQUEST_ID"
-
-                # Get the region from the Availability Zone
-                REGION=$(ec2-metadata -z | cut -d " " -f 2 | sed 's/.$//')
-                echo "Region retrieved: $REGION"
-
-                # Check if the file exists in the spot_check_interruption bucket
-                CHECK_KEY="open/${{REGION}}|${{SPOT_REQUEST_ID}}.txt"
-                echo "Checking if file $CHECK_KEY exists in bucket {spot_tracking_s3_bucket_name}..."
-                if aws s3api head-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY" 2>/dev/null; then
-                    echo "File $CHECK_KEY exists in bucket. No further action required."
-                    aws s3api delete-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY"
-                else
-                    echo "File $CHECK_KEY does not exist in bucket {spot_tracking_s3_bucket_name}. Skipping..."
-                fi
-
-                # Retrieve instance details and spot price information
-                INSTANCE_TYPE=$(ec2-metadata -t | cut -d " " -f 2)
-                AVAILABILITY_ZONE=$(ec2-metadata -z | cut -d " " -f 2)
-                LAUNCH_TIME=$(aws ec2 describe-instances \
-                  --instance-id $INSTANCE_ID \
-                  --query "Reservations[0].Instances[0].LaunchTime" \
-                  --output text)
-                CURRENT_SPOT_PRICE=$(aws ec2 describe-spot-price-history \
-                  --instance-types $INSTANCE_TYPE \
-                  --availability-zone $AVAILABILITY_ZONE \
-                  --product-descriptions "Linux/UNIX" \
-                  --max-results 1 \
-                  --query "SpotPriceHistory[0].SpotPrice" \
-                  --output text)
-                CURRENT_TIME=$(date --utc +'%Y-%m-%dT%H:%M:%S+00:00')
-
-                # Write the information to a file
-                echo "Instance ID: $INSTANCE_ID" > /tmp/instance_info.txt
-                echo "Availability Zone: $AVAILABILITY_ZONE" >> /tmp/instance_info.txt
-                echo "Instance Launch Time: $LAUNCH_TIME" >> /tmp/instance_info.txt
-                echo "Current Time: $CURRENT_TIME" >> /tmp/instance_info.txt
-                echo "Current Spot Price: $CURRENT_SPOT_PRICE" >> /tmp/instance_info.txt
-
-                KEY="$INSTANCE_ID.txt"
-
-                echo "Checking if bucket {complete_bucket_name} exists..."
-                if aws s3api head-bucket --bucket "{complete_bucket_name}" &>/dev/null; then
-                  echo "Bucket {complete_bucket_name} exists"
-                else
-                  echo "Bucket {complete_bucket_name} does not exist. Creating..."
-                  aws s3api create-bucket --bucket "{complete_bucket_name}"
-                  echo "Bucket {complete_bucket_name} created."
-                fi
-
-                echo "Uploading the file with the name $INSTANCE_ID.txt to the S3 bucket {complete_bucket_name}..."
-                aws s3api put-object --bucket {complete_bucket_name} --key $KEY --body /tmp/instance_info.txt
-                rm -f /tmp/instance_info.txt
-                echo "Upload completed. Please check the S3 bucket for the file."
-
-                echo "Terminating instance $INSTANCE_ID"
-                aws ec2 terminate-instances --instance-ids $INSTANCE_ID
-
-                """
-
-    # Base64 encode the user data script
-    user_data_encoded = base64.b64encode(user_data_script.encode()).decode()
+    user_data_encoded = render_user_data(user_data_config(aws_credentials, complete_bucket_name, workload='checkpoint',
+                                                          region=Region_DynamoForCheckpoint, lease_seconds=lease_seconds,
+                                                          batch_command=batch_command, checkpoint_bucket=checkpoint_s3_bucket_name,
+                                                          output_dir=checkpoint_output_dir, flush_interval=checkpoint_flush_interval,
+                                                          max_attempts=max_attempts, retry_backoff_seconds=retry_backoff_seconds))
 
     print(f"Using On Demand Price: {on_demand_price}")
     # Request spot instance
@@ -541,6 +440,16 @@ def empty_spot_bucket(bucket_name, folder_name):
             obj.delete()
 
 
+def seed_work_queue():
+    """
+    Create one pending work-queue row per batch, so the instances lease batches instead of running fixed ones.
+    """
+    queue = WorkQueue(boto3.resource('dynamodb', region_name=Region_DynamoForCheckpoint).Table(CHECKPOINT_TABLE_NAME))
+    reset = input("Reset the work queue so every batch runs again? Type 'yes' to reset: ").lower() == 'yes'
+    queue.seed(batch_names(number_of_batches), reset=reset)
+    print(f"Work queue: {queue.summary()}")
+
+
 def print_info(details: dict):
     """
     Print details in a formatted way.
@@ -607,7 +516,7 @@ def empty_buckets():
     """
     # Prompting for creating or emptying buckets, indicating continuation unless "no" is input
     # Prompting individually for creating or emptying each bucket
-    for bucket_name in [complete_bucket_name, interrupt_s3_bucket_name]:
+    for bucket_name in [complete_bucket_name, interrupt_s3_bucket_name, checkpoint_s3_bucket_name]:
         # Check and create bucket if it doesn't exist
         if not bucket_exists(bucket_name):
             print(f"Bucket {bucket_name} does not exist. Creating it...")
@@ -939,6 +848,15 @@ on_demand_price = float(config.get('settings', 'on_demand_price'))
 available_regions = [region.strip() for region in config.get('settings', 'available_regions').split(',')]
 Region_DynamoDBForSpotPlacementScore = config.get('settings', 'Region_DynamoForSpotPlacementScore')
 Region_DynamoDBForStabilityScore = config.get('settings', 'Region_DynamoForSpotInterruptionRatio')
+Region_DynamoForCheckpoint = config.get('settings', 'Region_DynamoForCheckpoint')
+number_of_batches = config.getint('settings', 'number_of_batches', fallback=10)
+lease_seconds = config.getint('settings', 'lease_seconds', fallback=300)
+max_attempts = config.getint('settings', 'max_attempts', fallback=3)
+retry_backoff_seconds = config.getint('settings', 'retry_backoff_seconds', fallback=60)
+batch_command = config.get('settings', 'batch_command', fallback='./run_batch_checkpoint.sh')
+checkpoint_s3_bucket_name = config.get('settings', 'checkpoint_s3_bucket_name')
+checkpoint_output_dir = config.get('settings', 'checkpoint_output_dir', fallback='output/{batch}')
+checkpoint_flush_interval = config.getint('settings', 'checkpoint_flush_interval', fallback=300)
 print(f"Complete bucket name: {complete_bucket_name}")
 print(f"Interrupt bucket name: {interrupt_s3_bucket_name}")
 print(f"Sleep time: {sleep_time}")
@@ -952,6 +870,15 @@ print(f"Spot Placement Score DynamoDB Region: {Region_DynamoDBForSpotPlacementSc
 print(f"Stability Score DynamoDB Region: {Region_DynamoDBForStabilityScore}")
 print(f"On-demand price: {on_demand_price}")
 print(f"Available regions: {available_regions}")
+print(f"Checkpoint DynamoDB Region: {Region_DynamoForCheckpoint}")
+print(f"Number of batches: {number_of_batches}")
+print(f"Lease seconds: {lease_seconds}")
+print(f"Max attempts: {max_attempts}")
+print(f"Retry backoff seconds: {retry_backoff_seconds}")
+print(f"Batch command: {batch_command}")
+print(f"Checkpoint bucket name: {checkpoint_s3_bucket_name}")
+print(f"Checkpoint output directory: {checkpoint_output_dir}")
+print(f"Checkpoint flush interval: {checkpoint_flush_interval}")
 
 # exit()
 
@@ -991,6 +918,8 @@ def main():
                                                                Region_DynamoDBForStabilityScore)
         print(f"Suitable regions from preferred regions: {suitable_regions}")
 
+    seed_work_queue()
+
     response_dict: dict = fetch_spot_price_data(suitable_regions)
 
     launch_all_spot_instances(response_dict)
@@ -1,16 +1,17 @@
+import argparse
 import configparser
 import logging
 import os
-import pickle
-import re
 from datetime import datetime
 from pathlib import Path
 from typing import Dict, Optional
 
+import numpy as np
 import pytz
 
+from instance_store import OUTCOMES, STORE_DIR, InstanceRecords, parse_record
 from my_logger import LoggerSetup
-from utils import FileType, Instance
+from utils import FileType
 
 logger = LoggerSetup.setup_logger()
 
@@ -38,161 +39,45 @@ INSTANCE_TYPE = config.get('settings', 'instance_type')
 print(f"instance_type: {INSTANCE_TYPE}")
 
 
-def extract_content(text: str, pattern: str) -> str:
-    """Extract the content from the text using the pattern."""
-    match = re.search(pattern, text)
-    return match[1] if match else None
-
-
-def convert_to_datetime(datetime_str: str) -> Optional[datetime]:
-    """Convert the datetime string to datetime object."""
-    try:
-        return datetime.fromisoformat(datetime_str.replace('Z', '+00:00')) if datetime_str else None
-    except Exception as e:
-        logging.error(f"Error converting datetime: {datetime_str}, Error: {str(e)}")
-        return None
-
-
-def parse_file_content_complete(file_path: str) -> tuple:
-    """Parse the file content for complete instances."""
-    with open(file_path, 'r') as file:
-        content = file.read()
-        logger.debug(f"Parsing file content for complete: {content}")
-
-        instance_id = extract_content(content, r'Instance ID: (\S+)')
-        availability_zone = extract_content(content, r'Availability Zone: (\w+-\w+-\d\w)')
-        region = availability_zone[:-1] if availability_zone else None
-
-        start_time = convert_to_datetime(extract_content(content, r'Instance Launch Time: (.+)'))
-        end_time = convert_to_datetime(extract_content(content, r'Current Time: (.+)'))
-        cost = float(extract_content(content, r'Current Spot Price: (.+)'))
-
-        logger.debug(f"Extracted complete instance details: ID={instance_id}, AZ={availability_zone}, Region={region}, Start={start_time}, End={end_time}, Cost={cost}")
-        return instance_id, availability_zone, region, start_time, end_time, cost
-
-
-def parse_file_content_interruption(file_path: str) -> tuple:
-    """Parse the file content for interruption instances."""
-    with open(file_path, 'r') as file:
-        content = file.read()
-        logger.debug(f"Parsing file content for interruption: {content}")
-
-        instance_id = extract_content(content, r'Instance ID: (\S+)')
-        availability_zone = extract_content(content, r'Availability Zone: (\w+-\w+-\d\w)')
-        region = availability_zone[:-1] if availability_zone else None
-
-        start_time = convert_to_datetime(extract_content(content, r'Instance Launch Time: (.+)'))
-        end_time = convert_to_datetime(extract_content(content, r'Spot Interruption Warning Time: (.+)'))
-
-        cost_str = extract_content(content, r'Current Spot Price: (.+)')
-        cost = float(cost_str) if cost_str is not None else 0.0
-        if cost == 0.0:
-            logger.debug("Cost was None or invalid, setting to 0.0")
-
-        logger.debug(f"Extracted interruption instance details: ID={instance_id}, AZ={availability_zone}, Region={region}, Start={start_time}, End={end_time}, Cost={cost}")
-        return instance_id, availability_zone, region, start_time, end_time, cost
-
-
-def update_distribution(distribution: dict, key: str):
+def read_records(base_directory: str):
     """
-    Update the distribution dictionary with the key.
+    Yield the (path, content) of every record downloaded to the directory.
     """
-    if key:
-        distribution[key] = distribution.get(key, 0) + 1
-
-
-def initialize_distributions():
-    """
-    Initialize the distribution's dictionary.
-    """
-    utc = pytz.UTC
-    return {
-        "zone": {},
-        "region": {},
-        "instance_type": INSTANCE_TYPE,
-        "instances": {},
-        "global_min_start_time": utc.localize(datetime.max),
-        "global_max_end_time": utc.localize(datetime.min),
-        "min_start_instance_id": None,
-        "max_end_instance_id": None,
-        "second_min_start_time": utc.localize(datetime.max),
-        "second_max_end_time": utc.localize(datetime.min),
-        "second_min_start_instance_id": None,
-        "second_max_end_instance_id": None
-    }
-
-
-def update_min_max_times(distribution_information, start_time, end_time, instance_id):
-    """
-    Update the min and next min start times and max and previous max end times.
-    """
-    utc = pytz.UTC
-    start_time = utc.localize(start_time) if start_time.tzinfo is None else start_time
-    end_time = utc.localize(end_time) if end_time.tzinfo is None else end_time
-
-    global_min_start_time = distribution_information["global_min_start_time"]
-    global_max_end_time = distribution_information["global_max_end_time"]
-    second_min_start_time = distribution_information["second_min_start_time"]
-    second_max_end_time = distribution_information["second_max_end_time"]
-
-    # Update min and second min start times
-    if start_time < global_min_start_time:
-        distribution_information["second_min_start_time"], distribution_information["second_min_start_instance_id"] = \
-            global_min_start_time, distribution_information["min_start_instance_id"]
-        distribution_information["global_min_start_time"], distribution_information[
-            "min_start_instance_id"] = start_time, instance_id
-    elif global_min_start_time < start_time < second_min_start_time:
-        distribution_information["second_min_start_time"], distribution_information[
-            "second_min_start_instance_id"] = start_time, instance_id
-
-    # Update max and second max end times
-    if end_time > global_max_end_time:
-        distribution_information["second_max_end_time"], distribution_information["second_max_end_instance_id"] = \
-            global_max_end_time, distribution_information["max_end_instance_id"]
-        distribution_information["global_max_end_time"], distribution_information[
-            "max_end_instance_id"] = end_time, instance_id
-    elif global_max_end_time > end_time > second_max_end_time:
-        distribution_information["second_max_end_time"], distribution_information[
-            "second_max_end_instance_id"] = end_time, instance_id
-
-
-def analyze_directory(base_directory: str, file_type: FileType) -> dict:
-    """
-    Analyze the directory and return the distribution dictionary.
-    """
-
-    utc = pytz.UTC
-
-    # Initialize the distribution dictionary
-    distribution_info = initialize_distributions()
-
     for root, _, files in os.walk(base_directory):
         for file_name in files:
             file_path = os.path.join(root, file_name)
-            try:
-                if file_type == FileType.COMPLETE:
-                    instance_id, availability_zone, region, start_time, end_time, cost = \
-                        parse_file_content_complete(file_path)
-                else:
-                    instance_id, availability_zone, region, start_time, end_time, cost = \
-                        parse_file_content_interruption(file_path)
+            with open(file_path, 'r') as file:
+                yield file_path, file.read()
 
-                update_distribution(distribution_info["zone"], availability_zone)
-                update_distribution(distribution_info["region"], region)
 
-                completion_hours = ((end_time - start_time).total_seconds() / 3600) if start_time and end_time else None
-                total_cost = completion_hours * cost if completion_hours is not None and cost is not None else None
+def parse_records(records, file_type: FileType):
+    """
+    Parse (name, content) records with the compiled record parser.
 
-                distribution_info["instances"][instance_id] = Instance(start_time, end_time, availability_zone, cost,
-                                                                       completion_hours, total_cost)
+    :return: generator of (file type, instance ID, availability zone, start epoch, end epoch, price) rows
+    """
+    for name, content in records:
+        try:
+            instance_id, availability_zone, start, end, price = parse_record(content, file_type)
+        except Exception as e:
+            logging.error(f"Error processing {name}: {str(e)}")
+            continue
+        if not instance_id:
+            logging.error(f"Error processing {name}: no instance ID")
+            continue
+        yield file_type, instance_id, availability_zone, start, end, price
 
-                if start_time and end_time:
-                    update_min_max_times(distribution_info, start_time, end_time, instance_id)
 
-            except Exception as e:
-                logging.error(f"Error processing {file_path}: {str(e)}")
+def aggregate_costs(records: InstanceRecords) -> tuple:
+    """
+    Aggregate the cost of the instances from the price written in their records.
+    Completion records carry no price, so they are counted apart instead of being priced at 0.
 
-    return distribution_info
+    :return: (cost of the priced records, number of priced records, number of records without a price)
+    """
+    priced = ~np.isnan(records.price)
+    cost = float(np.sum((records.end[priced] - records.start[priced]) / 3600 * records.price[priced]))
+    return cost, int(priced.sum()), int((~priced).sum())
 
 
 def print_distribution(distributions: dict):
@@ -212,8 +97,9 @@ def print_distribution(distributions: dict):
                  f"Instance ID: {distributions['max_end_instance_id']}")
 
     # Calculate and logging.info the total duration
-    total_duration = distributions['global_max_end_time'] - distributions['global_min_start_time']
-    logging.info(f"Total Duration: {total_duration} (HH:MM:SS)")
+    if distributions['global_min_start_time'] and distributions['global_max_end_time']:
+        total_duration = distributions['global_max_end_time'] - distributions['global_min_start_time']
+        logging.info(f"Total Duration: {total_duration} (HH:MM:SS)")
     logging.info("=========================================")
 
 
@@ -284,54 +170,6 @@ def compare_end_times(all_distributions_info: Dict[str, Dict[str, Optional[datet
         logging.error("Unable to compare end times as logs for 'complete' and/or 'interruption' do not exist.")
 
 
-def aggregate_costs(instances):
-    """
-    Aggregate the total cost of all instances.
-    """
-    total_cost = 0.0
-    for instance_id, instance in instances.items():
-        if instance.total_cost:
-            total_cost += instance.total_cost
-    return total_cost
-
-
-def analyze_and_add_distribution(full_path, file_type, all_distributions_info):
-    """Analyze the directory and add the distribution to the dictionary of all distributions."""
-    logging.info("=========================================")
-    logging.info(f"Analyzing {file_type}")
-    logging.info(f"Directory is {full_path}...")
-
-    # Analyze the directory
-    distribution_info = analyze_directory(full_path, file_type)
-
-    # Print the distribution
-    print_distribution(distribution_info)
-
-    # Save the distribution to the dictionary of all distributions
-    all_distributions_info[file_type.name.lower()] = distribution_info
-
-    return distribution_info
-
-
-def save_distributions(dist_info, file_name, sub_directory):
-    """
-    Save the distributions to a pickle file in the specified subdirectory.
-
-    :param dist_info: The distribution information to save.
-    :param file_name: The name of the file to save the distribution info into.
-    :param sub_directory: The subdirectory to save the file in.
-    """
-    # Ensure the subdirectory exists; if not, create it.
-    os.makedirs(sub_directory, exist_ok=True)
-
-    file_path = os.path.join(sub_directory, file_name)
-    logging.info("=========================================")
-    logging.info(f"Saving distributions to {file_path}...")
-
-    with open(file_path, 'wb') as f:
-        pickle.dump(dist_info, f)
-
-
 def get_subdirectories(path):
     """
     Retrieve the subdirectories of a given path.
@@ -351,43 +189,81 @@ def get_subdirectories(path):
     return subdirectories
 
 
-def find_directory(target_dir_name):
+def stream_buckets():
+    """
+    Read the records straight from the complete and interruption buckets, without downloading them first.
+
+    :return: list of (bucket name, generator of (key, content)) pairs
+    """
+    # Only needed, and only reads the bucket names, when streaming
+    from step_0_download_bucket_and_object import S3Downloader, aws_region, complete_bucket_name, \
+        interrupt_s3_bucket_name
+
+    downloader = S3Downloader(aws_region)
+    return [(bucket_name, downloader.stream_bucket(bucket_name))
+            for bucket_name in [complete_bucket_name, interrupt_s3_bucket_name]]
+
+
+def find_directory(target_dir_name, stream=False):
     base_dir = os.getcwd()
-    global_total_cost = 0.0
     all_distributions = {}
 
     selected_dir_path = os.path.join(base_dir, target_dir_name)
     logger.debug(f"Selected directory path: {selected_dir_path}")
 
-    subdirectories = get_subdirectories(selected_dir_path)
-    if not subdirectories:
-        logger.warning(f"No subdirectories to process in {selected_dir_path}")
-        return
-    logger.debug(f"Subdirectories: {subdirectories}")
-
-    for directory in subdirectories:
-        full_dir_path = os.path.join(selected_dir_path, directory)
-
+    if stream:
+        sources = stream_buckets()
+    else:
+        subdirectories = get_subdirectories(selected_dir_path)
+        if not subdirectories:
+            logger.warning(f"No subdirectories to process in {selected_dir_path}")
+            return
+        logger.debug(f"Subdirectories: {subdirectories}")
+        sources = [(directory, read_records(os.path.join(selected_dir_path, directory)))
+                   for directory in subdirectories if directory != STORE_DIR]
+
+    rows = []
+    for directory, records in sources:
         if "complete" in directory.lower():
-            distributions = analyze_and_add_distribution(full_dir_path, FileType.COMPLETE, all_distributions)
+            file_type = FileType.COMPLETE
         elif "interruption" in directory.lower():
-            distributions = analyze_and_add_distribution(full_dir_path, FileType.INTERRUPTION, all_distributions)
+            file_type = FileType.INTERRUPTION
         else:
             logger.warning(f"Directory type not recognized: {directory}")
             continue
+        logging.info(f"Parsing {file_type} records of {directory}...")
+        rows.extend(parse_records(records, file_type))
+
+    instance_records = InstanceRecords.from_rows(rows)
 
-        global_total_cost += aggregate_costs(distributions['instances'])
+    for file_type in OUTCOMES:
+        logging.info("=========================================")
+        logging.info(f"Analyzing {file_type}")
+        distribution_info = instance_records.select(file_type).summary()
+        distribution_info["instance_type"] = INSTANCE_TYPE
+        print_distribution(distribution_info)
+        all_distributions[file_type.value] = distribution_info
 
-    logging.info(f"Total Cost of Spot Instances (Without Detailed Information): ${global_total_cost:.2f}")
+    priced_cost, priced_count, unpriced_count = aggregate_costs(instance_records)
+    logging.info(f"Cost of the {priced_count} records with a spot price: ${priced_cost:.2f} "
+                 f"({unpriced_count} records without a price are not included, "
+                 f"step_3 prices every instance from the spot price history)")
 
     compare_start_times(all_distributions)
     compare_end_times(all_distributions)
 
-    file_name = "original_distribution.pkl"
-    save_distributions(all_distributions, file_name, selected_dir_path)
+    store_path = os.path.join(selected_dir_path, STORE_DIR)
+    logging.info("=========================================")
+    logging.info(f"Saving {len(instance_records)} instance records to {store_path}...")
+    instance_records.save(store_path)
 
 
 # Main Entry Point
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse the instance records and save them to the record store.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Read the records from the buckets instead of the files downloaded by step_0")
+    args = parser.parse_args()
+
     target_directory_name = "data"  # The name of the directory you're trying to find
-    find_directory(target_directory_name)
+    find_directory(target_directory_name, args.stream)
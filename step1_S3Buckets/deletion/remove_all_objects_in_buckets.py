@@ -3,6 +3,8 @@ from pathlib import Path
 
 import boto3
 
+from s3_bucket_ops import empty_bucket
+
 
 class CaseSensitiveConfigParser(configparser.ConfigParser):
     def optionxform(self, optionstr):
@@ -52,21 +54,10 @@ print(f"Found {len(buckets)} buckets to delete.")
 for bucket in buckets:
     print(f"Processing bucket: {bucket}")
 
-    # Delete all object versions
-    print(f"Listing and deleting object versions for bucket {bucket}...")
-    versions = s3.list_object_versions(Bucket=bucket).get('Versions', [])
-    for version in versions:
-        key = version['Key']
-        version_id = version['VersionId']
-        s3.delete_object(Bucket=bucket, Key=key, VersionId=version_id)
-
-    # Delete all delete markers
-    print(f"Listing and deleting delete markers for bucket {bucket}...")
-    delete_markers = s3.list_object_versions(Bucket=bucket).get('DeleteMarkers', [])
-    for marker in delete_markers:
-        key = marker['Key']
-        version_id = marker['VersionId']
-        s3.delete_object(Bucket=bucket, Key=key, VersionId=version_id)
+    # Delete all object versions and delete markers, listed page by page and deleted in concurrent
+    # 1000-key batches
+    print(f"Listing and deleting object versions and delete markers for bucket {bucket}...")
+    empty_bucket(s3, bucket)
 
     # Delete the bucket
     print(f"Deleting the bucket {bucket}...")
@@ -0,0 +1,120 @@
+"""
+S3 bucket operations
+
+Lists buckets with paginators, so nothing is cut off after the first 1000 keys, and yields the keys
+as the pages come in instead of building the whole listing first. Deletes go through DeleteObjects
+in batches of 1000 keys (the API maximum) sent from a small thread pool, instead of one
+delete_object call per key or version, so emptying a bucket no longer grows linearly with its size
+and history.
+
+The same file is shipped with every script that lists or empties buckets.
+"""
+
+import concurrent.futures
+import itertools
+
+# Largest number of keys DeleteObjects accepts in one call
+MAX_DELETE_BATCH = 1000
+
+# Number of DeleteObjects calls in flight at the same time
+DEFAULT_DELETE_WORKERS = 8
+
+
+def iter_objects(s3_client, bucket_name, prefix=''):
+    """
+    Yield every object of a bucket, one listing page at a time.
+    :param s3_client: S3 client
+    :param bucket_name: Name of the bucket
+    :param prefix: Only list the keys starting with this prefix
+    :return: Generator of {'Key': key} dictionaries
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield {'Key': obj['Key']}
+
+
+def iter_object_versions(s3_client, bucket_name, prefix=''):
+    """
+    Yield every object version and delete marker of a bucket, one listing page at a time.
+    Buckets that were never versioned return their objects with the 'null' version.
+    :param s3_client: S3 client
+    :param bucket_name: Name of the bucket
+    :param prefix: Only list the keys starting with this prefix
+    :return: Generator of {'Key': key, 'VersionId': version ID} dictionaries
+    """
+    paginator = s3_client.get_paginator('list_object_versions')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for version in itertools.chain(page.get('Versions', []), page.get('DeleteMarkers', [])):
+            yield {'Key': version['Key'], 'VersionId': version['VersionId']}
+
+
+def batched(iterable, size):
+    """
+    Split an iterable into lists of at most size elements without reading it all first.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def delete_batch(s3_client, bucket_name, objects):
+    """
+    Delete up to 1000 objects with a single DeleteObjects call.
+    :param s3_client: S3 client
+    :param bucket_name: Name of the bucket
+    :param objects: List of {'Key': key} or {'Key': key, 'VersionId': version ID} dictionaries
+    :return: Number of deleted objects
+    """
+    response = s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': objects, 'Quiet': True})
+    errors = response.get('Errors', [])
+    for error in errors:
+        print(f"Error deleting {error.get('Key')} ({error.get('VersionId', 'latest')}) from {bucket_name}: "
+              f"{error.get('Code')} {error.get('Message')}")
+    return len(objects) - len(errors)
+
+
+def delete_objects(s3_client, bucket_name, objects, max_workers=DEFAULT_DELETE_WORKERS):
+    """
+    Delete objects in 1000-key DeleteObjects batches sent concurrently.
+    The objects are consumed lazily, so a listing generator can be passed in directly and deletes start
+    as soon as the first page is listed.
+    :param s3_client: S3 client (clients are thread-safe and shared by the workers)
+    :param bucket_name: Name of the bucket
+    :param objects: Iterable of {'Key': key} or {'Key': key, 'VersionId': version ID} dictionaries
+    :param max_workers: Number of DeleteObjects calls in flight at the same time
+    :return: Number of deleted objects
+    """
+    deleted = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for batch in batched(objects, MAX_DELETE_BATCH):
+            # Keep the number of queued batches bounded, so a huge listing is never held in memory
+            if len(pending) >= max_workers * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                deleted += sum(future.result() for future in done)
+            pending.add(executor.submit(delete_batch, s3_client, bucket_name, batch))
+        deleted += sum(future.result() for future in concurrent.futures.as_completed(pending))
+    return deleted
+
+
+def empty_bucket(s3_client, bucket_name, include_versions=True, max_workers=DEFAULT_DELETE_WORKERS):
+    """
+    Delete everything in a bucket.
+    :param s3_client: S3 client
+    :param bucket_name: Name of the bucket
+    :param include_versions: Also delete old versions and delete markers, required before deleting a
+                             versioned bucket
+    :param max_workers: Number of DeleteObjects calls in flight at the same time
+    :return: Number of deleted objects
+    """
+    if include_versions:
+        objects = iter_object_versions(s3_client, bucket_name)
+    else:
+        objects = iter_objects(s3_client, bucket_name)
+    deleted = delete_objects(s3_client, bucket_name, objects, max_workers)
+    print(f"Deleted {deleted} objects from {bucket_name}.")
+    return deleted
@@ -2,6 +2,8 @@ import configparser
 import boto3
 from botocore.exceptions import ClientError
 
+from s3_bucket_ops import empty_bucket
+
 
 class CaseSensitiveConfigParser(configparser.ConfigParser):
     def optionxform(self, optionstr):
@@ -25,24 +27,8 @@ def delete_all_objects(s3_client, bucket_name):
     print(f"Deleting all objects from {bucket_name}")
 
     try:
-        while True:
-            # Retrieve all versions of every object within the bucket
-            versioned_objects = s3_client.list_object_versions(Bucket=bucket_name)
-
-            if 'Versions' in versioned_objects:
-                for version in versioned_objects['Versions']:
-                    s3_client.delete_object(Bucket=bucket_name, Key=version['Key'], VersionId=version['VersionId'])
-
-            # Handle delete markers separately
-            if 'DeleteMarkers' in versioned_objects:
-                for delete_marker in versioned_objects['DeleteMarkers']:
-                    s3_client.delete_object(Bucket=bucket_name, Key=delete_marker['Key'],
-                                            VersionId=delete_marker['VersionId'])
-
-            # If there are no versions or delete markers, break out of the loop
-            if not versioned_objects.get('Versions') and not versioned_objects.get('DeleteMarkers'):
-                break
-
+        # Paginated listing of every version and delete marker, deleted in concurrent 1000-key batches
+        empty_bucket(s3_client, bucket_name)
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchBucket':
             print(f"Bucket {bucket_name} does not exist. Skipping deletion.")
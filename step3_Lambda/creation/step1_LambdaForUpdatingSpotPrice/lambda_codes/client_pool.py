@@ -0,0 +1,215 @@
+"""
+Shared AWS client pool
+
+Every script used to build its clients ad hoc, often inside loops and worker threads, with the
+default retry settings and a connection pool of 10. The pool keeps one client per service and
+region for the lifetime of the process (or warm Lambda container), configured with:
+
+- adaptive retry mode, which backs off and rate-limits the client itself once AWS starts throttling,
+- max_pool_connections sized for the thread pools that share the client,
+- a token bucket per region in front of the EC2 Describe* calls, which share one request-rate
+  budget per account and region, so large fleet launches stop running into RequestLimitExceeded,
+- throttle counters per service, region and operation, to see which calls still get throttled.
+
+Clients are thread-safe and shared by every thread. Resources are not, so they are cached per thread.
+
+The same file is shipped with the launcher and with every Lambda that calls AWS from several threads.
+"""
+
+import threading
+import time
+from collections import Counter
+
+import boto3
+from botocore.config import Config
+
+# Large enough for the widest thread pool that shares one client (region workers, DeleteObjects workers)
+MAX_POOL_CONNECTIONS = 50
+
+# Attempts per call, including the first one; adaptive mode spaces the retries out
+MAX_ATTEMPTS = 10
+
+# Token bucket of the EC2 Describe* calls, per region: sustained calls per second and burst size.
+# EC2 refills the non-mutating action bucket at 20 calls per second with a capacity of 100.
+EC2_DESCRIBE_RATE = 20
+EC2_DESCRIBE_BURST = 100
+
+# Error codes AWS services return when a call is throttled
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'EC2ThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'SlowDown',
+    'BandwidthLimitExceeded',
+}
+
+CLIENT_CONFIG = Config(
+    retries={'max_attempts': MAX_ATTEMPTS, 'mode': 'adaptive'},
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+)
+
+
+class TokenBucket:
+    """
+    Blocking token bucket: acquire() waits until a token is available.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: Tokens added per second
+        :param burst: Maximum number of tokens
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+        :return: Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+_session = boto3.session.Session()
+_clients = {}
+_clients_lock = threading.Lock()
+_local = threading.local()
+
+_describe_buckets = {}
+_buckets_lock = threading.Lock()
+
+_throttles = Counter()
+_throttles_lock = threading.Lock()
+
+
+def describe_bucket(region_name):
+    """
+    Return the token bucket of the EC2 Describe* calls of a region.
+    """
+    with _buckets_lock:
+        if region_name not in _describe_buckets:
+            _describe_buckets[region_name] = TokenBucket(EC2_DESCRIBE_RATE, EC2_DESCRIBE_BURST)
+        return _describe_buckets[region_name]
+
+
+def _rate_limit_describe_calls(region_name):
+    bucket = describe_bucket(region_name)
+
+    def before_call(model, **kwargs):
+        if model.name.startswith('Describe'):
+            bucket.acquire()
+
+    return before_call
+
+
+def _count_throttles(service_name, region_name):
+    def needs_retry(response, operation, **kwargs):
+        # response is (HTTP response, parsed body), or None when the call raised before a response
+        if response is None:
+            return None
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code in THROTTLING_ERROR_CODES:
+            with _throttles_lock:
+                _throttles[(service_name, region_name, operation.name)] += 1
+        # Only observes the attempt, the retry decision is left to the retry handler
+        return None
+
+    return needs_retry
+
+
+def _needs_retry_event(client):
+    # Emitted once per attempt, named after the hyphenized service ID (e.g. 'dynamodb', 'ec2')
+    return f'needs-retry.{client.meta.service_model.service_id.hyphenize()}.*'
+
+
+def get_client(service_name, region_name=None):
+    """
+    Return the shared client of a service and region, creating it on first use.
+    :param service_name: AWS service name (e.g. 'ec2')
+    :param region_name: Region name, None uses the default region of the environment
+    :return: boto3 client
+    """
+    key = (service_name, region_name)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            # Sessions are not thread-safe, creating every client under the lock keeps the shared one safe
+            client = _session.client(service_name, region_name=region_name, config=CLIENT_CONFIG)
+            region = client.meta.region_name
+            if service_name == 'ec2':
+                client.meta.events.register('before-call.ec2.*', _rate_limit_describe_calls(region))
+            client.meta.events.register(_needs_retry_event(client), _count_throttles(service_name, region))
+            _clients[key] = client
+        return client
+
+
+def get_resource(service_name, region_name=None):
+    """
+    Return the resource of a service and region for the calling thread.
+    :param service_name: AWS service name (e.g. 'dynamodb')
+    :param region_name: Region name, None uses the default region of the environment
+    :return: boto3 resource
+    """
+    if not hasattr(_local, 'resources'):
+        # Resources are not thread-safe, every thread gets its own session and resources
+        _local.session = boto3.session.Session()
+        _local.resources = {}
+    key = (service_name, region_name)
+    if key not in _local.resources:
+        resource = _local.session.resource(service_name, region_name=region_name, config=CLIENT_CONFIG)
+        client = resource.meta.client
+        client.meta.events.register(_needs_retry_event(client),
+                                    _count_throttles(service_name, client.meta.region_name))
+        _local.resources[key] = resource
+    return _local.resources[key]
+
+
+def get_table(table_name, region_name=None):
+    """
+    Return a DynamoDB Table resource for the calling thread.
+    :param table_name: Name of the DynamoDB table
+    :param region_name: Region the table lives in
+    :return: DynamoDB Table resource
+    """
+    return get_resource('dynamodb', region_name).Table(table_name)
+
+
+def throttle_counts():
+    """
+    Number of throttled attempts so far.
+    :return: Dictionary of (service, region, operation) to count
+    """
+    with _throttles_lock:
+        return dict(_throttles)
+
+
+def report_throttles():
+    """
+    Print the throttled attempts so far, most throttled call first.
+    """
+    counts = throttle_counts()
+    if not counts:
+        print("No AWS calls were throttled.")
+        return
+    for (service_name, region_name, operation), count in sorted(counts.items(), key=lambda x: -x[1]):
+        print(f"Throttled {count} times: {service_name} {operation} in {region_name}")
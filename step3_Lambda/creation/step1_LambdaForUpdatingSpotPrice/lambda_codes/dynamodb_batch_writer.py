@@ -0,0 +1,107 @@
+"""
+Batched DynamoDB writes
+
+Writes and deletes items with BatchWriteItem (25 items per call) instead of one call per row.
+Unprocessed items and throttled calls are retried with exponential backoff, and every run reports
+how many items were written and how much write capacity was consumed.
+
+The same file is shipped with the launcher and with every Lambda that updates a DynamoDB table.
+"""
+
+import random
+import time
+
+from botocore.exceptions import ClientError
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+MAX_BATCH_SIZE = 25
+
+RETRYABLE_ERROR_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                         'RequestLimitExceeded', 'InternalServerError')
+
+
+def backoff_delay(attempt, base_delay=0.05, max_delay=2.0):
+    """
+    Exponential backoff with full jitter.
+    :param attempt: Number of the retry (starting at 0)
+    :return: Seconds to sleep
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def deduplicate_items(items, key_names):
+    """
+    Keep only the last item of each primary key; BatchWriteItem rejects duplicate keys in one call.
+    :param items: List of items
+    :param key_names: Attribute names of the primary key
+    :return: List of items with unique primary keys
+    """
+    unique_items = {tuple(item[name] for name in key_names): item for item in items}
+    return list(unique_items.values())
+
+
+def batch_put_items(table, items, overwrite_by_pkeys=None, max_attempts=8):
+    """
+    Put the given items into a DynamoDB table with BatchWriteItem.
+
+    :param table: DynamoDB Table resource
+    :param items: List of items (plain Python types, as for put_item)
+    :param overwrite_by_pkeys: Optional list of primary key attribute names used to drop duplicates
+    :param max_attempts: Maximum number of calls per chunk before giving up on its unprocessed items
+    :return: Dictionary with the written, failed, batches, retries and consumed_capacity counts
+    """
+    if overwrite_by_pkeys:
+        items = deduplicate_items(items, overwrite_by_pkeys)
+    return _batch_write(table, [{'PutRequest': {'Item': item}} for item in items], max_attempts)
+
+
+def batch_delete_keys(table, keys, max_attempts=8):
+    """
+    Delete the items with the given primary keys from a DynamoDB table with BatchWriteItem.
+
+    :param table: DynamoDB Table resource
+    :param keys: List of primary keys (e.g. {'request_id': 'sir-...'}), without duplicates
+    :param max_attempts: Maximum number of calls per chunk before giving up on its unprocessed items
+    :return: Dictionary with the written (deleted), failed, batches, retries and consumed_capacity counts
+    """
+    return _batch_write(table, [{'DeleteRequest': {'Key': key}} for key in keys], max_attempts)
+
+
+def _batch_write(table, write_requests, max_attempts):
+    # The client of a resource accepts plain Python types, like table.put_item does
+    client = table.meta.client
+    stats = {'written': 0, 'failed': 0, 'batches': 0, 'retries': 0, 'consumed_capacity': 0.0}
+
+    for i in range(0, len(write_requests), MAX_BATCH_SIZE):
+        requests = write_requests[i:i + MAX_BATCH_SIZE]
+
+        for attempt in range(max_attempts):
+            if attempt:
+                stats['retries'] += 1
+                time.sleep(backoff_delay(attempt - 1))
+
+            try:
+                response = client.batch_write_item(RequestItems={table.name: requests},
+                                                   ReturnConsumedCapacity='TOTAL')
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRYABLE_ERROR_CODES:
+                    raise e
+                print(f"Batch write to {table.name} throttled, retrying: {e}")
+                continue
+
+            stats['batches'] += 1
+            stats['consumed_capacity'] += sum(capacity.get('CapacityUnits', 0)
+                                              for capacity in response.get('ConsumedCapacity', []))
+
+            unprocessed = response.get('UnprocessedItems', {}).get(table.name, [])
+            stats['written'] += len(requests) - len(unprocessed)
+            requests = unprocessed
+            if not requests:
+                break
+
+        if requests:
+            print(f"Giving up on {len(requests)} unprocessed items for {table.name}.")
+            stats['failed'] += len(requests)
+
+    print(f"Batch write to {table.name} completed: {stats}")
+    return stats
@@ -1,67 +1,110 @@
+import concurrent.futures
 import configparser
 from datetime import datetime, timedelta
 from decimal import Decimal
 
-import boto3
+from client_pool import get_client, get_table, report_throttles
+from dynamodb_batch_writer import batch_put_items
 
 config = configparser.ConfigParser()
 config.read('./conf.ini')
 
 table_name = "SpotPriceCostTable"
 region_for_db = config.get('settings', 'Region_DynamodbForSpotPrice')
-dynamodb = boto3.resource('dynamodb', region_name=region_for_db)
-table = dynamodb.Table(table_name)
+table = get_table(table_name, region_for_db)
 instance_type = config.get('settings', 'instance_type')
+# Comma-separated list of instance types to collect, defaults to the single instance_type
+instance_types = [t.strip() for t in config.get('settings', 'instance_types', fallback=instance_type).split(',')]
+preferred_regions = [region.strip() for region in config.get('settings', 'regions_to_use').split(',')]
+available_regions = [region.strip() for region in config.get('settings', 'available_regions').split(',')]
+
+# Use the preferred regions when they are set, otherwise every region that is available for deployment
+if preferred_regions == ['None']:
+    regions_to_collect = available_regions
+else:
+    regions_to_collect = preferred_regions
+
+# Upper bound of regions queried at the same time
+MAX_COLLECTOR_WORKERS = 16
+
+print(f"Instance types: {instance_types}")
+print(f"Regions to collect: {regions_to_collect}")
+
+
+def collect_latest_prices(region_name, start_time):
+    """
+    Fetch the spot price history of every instance type in a region with one paginated call,
+    and keep the latest price of every AZ and instance type.
+    :param region_name: Region to query
+    :param start_time: Earliest timestamp of the price history to fetch
+    :return: List of items ready to be written to the SpotPriceCostTable
+    """
+    print(f"Processing region: {region_name}")
+    # Shared, thread-safe client; its Describe* calls are rate limited per region by the pool
+    ec2_client = get_client('ec2', region_name)
+
+    paginator = ec2_client.get_paginator('describe_spot_price_history')
+    page_iterator = paginator.paginate(
+        InstanceTypes=instance_types,
+        ProductDescriptions=['Linux/UNIX'],
+        StartTime=start_time
+    )
+
+    latest_prices = {}
+
+    for page in page_iterator:
+        for item in page['SpotPriceHistory']:
+            az_value = item.get('AvailabilityZone', 'ALL_AZs')
+            key = (az_value, item['InstanceType'])
+
+            # If this AZ/type is not in our dictionary or if the timestamp is newer than the existing one
+            if key not in latest_prices or item['Timestamp'] > latest_prices[key]['timestamp']:
+                latest_prices[key] = {
+                    'timestamp': item['Timestamp'],
+                    'price': Decimal(str(item['SpotPrice']))
+                }
 
-print(f"Instance type: {instance_type}")
+    return [
+        {
+            'availability_zone': az,
+            'instance_type': ec2_instance_type,
+            'timestamp': details['timestamp'].strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'price': details['price'],
+            'region': region_name  # This will just be a regular attribute now
+        }
+        for (az, ec2_instance_type), details in latest_prices.items()
+    ]
 
 
 def lambda_handler(event, context):
     print("Lambda execution started")
 
-    ec2_client_global = boto3.client('ec2')
-    ec2_regions = [region['RegionName'] for region in ec2_client_global.describe_regions()['Regions']]
-    print(f"Found EC2 regions: {ec2_regions}")
-
     # Calculate start time as 1 hour ago
     start_time = datetime.utcnow() - timedelta(hours=1)
-
-    for region_name in ec2_regions:
-        print(f"Processing region: {region_name}")
-        ec2_client = boto3.client('ec2', region_name=region_name)
-
-        paginator = ec2_client.get_paginator('describe_spot_price_history')
-        page_iterator = paginator.paginate(
-            InstanceTypes=[instance_type],
-            ProductDescriptions=['Linux/UNIX'],
-            StartTime=start_time
-        )
-
-        latest_prices = {}
-
-        for page in page_iterator:
-            for item in page['SpotPriceHistory']:
-                az_value = item.get('AvailabilityZone', 'ALL_AZs')
-
-                # If this AZ is not in our dictionary or if the timestamp is newer than the existing one
-                if az_value not in latest_prices or item['Timestamp'] > latest_prices[az_value]['timestamp']:
-                    latest_prices[az_value] = {
-                        'timestamp': item['Timestamp'],
-                        'price': Decimal(str(item['SpotPrice']))
-                    }
-
-        # Insert the latest prices into DynamoDB
-        for az, details in latest_prices.items():
-            print(f"Inserting/updating data for availability zone: {az} in region: {region_name}")
-
-            table.put_item(
-                Item={
-                    'availability_zone': az,
-                    'timestamp': details['timestamp'].strftime('%Y-%m-%dT%H:%M:%SZ'),
-                    'price': details['price'],
-                    'region': region_name  # This will just be a regular attribute now
-                }
-            )
+    items = []
+
+    # Query every region at once, the run then takes about as long as the slowest region
+    max_workers = min(MAX_COLLECTOR_WORKERS, len(regions_to_collect))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(collect_latest_prices, region_name, start_time): region_name
+                   for region_name in regions_to_collect}
+
+        for future in concurrent.futures.as_completed(futures):
+            region_name = futures[future]
+            try:
+                region_items = future.result()
+            except Exception as e:
+                print(f"Error collecting spot prices for region {region_name}: {e}")
+                continue
+
+            for item in region_items:
+                print(f"Inserting/updating data for availability zone: {item['availability_zone']} "
+                      f"({item['instance_type']}) in region: {region_name}")
+            items.extend(region_items)
+
+    write_stats = batch_put_items(table, items, overwrite_by_pkeys=['availability_zone', 'instance_type'])
+    report_throttles()
 
     print("Lambda execution completed")
-    return "Lambda execution completed"
+    return f"Lambda execution completed: {write_stats['written']} items written, " \
+           f"{write_stats['consumed_capacity']} WCU consumed"
@@ -1,16 +1,25 @@
-import base64
+import concurrent.futures
 import configparser
+import functools
 import json
 import os
-import random
 import re
 import time
-from datetime import datetime
-from datetime import timezone
-from decimal import Decimal
-
-import boto3
-from boto3.dynamodb.conditions import Attr
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+from client_pool import get_client, get_table
+from launch_backends import SPOT_REQUEST_BACKEND, get_launch_backend
+from placement_engine import DEFAULT_SPREAD, allocate_instances, fetch_pool_scores, launch_across_pools, \
+    placement_weights
+from region_scores import INTERRUPTION_TABLE_NAME, SPS_TABLE_NAME, fetch_region_scores
+from spot_price_store import SPOT_PRICE_TABLE_NAME, cheapest_items, filter_instance_types_by_requirements, \
+    query_prices_for_regions
+from spot_request_ledger import FAILED, INTERRUPTED, LEDGER_TABLE_NAME, OPEN, STANDBY, SUCCESSFUL, SpotRequestLedger
+from standby_pool import REPLENISH_EVENT_KEY, StandbyPool, is_member, request_replenishment, user_data_standby_wait
+from ttl_cache import TTLCache
+from user_data_builder import render_user_data, user_data_config
 
 # Initialize the parser and read the ini file
 config = configparser.ConfigParser()
@@ -18,19 +27,40 @@ config.read('./conf.ini')
 regions_string = config.get('settings', 'regions_to_use')
 target_regions = [region.strip() for region in regions_string.split(',')]
 
-SLEEP_TIME_SPOT_REQUEST = 30  # seconds
+SLEEP_TIME_SPOT_REQUEST = 30  # maximum seconds to wait for a spot request to settle
 complete_bucket_name = config.get('settings', 'complete_s3_bucket_name')
 interrupt_s3_bucket_name = config.get('settings', 'interrupt_s3_bucket_name')
 sleep_time = int(config.get('settings', 'sleep_time'))
 number_of_spot_instances = 1
 # factor = Decimal(config.getfloat('settings', 'spot_price_factor'))
 instance_type = config.get('settings', 'instance_type')
+# Candidate instance types, the cheapest AZ/type pair that meets the requirements is launched
+instance_types = [t.strip() for t in config.get('settings', 'instance_types', fallback=instance_type).split(',')]
+min_vcpus = config.getint('settings', 'min_vcpus', fallback=0)
+min_memory_gib = config.getfloat('settings', 'min_memory_gib', fallback=0)
+placement_spread = config.getint('settings', 'placement_spread_azs', fallback=DEFAULT_SPREAD)
 key_name = config.get('settings', 'key_name')
 spot_status_s3_bucket_name = config.get('settings', 'spot_tracking_s3_bucket_name')
 Region_DynamodbForSpotPrice = config.get('settings', 'Region_DynamodbForSpotPrice')
+Region_DynamoForSpotRequestLedger = config.get('settings', 'Region_DynamoForSpotRequestLedger',
+                                               fallback=Region_DynamodbForSpotPrice)
 on_demand_price = float(config.get('settings', 'on_demand_price'))
+launch_backend = get_launch_backend(config.get('settings', 'launch_backend', fallback=SPOT_REQUEST_BACKEND),
+                                    on_demand_price, SLEEP_TIME_SPOT_REQUEST,
+                                    config.get('settings', 'fleet_allocation_strategy',
+                                               fallback='price-capacity-optimized'))
 Region_DynamoDBForSpotPlacementScore = config.get('settings', 'Region_DynamoForSpotPlacementScore')
 Region_DynamoDBForStabilityScore = config.get('settings', 'Region_DynamoForSpotInterruptionRatio')
+# The updater Lambdas refresh the score and price tables at the top of every hour (step5_CloudWatch); cached
+# reads expire once they are done (SCORE_REFRESH_LAG seconds past the hour), or after SCORE_CACHE_TTL seconds
+SCORE_CACHE_TTL = config.getint('settings', 'score_cache_ttl', fallback=3600)
+SCORE_REFRESH_PERIOD = 3600
+SCORE_REFRESH_LAG = config.getint('settings', 'score_refresh_lag', fallback=300)
+# Warm-standby pool, disabled when its maximum size is 0
+standby_pool_min_size = config.getint('settings', 'standby_pool_min_size', fallback=0)
+standby_pool_max_size = config.getint('settings', 'standby_pool_max_size', fallback=0)
+standby_replenish_seconds = config.getint('settings', 'standby_replenish_seconds', fallback=300)
+standby_rate_window_hours = config.getfloat('settings', 'standby_rate_window_hours', fallback=24)
 
 print(f"Configured target regions: {target_regions}")
 print(f"target_regions: {target_regions}")
@@ -38,29 +68,32 @@ print(f"target_regions: {target_regions}")
 print(f"sleep_time: {sleep_time}")
 print(f"number_of_spot_instances: {number_of_spot_instances}")
 print(f"instance_type: {instance_type}")
+print(f"instance_types: {instance_types} (min vCPUs: {min_vcpus}, min memory: {min_memory_gib} GiB)")
 print(f"key_name: {key_name}")
 print(f"complete_bucket_name: {complete_bucket_name}")
 print(f"interrupt_bucket_name: {interrupt_s3_bucket_name}")
 print("SLEEP_TIME_SPOT_REQUEST: ", SLEEP_TIME_SPOT_REQUEST)
 print(f"spot_status_bucket_name: {spot_status_s3_bucket_name}")
 print(f"Region_DynamodbForSpotPrice: {Region_DynamodbForSpotPrice}")
+print(f"Region_DynamoForSpotRequestLedger: {Region_DynamoForSpotRequestLedger}")
 print(f"on_demand_price: {on_demand_price}")
-
-s3_client = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb', region_name=Region_DynamodbForSpotPrice)
-table = dynamodb.Table('SpotPriceCostTable')
-ec2_client = boto3.client('ec2')
+print(f"SCORE_CACHE_TTL: {SCORE_CACHE_TTL}")
+print(f"SCORE_REFRESH_LAG: {SCORE_REFRESH_LAG}")
+print(f"placement_spread: {placement_spread}")
+print(f"launch_backend: {launch_backend.name}")
+print(f"standby pool size: {standby_pool_min_size}-{standby_pool_max_size}")
+
+# Clients and resources come from the shared pool and survive between invocations of a warm container
+s3_client = get_client('s3')
+table = get_table(SPOT_PRICE_TABLE_NAME, Region_DynamodbForSpotPrice)
+ledger = SpotRequestLedger(get_table(LEDGER_TABLE_NAME, Region_DynamoForSpotRequestLedger))
+standby_pool = StandbyPool(ledger, standby_pool_min_size, standby_pool_max_size, standby_replenish_seconds,
+                           standby_rate_window_hours)
+# Survives between invocations of a warm container
+score_cache = TTLCache(SCORE_CACHE_TTL, SCORE_REFRESH_PERIOD, SCORE_REFRESH_LAG)
 region_for_lambda_env = os.environ['AWS_REGION']
 
 
-def check_object_exists_in_s3(s3_client, bucket_name, object_key):
-    try:
-        s3_client.head_object(Bucket=bucket_name, Key=object_key)
-        return True
-    except Exception as e:
-        return False
-
-
 def extract_value(pattern, content):
     return match[1] if (match := re.search(pattern, content)) else None
 
@@ -78,21 +111,33 @@ def get_aws_credentials_from_file(filename='credentials.txt'):
     }
 
 
-def add_instance_id_to_s3(instance_id, s3_client, event):
+def describe_instance(instance_id, region):
+    """
+    Fetch the details of an instance with one describe_instances call.
+    :param instance_id: Instance ID
+    :param region: Region of the instance
+    :return: Instance description, or None if it could not be described
+    """
+    try:
+        response = get_client('ec2', region).describe_instances(InstanceIds=[instance_id])
+        return response['Reservations'][0]['Instances'][0]
+    except Exception as e:
+        print(f"Error describing instance {instance_id}: {e}")
+        return None
+
+
+def add_instance_id_to_s3(instance_id, s3_client, event, instance_details=None):
     termination_time = event.get('time', None)
     region = event.get('region', 'N/A')
 
     try:
-
-        # Fetch instance details
-        ec2_client = boto3.client('ec2', region_name=region)
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        instance_details = response['Reservations'][0]['Instances'][0]
+        if instance_details is None:
+            raise ValueError(f"No instance details for {instance_id}")
+        ec2_client = get_client('ec2', region)
 
         availability_zone = instance_details['Placement']['AvailabilityZone']
         ec2_instance_type = instance_details['InstanceType']
         launch_time = instance_details['LaunchTime'].strftime('%Y-%m-%dT%H:%M:%SZ')  # Format launch time
-        current_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
 
         # Get the current spot price for the instance type in its availability zone
         spot_price_response = ec2_client.describe_spot_price_history(
@@ -128,16 +173,16 @@ def add_instance_id_to_s3(instance_id, s3_client, event):
         )
 
     try:
-        buckets = [bucket['Name'] for bucket in s3_client.list_buckets()['Buckets']]
-        if interrupt_s3_bucket_name not in buckets:
+        object_key = f'{instance_id}.txt'
+        try:
+            s3_client.put_object(Bucket=interrupt_s3_bucket_name, Key=object_key, Body=data.encode('utf-8'))
+        except ClientError as e:
+            # The bucket is created by the setup scripts, only list/create it when it is really missing
+            if e.response['Error']['Code'] != 'NoSuchBucket':
+                raise e
             print(f"Bucket '{interrupt_s3_bucket_name}' does not exist. Creating it...")
             s3_client.create_bucket(Bucket=interrupt_s3_bucket_name)
-            print(f"Bucket '{interrupt_s3_bucket_name}' created successfully.")
-        else:
-            print(f"Bucket '{interrupt_s3_bucket_name}' already exists.")
-
-        object_key = f'{instance_id}.txt'
-        s3_client.put_object(Bucket=interrupt_s3_bucket_name, Key=object_key, Body=data.encode('utf-8'))
+            s3_client.put_object(Bucket=interrupt_s3_bucket_name, Key=object_key, Body=data.encode('utf-8'))
         print("Data:", data)
         print(f"Uploaded instance details for {instance_id} to S3 bucket {interrupt_s3_bucket_name}.")
 
@@ -145,6 +190,7 @@ def add_instance_id_to_s3(instance_id, s3_client, event):
         print(f"An error occurred during S3 operations: {str(e)}")
 
 
+@functools.lru_cache(maxsize=None)
 def get_values_from_file(filename):
     values = {}
     with open(f"./{filename}", 'r') as f:
@@ -154,183 +200,65 @@ def get_values_from_file(filename):
     return values
 
 
-def generate_user_data_script(aws_credentials, sleep_time, complete_bucket_name):
-    script = f"""#!/bin/bash
-
-                # Exporting AWS credentials for use in subsequent AWS CLI commands
-                export AWS_ACCESS_KEY_ID="{aws_credentials['AWS_ACCESS_KEY_ID']}"
-                export AWS_SECRET_ACCESS_KEY="{aws_credentials['AWS_SECRET_ACCESS_KEY']}"
-
-                # Initializing the log file to capture the output of this script
-                echo "Starting script" >/var/log/user-data.log
-
-                # Redirecting all stdout and stderr to the log file for debugging purposes
-                exec > >(tee -a /var/log/user-data.log) 2>&1
-
-                # Placeholder sleep command for testing purposes
-                # You can remove or replace this line with actual script logic in production
-                echo "Sleeping for {sleep_time} seconds..."
-                sleep {sleep_time}
-
-                # Retrieve the instance ID using the ec2-metadata command
-                echo "Retrieving the instance ID using ec2-metadata..."
-                INSTANCE_ID=$(ec2-metadata -i | cut -d " " -f 2)
-                echo "Instance ID retrieved: $INSTANCE_ID"
-
-                # Retrieve the Spot Instance Request ID associated with this instance
-                SPOT_REQUEST_ID=$(aws ec2 describe-instances --instance-id $INSTANCE_ID --query "Reservations[0].Instances[0].SpotInstanceRequestId" --output text)
-                echo "Spot Instance Request ID retrieved: $SPOT_REQUEST_ID"
-
-                # Extract the region from the Availability Zone using ec2-metadata
-                REGION=$(ec2-metadata -z | cut -d " " -f 2 | sed 's/.$//')
-                echo "Region retrieved: $REGION"
-
-                # Check if the specific file exists in the S3 bucket for spot instance interruptions
-                CHECK_KEY="open/${{REGION}}|${{SPOT_REQUEST_ID}}.txt"
-                echo "Checking if file $CHECK_KEY exists in bucket {spot_status_s3_bucket_name}..."
-                if aws s3api head-object --bucket "{spot_status_s3_bucket_name}" --key "$CHECK_KEY" 2>/dev/null; then
-                    echo "File $CHECK_KEY exists in bucket. No further action required."
-                    aws s3api delete-object --bucket "{spot_status_s3_bucket_name}" --key "$CHECK_KEY"
-                else
-                    echo "File $CHECK_KEY does not exist in bucket {spot_status_s3_bucket_name}. Skipping..."
-                fi
-
-                # Retrieve instance details such as instance type, availability zone, and launch time
-                INSTANCE_TYPE=$(ec2-metadata -t | cut -d " " -f 2)
-                AVAILABILITY_ZONE=$(ec2-metadata -z | cut -d " " -f 2)
-                LAUNCH_TIME=$(aws ec2 describe-instances \
-                  --instance-id $INSTANCE_ID \
-                  --query "Reservations[0].Instances[0].LaunchTime" \
-                  --output text)
-                # Fetch the current spot price for the instance type in the specific availability zone
-                CURRENT_SPOT_PRICE=$(aws ec2 describe-spot-price-history \
-                  --instance-types $INSTANCE_TYPE \
-                  --availability-zone $AVAILABILITY_ZONE \
-                  --product-descriptions "Linux/UNIX" \
-                  --max-results 1 \
-                  --query "SpotPriceHistory[0].SpotPrice" \
-                  --output text)
-                CURRENT_TIME=$(date --utc +'%Y-%m-%dT%H:%M:%S+00:00')
-
-                # Write all the retrieved information to a temporary file
-                echo "Instance ID: $INSTANCE_ID" > /tmp/instance_info.txt
-                echo "Availability Zone: $AVAILABILITY_ZONE" >> /tmp/instance_info.txt
-                echo "Instance Launch Time: $LAUNCH_TIME" >> /tmp/instance_info.txt
-                echo "Current Time: $CURRENT_TIME" >> /tmp/instance_info.txt
-                echo "Current Spot Price: $CURRENT_SPOT_PRICE" >> /tmp/instance_info.txt
-
-                # Define the S3 object key as the instance ID followed by .txt
-                KEY="$INSTANCE_ID.txt"
-
-                # Check if the S3 bucket for completed instance information exists, create it if not
-                echo "Checking if bucket {complete_bucket_name} exists..."
-                if aws s3api head-bucket --bucket "{complete_bucket_name}" &>/dev/null; then
-                  echo "Bucket {complete_bucket_name} exists"
-                else
-                  echo "Bucket {complete_bucket_name} does not exist. Creating..."
-                  aws s3api create-bucket --bucket "{complete_bucket_name}"
-                  echo "Bucket {complete_bucket_name} created."
-                fi
-
-                # Upload the instance information file to the S3 bucket
-                echo "Uploading the file with the name $INSTANCE_ID.txt to the S3 bucket {complete_bucket_name}..."
-                aws s3api put-object --bucket {complete_bucket_name} --key $KEY --body /tmp/instance_info.txt
-                # Remove the temporary file after uploading
-                rm -f /tmp/instance_info.txt
-                echo "Upload completed. Please check the S3 bucket for the file."
-
-                # Terminate the instance after completing all tasks
-                echo "Terminating instance $INSTANCE_ID"
-                aws ec2 terminate-instances --instance-ids $INSTANCE_ID
-
-                """
-    # Return the generated script, base64 encoded for use in the EC2 user data
-    return base64.b64encode(script.encode()).decode()
-
-
-def save_spot_request_to_s3(s3_client, bucket_name, folder, request_id, region, check_count=0):
-    """
-    Save the spot request ID to the specified folder in the bucket with region information in the filename.
-    Include the check count in the object's metadata.
-    """
-    try:
-        s3_key = f"{folder}/{region}|{request_id}.txt"
-        metadata = {'check_count': str(check_count)}
-        s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=request_id, Metadata=metadata)
-        print(
-            f"Spot request {request_id} (Region: {region}) saved to {folder} in S3 bucket {bucket_name} with check count {check_count}.")
-    except Exception as e:
-        print(
-            f"Error saving spot request {request_id} (Region: {region}) to {folder} in S3 bucket {bucket_name}. Error: {e}")
+def generate_user_data_script(aws_credentials, sleep_time, complete_bucket_name, standby=False):
+    # Standby instances stay parked until they are claimed from the pool
+    standby_wait = user_data_standby_wait(Region_DynamoForSpotRequestLedger) if standby else ''
+    return render_user_data(user_data_config(aws_credentials, complete_bucket_name, sleep_time=sleep_time,
+                                             ledger_region=Region_DynamoForSpotRequestLedger,
+                                             before_workload=standby_wait))
 
 
-def check_spot_request_and_save_open_request_to_s3(ec2_inst_client, request_id, region):
+def record_launch_result(ec2_inst_client, result, region, standby=False):
     """
-    Waits for the spot instance request to be fulfilled and handles various states.
+    Record the spot requests of a launch in the ledger and cancel the ones that failed.
+    :param ec2_inst_client: EC2 client of the region the instances were launched in
+    :param result: LaunchResult of the launch backend
+    :param region: Region of the launch
+    :param standby: The instances are parked in the standby pool
+    :return: Tuple of (status, instance ID or spot request ID) of the first successful request
     """
-    try:
-        response = ec2_inst_client.describe_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-        state = response['SpotInstanceRequests'][0]['State']
-
-        # Active State
-        if state == 'active':
-            instance_id = response['SpotInstanceRequests'][0]['InstanceId']
-            save_spot_request_to_s3(s3_client, spot_status_s3_bucket_name, 'successful', request_id, region)
-            print(f"Spot request {request_id} is active with instance ID: {instance_id}.")
-            print(f"Saved to S3 bucket {spot_status_s3_bucket_name} with successful folder .")
-            return 'active', instance_id
-
-        elif state == 'open':
-            save_spot_request_to_s3(s3_client, spot_status_s3_bucket_name, 'open', request_id, region)
-            print(f"Spot request {request_id} is open. Saved to S3.")
-            return 'open', request_id
-
-        elif state == 'failed':
-            print(f"Spot request {request_id} has failed.")
-            ec2_inst_client.cancel_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-            return 'failed', None
-
-        elif state == 'cancelled':
-            print(f"Spot request {request_id} has been cancelled already. No further action required.")
-            return 'cancelled', None
-
-        elif state in ['closed', 'marked-for-termination']:
-            print(f"Spot request {request_id} is {state}. No further action required.")
-            return state, None
-
-        else:
-            print(f"Spot request {request_id} is in an unexpected state: {state}.")
-            return state, None
-
-    except Exception as e:
-        print(f"Error while handling spot request {request_id}: {e}")
-        return 'error', None
-
-
-import random
-import boto3
+    if standby and result.open_request_ids:
+        # A standby only helps if it is running already, open standby requests are given up
+        print(f"Standby spot requests {result.open_request_ids} are still open, cancelling them.")
+        result.failed_request_ids.extend(result.open_request_ids)
+        result.open_request_ids = []
+
+    active_state = STANDBY if standby else SUCCESSFUL
+    # One batched ledger write for every request of the launch
+    ledger.record_many(
+        [(request_id, region, active_state, instance_id) for request_id, instance_id in result.active.items()]
+        + [(request_id, region, OPEN, None) for request_id in result.open_request_ids]
+        + [(request_id, region, FAILED, None) for request_id in result.failed_request_ids])
+
+    if result.failed_request_ids:
+        print(f"Spot requests {result.failed_request_ids} have failed.")
+        try:
+            ec2_inst_client.cancel_spot_instance_requests(SpotInstanceRequestIds=result.failed_request_ids)
+        except Exception as e:
+            print(f"Error cancelling failed spot requests {result.failed_request_ids}: {e}")
+
+    if result.active:
+        return 'active', next(iter(result.active.values()))
+    if result.open_request_ids:
+        return 'open', result.open_request_ids[0]
+    return 'failed', None
+
+
+@functools.lru_cache(maxsize=2)
+def get_user_data_encoded(standby=False):
+    """
+    Return the user data of replacement (or standby) instances. It only depends on conf.ini and
+    credentials.txt, so it is built once per container instead of on the interruption path.
+    """
+    return generate_user_data_script(get_aws_credentials_from_file(), sleep_time, complete_bucket_name, standby)
 
-import random
-import boto3
 
-def launch_spot_instance(aws_credentials, target_regions, table):
+def launch_spot_instance(target_regions, table):
     print("Starting the launch_spot_instance function...")
 
-    user_data_encoded = generate_user_data_script(aws_credentials, sleep_time, complete_bucket_name)
+    user_data_encoded = get_user_data_encoded()
     print(f"Generated user data script: {user_data_encoded[:50]}...")  # Display the first 50 characters for brevity
 
-    print("Scanning the DynamoDB table for available items...")
-    response = table.scan()
-
-    items = response.get('Items', [])
-    print(f"Scanned items: {items}")
-    if not items:
-        print("No items found in the table.")
-        raise Exception("NoItemsAvailable: No items found in the response.")
-
-    available_items = [item for item in items if item['region'] in target_regions]
-    print(f"Filtered available items based on target regions: {available_items}")
-
     # Evaluate regions based on SPS and Interruption Free Scores
     print("Evaluating regions based on SPS and Interruption Free Scores...")
     suitable_regions = evaluate_regions_for_spot_instances(target_regions)
@@ -339,35 +267,68 @@ def launch_spot_instance(aws_credentials, target_regions, table):
         print("No suitable regions found after evaluation.")
         raise Exception("No suitable regions based on SPS and Interruption Free scores.")
 
-    # Filter available items to only include those in suitable regions
-    available_items = [item for item in available_items if item['region'] in suitable_regions]
-    print(f"Available items after filtering by suitable regions: {available_items}")
-    if not available_items:
+    # Query only the AZs of the suitable regions, already sorted by price
+    print("Querying the DynamoDB table for the suitable regions...")
+    items_by_region = get_cached_prices_for_regions(suitable_regions)
+    print(f"Available items by suitable region: {items_by_region}")
+    if not items_by_region:
         print("No items available in the suitable regions.")
         raise Exception("NoItemsAvailable: No items available in the suitable regions.")
 
-    # Randomly select one of the suitable regions
-    selected_region = random.choice(suitable_regions)
-    print(f"Randomly selected region: {selected_region}")
+    # Spread the launch over the cheapest pools of all suitable regions, weighted by price and scores,
+    # so replacements do not all land in the pool that was just interrupted
+    weighted_items = placement_weights(cheapest_items(items_by_region), get_cached_pool_scores(), placement_spread)
+    print(f"Candidate pools: {[(item['availability_zone'], round(weight, 3)) for item, weight in weighted_items]}")
+
+    print(f"Using On-Demand price: {on_demand_price} (launch backend: {launch_backend.name})")
+    results = []
+    if launch_backend.multi_pool:
+        # A fleet only spans one region, so try one fleet per region over its candidate pools, best region first
+        pools_by_region = {}
+        for item, _ in weighted_items:
+            pools_by_region.setdefault(item['region'], []).append(item)
+        for pools in pools_by_region.values():
+            try:
+                results.append(launch_in_pools(pools, number_of_spot_instances, user_data_encoded))
+            except Exception as e:
+                results.append(e)
+                continue
+            if results[-1][0] in ['active', 'open']:
+                break
+    else:
+        allocations = allocate_instances(weighted_items, number_of_spot_instances)
+        print(f"Placement: {[(item['availability_zone'], n) for item, n in allocations]}")
+        results = [result for _, _, result in launch_across_pools(
+            allocations, lambda item, count: launch_in_pools([item], count, user_data_encoded))]
+
+    successful_results = [result for result in results
+                          if not isinstance(result, Exception) and result[0] in ['active', 'open']]
+    if not successful_results:
+        print("No spot request was successful.")
+        raise Exception("Spot request was not successful.")
 
-    # Filter available items to only include those in the selected region
-    region_specific_items = [item for item in available_items if item['region'] == selected_region]
-    print(f"Items in the selected region: {region_specific_items}")
+    status, result = successful_results[0]
+    print(f"Spot request was successful with status {status}.")
+    return result
 
-    # Sort the items within the selected region by price
-    sorted_items = sorted(region_specific_items, key=lambda x: float(x['price']))
-    print(f"Sorted items by price in the selected region: {sorted_items}")
 
-    # Select the best-priced item within the selected region
-    selected_region_item = sorted_items[0]  # Since it's sorted, the first item will have the lowest price
-    region = selected_region_item['region']
-    availability_zone = selected_region_item['availability_zone']
+def launch_in_pools(pools, count, user_data_encoded, standby=False):
+    """
+    Launch spot instances in the given pools of one region with the configured launch backend.
+    :param pools: Spot price items of the pools (the legacy backend only uses the first one)
+    :param count: Number of instances to launch
+    :param user_data_encoded: Base64 encoded user data script
+    :param standby: The instances are parked in the standby pool
+    :return: Tuple of (status, instance ID or spot request ID)
+    """
+    region = pools[0]['region']
+    # Rows written before prices were stored per instance type have no instance_type
+    pools = [{**pool, 'instance_type': pool.get('instance_type', instance_type)} for pool in pools]
 
     print(f"Selected region: {region}")
-    print(f"Selected availability zone: {availability_zone}")
+    print(f"Selected pools: {[(pool['availability_zone'], pool['instance_type']) for pool in pools]}")
 
-    print(f"Using On-Demand price: {on_demand_price}")
-    ec2_instance_client = boto3.client('ec2', region_name=region)
+    ec2_instance_client = get_client('ec2', region)
 
     ami_id = get_values_from_file('ami_ids.txt').get(region)
     security_group_ids = [get_values_from_file('security_group_ids.txt').get(region)]
@@ -376,125 +337,174 @@ def launch_spot_instance(aws_credentials, target_regions, table):
     print(f"Security Group IDs: {security_group_ids}")
 
     try:
-        print("Requesting spot instances...")
-        response = ec2_instance_client.request_spot_instances(
-            SpotPrice=str(on_demand_price),
-            InstanceCount=number_of_spot_instances,
-            Type="one-time",
-            LaunchSpecification={
-                "ImageId": ami_id,
-                "InstanceType": instance_type,
-                "KeyName": key_name,
-                "SecurityGroupIds": security_group_ids,
-                "Placement": {
-                    "AvailabilityZone": availability_zone
-                },
-                'UserData': user_data_encoded
-            }
-        )
-        print(f"Spot instance request response: {response}")
+        print("Launching spot instances...")
+        result = launch_backend.launch(ec2_instance_client, pools, count, {
+            "ImageId": ami_id,
+            "KeyName": key_name,
+            "SecurityGroupIds": security_group_ids,
+            'UserData': user_data_encoded
+        })
+        print(f"Launch result: {result}")
 
     except Exception as e:
-        print(f"Error occurred during spot instance request: {e}")
+        print(f"Error occurred during spot instance launch: {e}")
         raise e
 
-    print("Sleeping for 30 seconds to allow the spot request to process...")
-    time.sleep(SLEEP_TIME_SPOT_REQUEST)
-
-    spot_request_id = response['SpotInstanceRequests'][0]['SpotInstanceRequestId']
-    print(f"Spot Request ID: {spot_request_id}")
-
-    status, result = check_spot_request_and_save_open_request_to_s3(ec2_instance_client, spot_request_id, region)
+    status, result = record_launch_result(ec2_instance_client, result, region, standby)
     print(f"Spot request status: {status}")
     print(f"Result: {result}")
 
     if status in ['active', 'open']:
-        print(f"Spot request was successful with status {status}.")
         type_of_result = 'Instance ID' if result.startswith('i') else 'Spot Request ID'
-        print(f"Processed request {spot_request_id} successfully with {type_of_result}: {result}")
-        return result
+        print(f"Launched successfully with {type_of_result}: {result}")
     else:
-        print(f"Spot request {spot_request_id} was not successful with status {status}.")
-        raise Exception("Spot request was not successful.")
+        print(f"Launch in {region} was not successful with status {status}.")
+    return status, result
 
 
-
-def get_request_id_from_instance(instance_id):
+def hand_over_standby(instance_id):
+    """
+    Replace an interrupted instance from the warm-standby pool.
+    :param instance_id: ID of the interrupted instance
+    :return: True if the pool handled the interruption (a standby was claimed, or the interrupted instance was
+             a standby itself), False if a replacement has to be launched
+    """
+    if not standby_pool.enabled:
+        return False
     try:
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        instance_details = response['Reservations'][0]['Instances'][0]
-        return instance_details['SpotInstanceRequestId']
+        members = standby_pool.members()
+        if is_member(members, instance_id):
+            print(f"Interrupted instance {instance_id} was a standby instance, no replacement is launched.")
+            return True
+        return standby_pool.claim(members, exclude_instance_id=instance_id) is not None
     except Exception as e:
-        print(f"Error fetching request ID for instance {instance_id}: {str(e)}")
-        return None
+        print(f"Error claiming a standby instance, launching a replacement instead: {e}")
+        return False
 
 
-def fetch_highest_sps_score(region: str) -> int:
+def replenish_standby_pool():
     """
-    Fetch the highest SPS score for a given region from the SpotPlacementScoreTable.
+    Launch the standby instances missing from the pool, unless another invocation is already replenishing it.
+    :return: Number of standby instances requested
+    """
+    with standby_pool.replenish_lock() as locked:
+        if not locked:
+            print("Another invocation is replenishing the standby pool.")
+            return 0
+        return launch_standby_shortfall()
 
-    :param region: The region to fetch the score.
-    :return: The highest SPS score as an integer.
+
+def launch_standby_shortfall():
+    """
+    Launch the standby instances missing from the pool, all in the best-scored suitable region.
+    Runs under the replenish lock, so the shortfall includes every standby launched before.
+    :return: Number of standby instances requested
     """
-    dynamodb = boto3.resource('dynamodb',
-                              region_name=Region_DynamoDBForSpotPlacementScore)  # Replace with the correct region
-    table = dynamodb.Table('SpotPlacementScoreTable')
+    shortfall = standby_pool.shortfall()
+    if not shortfall:
+        print("Standby pool is at its target size.")
+        return 0
+
+    items_by_region = get_cached_prices_for_regions(evaluate_regions_for_spot_instances(target_regions))
+    if not items_by_region:
+        print("No suitable region with price data to park standby instances in.")
+        return 0
 
-    print(f"Fetching the highest SPS score for region {region} from SpotPlacementScoreTable...")
+    # Served from the cache filled by evaluate_regions_for_spot_instances
+    total_scores = fetch_region_scores(target_regions, Region_DynamoDBForSpotPlacementScore,
+                                       Region_DynamoDBForStabilityScore,
+                                       instance_types=get_eligible_instance_types(), cache=score_cache)
+    best_region = max(items_by_region, key=lambda region: total_scores.get(region, 0))
+    weighted_items = placement_weights(items_by_region[best_region], get_cached_pool_scores(), placement_spread)
+    user_data_encoded = get_user_data_encoded(standby=True)
+
+    print(f"Launching {shortfall} standby instances in {best_region}...")
+    if launch_backend.multi_pool:
+        launch_in_pools([item for item, _ in weighted_items], shortfall, user_data_encoded, standby=True)
+    else:
+        allocations = allocate_instances(weighted_items, shortfall)
+        launch_across_pools(allocations,
+                            lambda item, count: launch_in_pools([item], count, user_data_encoded, standby=True))
+    return shortfall
+
+
+def record_interruption(instance_id, event):
+    """
+    Bookkeeping of an interrupted instance: move its spot request to interrupted in the ledger and upload
+    its details to the interrupt bucket. Runs next to the replacement launch, so it is off the critical path.
+    :param instance_id: ID of the interrupted instance
+    :param event: Spot interruption event
+    """
+    # One describe call gives both the spot request ID and the details uploaded to S3
+    instance_details = describe_instance(instance_id, event.get('region') or region_for_lambda_env)
+    request_id = instance_details.get('SpotInstanceRequestId') if instance_details else None
+
+    # One conditional write; the open-request checker only looks at open requests, so it leaves this one alone
+    if request_id:
+        # Resources are not thread-safe, the pool gives this thread its own Table resource
+        SpotRequestLedger(get_table(LEDGER_TABLE_NAME, Region_DynamoForSpotRequestLedger)).transition(
+            request_id, INTERRUPTED, from_states=(OPEN, SUCCESSFUL, STANDBY), instance_id=instance_id)
+    else:
+        print(f"No spot request ID found for instance {instance_id}.")
 
+    add_instance_id_to_s3(instance_id, s3_client, event, instance_details)
+
+
+def seconds_since(timestamp):
+    """
+    Seconds between an event timestamp (e.g. 2024-01-01T00:00:00Z) and now, or None if it cannot be parsed.
+    """
     try:
-        # Scan the table for the specific region
-        response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr('Region').eq(region)
-        )
-        items = response.get('Items', [])
-        if items:
-            # If there are multiple items, find the highest score
-            highest_score = max(int(item['SPS']) for item in items)
-            # print(f"Found items: {items}")
-            print(f"Highest SPS Score: {highest_score}")
-            return highest_score
-        else:
-            print(f"No matching items found for region: {region} in SpotPlacementScoreTable.")
-            return 0
+        event_time = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+    return (datetime.now(timezone.utc) - event_time).total_seconds()
 
-    except Exception as e:
-        print(f"Error fetching SPS score for region {region}: {e}")
-        return 0
 
+def get_eligible_instance_types():
+    """
+    Return the configured instance types that meet the vCPU and memory requirements.
+    The answer only depends on conf.ini, so it is cached like the score data.
+    """
 
-def fetch_interruption_free_score(region: str) -> int:
+    def load_instance_types():
+        ec2 = get_client('ec2', Region_DynamodbForSpotPrice)
+        return filter_instance_types_by_requirements(ec2, instance_types, min_vcpus, min_memory_gib)
+
+    return score_cache.get('eligible_instance_types', load_instance_types)
+
+
+def get_cached_prices_for_regions(regions):
     """
-    Fetch the Interruption_free_score for a given region from the SpotInterruptionRatioTable.
+    Fetch the price items of the given regions, reusing the warm-container cache when possible.
+    Only eligible instance types are kept and regions without price data are left out.
 
-    :param region: The region to fetch the score.
-    :return: The Interruption_free_score as an integer.
+    :param regions: List of region names
+    :return: Dictionary of region to its list of items sorted by price
     """
-    dynamodb = boto3.resource('dynamodb',
-                              region_name=Region_DynamoDBForStabilityScore)  # Replace with the correct region
-    table = dynamodb.Table('SpotInterruptionRatioTable')
 
-    print(f"Fetching Interruption_free_score for region {region} from SpotInterruptionRatioTable...")
+    eligible_types = get_eligible_instance_types()
 
-    try:
-        # Scan the table for the specific region
-        response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr('Region').eq(region)
-        )
-        items = response.get('Items', [])
-        if items:
-            # Since we assume Region is unique, take the score directly
-            score = int(items[0]['Interruption_free_score'])
-            # print(f"Found item: {items[0]}")
-            print(f"Interruption Free Score: {score}")
-            return score
-        else:
-            print(f"No matching items found for region: {region} in SpotInterruptionRatioTable.")
-            return 0
+    def load_prices():
+        items_by_region = query_prices_for_regions(table, regions, instance_types=eligible_types)
+        return {region: items for region, items in items_by_region.items() if items}
 
-    except Exception as e:
-        print(f"Error fetching Interruption_free_score for region {region}: {e}")
-        return 0
+    return score_cache.get((SPOT_PRICE_TABLE_NAME, tuple(sorted(regions)), tuple(eligible_types)), load_prices)
+
+
+def get_cached_pool_scores():
+    """
+    Fetch the per-AZ SPS and per-region interruption scores used to weight placements,
+    reusing the warm-container cache when possible.
+    """
+
+    def load_pool_scores():
+        pool_scores = fetch_pool_scores(get_table(SPS_TABLE_NAME, Region_DynamoDBForSpotPlacementScore),
+                                        get_table(INTERRUPTION_TABLE_NAME, Region_DynamoDBForStabilityScore))
+        # An empty result is not cached, so a failed read is retried on the next invocation
+        return pool_scores if pool_scores['sps'] or pool_scores['interruption'] else None
+
+    return score_cache.get('pool_scores', load_pool_scores)
 
 
 def evaluate_regions_for_spot_instances(preferred_region_list):
@@ -506,10 +516,13 @@ def evaluate_regions_for_spot_instances(preferred_region_list):
     """
     suitable_regions = []
 
+    # One pass over each score table for all candidate regions
+    total_scores = fetch_region_scores(preferred_region_list, Region_DynamoDBForSpotPlacementScore,
+                                       Region_DynamoDBForStabilityScore,
+                                       instance_types=get_eligible_instance_types(), cache=score_cache)
+
     for region in preferred_region_list:
-        spot_placement_score = fetch_highest_sps_score(region)
-        stability_score = fetch_interruption_free_score(region)
-        total_score = spot_placement_score + stability_score
+        total_score = total_scores[region]
 
         if total_score >= 4:
             print(f"Region {region} is good for spot instances (Total Score: {total_score}).")
@@ -532,30 +545,51 @@ def lambda_handler(event, context):
     :return:
     """
 
+    # The interruption handler and the open-request checker send {"replenish_standby": true} asynchronously
+    if event.get(REPLENISH_EVENT_KEY):
+        requested = replenish_standby_pool()
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f'Requested {requested} standby instances!')
+        }
+
     # Process the event here
     print("Spot interruption event:", event)
-    if instance_id := event.get('detail', {}).get('instance-id'):
-
-        request_id = get_request_id_from_instance(instance_id)
-
-        object_key_check = f'open/{region_for_lambda_env}|{request_id}.txt'
-        exists = check_object_exists_in_s3(s3_client, spot_status_s3_bucket_name, object_key_check)
-
-        if exists:
-            print(f"Object {object_key_check} already exists in {spot_status_s3_bucket_name}")
-            print(f"Deleting {object_key_check} from {spot_status_s3_bucket_name}...")
-            s3_client.delete_object(Bucket=spot_status_s3_bucket_name, Key=object_key_check)
-
-        else:
-            print(f"Object {object_key_check} does not exist in {spot_status_s3_bucket_name}open/")
-
-        aws_credentials = get_aws_credentials_from_file()
-        add_instance_id_to_s3(instance_id, s3_client, event)
-        launch_spot_instance(aws_credentials, target_regions, table)
-    else:
+    if not (instance_id := event.get('detail', {}).get('instance-id')):
         print("Instance-id not found in the event.")
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Spot interruption handled!')
+        }
+
+    # The replacement is claimed from the standby pool or requested first, from cached placement data,
+    # while the bookkeeping of the interrupted instance runs on another thread; the handler waits for both
+    # before returning
+    started = time.perf_counter()
+    launch_latency = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        bookkeeping = executor.submit(record_interruption, instance_id, event)
+        try:
+            if not hand_over_standby(instance_id):
+                launch_spot_instance(target_regions, table)
+            launch_latency = time.perf_counter() - started
+
+            if standby_pool.enabled:
+                # Top the pool up in a separate invocation, off the interruption path
+                try:
+                    request_replenishment(get_client('lambda'), context.function_name)
+                except Exception as e:
+                    print(f"Error requesting a standby pool replenishment: {e}")
+        finally:
+            handler_latency = 'n/a' if launch_latency is None else f"{launch_latency:.3f}"
+            print(f"Replacement launch latency: {handler_latency} s after the event arrived, "
+                  f"{seconds_since(event.get('time'))} s after the interruption warning")
+            try:
+                bookkeeping.result()
+            except Exception as e:
+                print(f"Error recording the interruption of {instance_id}: {e}")
 
     return {
         'statusCode': 200,
-        'body': json.dumps('Spot interruption handled!')
+        'body': json.dumps({'message': 'Spot interruption handled!', 'launch_latency_seconds': launch_latency})
     }
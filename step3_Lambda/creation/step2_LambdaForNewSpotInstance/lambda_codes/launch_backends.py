@@ -0,0 +1,231 @@
+"""
+Spot launch backends
+
+Every launch path asks a backend to start a number of spot instances in one or more capacity pools
+(AZ + instance type) and gets the same LaunchResult back, whichever API was used:
+
+- 'spot-request': the legacy request_spot_instances call in a single AZ, polled until it settles.
+- 'fleet': an instant-type CreateFleet call that takes every pool as an override and lets EC2 pick
+  them with the configured allocation strategy. The instances are returned by the call itself, so
+  there is nothing to poll and no open request is left behind.
+
+The same file is shipped with the launcher and with every Lambda that launches spot instances.
+"""
+
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import botocore
+
+from spot_request_tracker import SpotRequestTracker
+
+SPOT_REQUEST_BACKEND = 'spot-request'
+FLEET_BACKEND = 'fleet'
+
+FLEET_ALLOCATION_STRATEGIES = ('price-capacity-optimized', 'capacity-optimized', 'lowest-price', 'diversified')
+
+# describe_instances can miss instances for a moment right after CreateFleet returns them
+DESCRIBE_INSTANCES_ATTEMPTS = 5
+
+
+@dataclass
+class LaunchResult:
+    """
+    Outcome of one launch call.
+    """
+    active: Dict[str, str] = field(default_factory=dict)  # spot request ID (or instance ID) -> instance ID
+    open_request_ids: List[str] = field(default_factory=list)
+    failed_request_ids: List[str] = field(default_factory=list)
+    unfulfilled: int = 0  # Instances that were asked for but got neither an instance nor an open request
+
+    @property
+    def n_active(self):
+        return len(self.active)
+
+    @property
+    def n_open(self):
+        return len(self.open_request_ids)
+
+    @property
+    def n_failed(self):
+        return len(self.failed_request_ids) + self.unfulfilled
+
+
+class SpotRequestBackend:
+    """
+    Legacy backend: one request_spot_instances call in the first pool, then poll until it settles.
+    """
+    name = SPOT_REQUEST_BACKEND
+    multi_pool = False  # Only the first pool of a launch is used
+
+    def __init__(self, max_price, settle_timeout):
+        """
+        :param max_price: Maximum spot price (the on-demand price)
+        :param settle_timeout: Maximum time in seconds to wait for the requests to settle
+        """
+        self.max_price = max_price
+        self.settle_timeout = settle_timeout
+
+    def launch(self, ec2_client, pools, count, launch_spec):
+        """
+        :param ec2_client: EC2 client of the region of the pools
+        :param pools: List of spot price items (availability_zone and instance_type)
+        :param count: Number of instances to launch
+        :param launch_spec: Dictionary with ImageId, KeyName, SecurityGroupIds and base64 encoded UserData
+        :return: LaunchResult
+        """
+        pool = pools[0]
+        response = ec2_client.request_spot_instances(
+            SpotPrice=str(self.max_price),
+            InstanceCount=count,
+            Type="one-time",
+            LaunchSpecification={
+                **launch_spec,
+                "InstanceType": pool['instance_type'],
+                "Placement": {
+                    "AvailabilityZone": pool['availability_zone']
+                },
+            }
+        )
+        request_ids = [request['SpotInstanceRequestId'] for request in response['SpotInstanceRequests']]
+
+        # Poll with backoff until every request is active, failed, or open after evaluation
+        print(f"Waiting up to {self.settle_timeout} seconds for {len(request_ids)} spot requests to settle...")
+        tracker = SpotRequestTracker(ec2_client)
+        tracker.on('active', lambda request: print(f"Spot request {request['SpotInstanceRequestId']} is active."))
+        requests = tracker.wait(request_ids, timeout=self.settle_timeout)
+
+        result = LaunchResult()
+        for request_id in request_ids:
+            request = requests.get(request_id, {})
+            state = request.get('State')
+            if state == 'active':
+                result.active[request_id] = request.get('InstanceId')
+            elif state == 'open':
+                result.open_request_ids.append(request_id)
+            else:
+                result.failed_request_ids.append(request_id)
+        return result
+
+
+class InstantFleetBackend:
+    """
+    CreateFleet backend: one instant fleet with every pool as an override.
+    """
+    name = FLEET_BACKEND
+    multi_pool = True
+
+    def __init__(self, max_price, allocation_strategy='price-capacity-optimized'):
+        """
+        :param max_price: Maximum spot price (the on-demand price)
+        :param allocation_strategy: Spot allocation strategy of the fleet
+        """
+        if allocation_strategy not in FLEET_ALLOCATION_STRATEGIES:
+            raise ValueError(f"Unknown fleet allocation strategy: {allocation_strategy}")
+        self.max_price = max_price
+        self.allocation_strategy = allocation_strategy
+
+    def launch(self, ec2_client, pools, count, launch_spec):
+        """
+        :param ec2_client: EC2 client of the region of the pools
+        :param pools: List of spot price items (availability_zone and instance_type)
+        :param count: Number of instances to launch
+        :param launch_spec: Dictionary with ImageId, KeyName, SecurityGroupIds and base64 encoded UserData
+        :return: LaunchResult
+        """
+        # CreateFleet only takes launch templates; this one only lives for the duration of the call
+        template_id = ec2_client.create_launch_template(
+            LaunchTemplateName=f"spotverse-{uuid.uuid4()}",
+            LaunchTemplateData=launch_spec
+        )['LaunchTemplate']['LaunchTemplateId']
+
+        try:
+            response = ec2_client.create_fleet(
+                Type='instant',
+                TargetCapacitySpecification={
+                    'TotalTargetCapacity': count,
+                    'DefaultTargetCapacityType': 'spot',
+                },
+                SpotOptions={
+                    'AllocationStrategy': self.allocation_strategy,
+                    'InstanceInterruptionBehavior': 'terminate',
+                },
+                LaunchTemplateConfigs=[{
+                    'LaunchTemplateSpecification': {'LaunchTemplateId': template_id, 'Version': '$Latest'},
+                    'Overrides': [
+                        {
+                            'InstanceType': pool['instance_type'],
+                            'AvailabilityZone': pool['availability_zone'],
+                            'MaxPrice': str(self.max_price),
+                        }
+                        for pool in pools
+                    ],
+                }],
+            )
+        finally:
+            # The fleet may already have launched instances, which must still be returned and recorded
+            try:
+                ec2_client.delete_launch_template(LaunchTemplateId=template_id)
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                print(f"Failed to delete launch template {template_id}: {e}")
+
+        for error in response.get('Errors', []):
+            print(f"Fleet error in {error.get('LaunchTemplateAndOverrides', {}).get('Overrides', {})}: "
+                  f"{error.get('ErrorCode')} {error.get('ErrorMessage')}")
+
+        instance_ids = [instance_id for instances in response.get('Instances', [])
+                        for instance_id in instances.get('InstanceIds', [])]
+        print(f"Fleet launched {len(instance_ids)} of {count} instances: {instance_ids}")
+
+        # Fulfilment is counted from the instances CreateFleet returned, not from the lookup below
+        result = LaunchResult(unfulfilled=count - len(instance_ids))
+        if instance_ids:
+            result.active = self.spot_request_ids(ec2_client, instance_ids)
+        return result
+
+    @staticmethod
+    def spot_request_ids(ec2_client, instance_ids):
+        """
+        Look up the spot request ID of every instance, the bookkeeping is keyed by request ID.
+        An instance whose request ID cannot be resolved is kept under its instance ID, so every instance the fleet
+        launched is counted as active.
+        :return: Dictionary of spot request ID (or instance ID) to instance ID, one entry per instance
+        """
+        request_ids = {}
+        for attempt in range(DESCRIBE_INSTANCES_ATTEMPTS):
+            try:
+                response = ec2_client.describe_instances(InstanceIds=instance_ids)
+                request_ids = {
+                    instance['InstanceId']: instance['SpotInstanceRequestId']
+                    for reservation in response['Reservations']
+                    for instance in reservation['Instances']
+                    if 'SpotInstanceRequestId' in instance
+                }
+                break
+            except botocore.exceptions.ClientError as e:
+                if "InvalidInstanceID.NotFound" not in str(e):
+                    raise e
+                time.sleep(2 ** attempt)
+
+        unresolved = [instance_id for instance_id in instance_ids if instance_id not in request_ids]
+        if unresolved:
+            print(f"Could not look up the spot request IDs of {unresolved}, recording them by instance ID.")
+        return {request_ids.get(instance_id, instance_id): instance_id for instance_id in instance_ids}
+
+
+def get_launch_backend(name, max_price, settle_timeout, allocation_strategy='price-capacity-optimized'):
+    """
+    Build the launch backend configured in conf.ini.
+    :param name: 'spot-request' or 'fleet'
+    :param max_price: Maximum spot price (the on-demand price)
+    :param settle_timeout: Maximum time in seconds the legacy backend waits for requests to settle
+    :param allocation_strategy: Spot allocation strategy of the fleet backend
+    :return: Launch backend
+    """
+    if name == FLEET_BACKEND:
+        return InstantFleetBackend(max_price, allocation_strategy)
+    if name == SPOT_REQUEST_BACKEND:
+        return SpotRequestBackend(max_price, settle_timeout)
+    raise ValueError(f"Unknown launch backend: {name}")
@@ -0,0 +1,146 @@
+"""
+Diversified spot placement
+
+Spreads a launch over the N cheapest capacity pools (AZ + instance type) instead of sending the
+whole request to the cheapest AZ. Every pool gets a share proportional to its weight, which combines
+its price with its spot placement score and interruption-free score, and the per-pool requests are
+issued at the same time. A single interruption wave then only hits part of the fleet.
+
+The same file is shipped with the launcher and with every Lambda that launches spot instances.
+"""
+
+import concurrent.futures
+import random
+
+from region_scores import scan_all_items
+
+# Number of pools a launch is spread over unless configured otherwise
+DEFAULT_SPREAD = 3
+
+# Highest possible SPS and interruption-free score, used to scale both to [0, 1]
+MAX_SPS_SCORE = 10
+MAX_INTERRUPTION_FREE_SCORE = 3
+
+# Score used for a pool that has not been scored yet, so it is neither preferred nor excluded
+NEUTRAL_SCORE = 0.5
+
+
+def fetch_pool_scores(sps_table, interruption_table):
+    """
+    Read the per-pool scores used to weight placements.
+    :param sps_table: DynamoDB Table resource of SpotPlacementScoreTable
+    :param interruption_table: DynamoDB Table resource of SpotInterruptionRatioTable
+    :return: Dictionary with 'sps' ((availability_zone, instance type) -> SPS) and
+             'interruption' ((region, instance type) -> Interruption_free_score)
+    """
+    pool_scores = {'sps': {}, 'interruption': {}}
+    try:
+        for item in scan_all_items(sps_table, ['availability_zone', 'InstanceType', 'SPS']):
+            pool_scores['sps'][(item.get('availability_zone'), item.get('InstanceType'))] = int(item['SPS'])
+
+        for item in scan_all_items(interruption_table, ['Region', 'InstanceType', 'Interruption_free_score']):
+            key = (item['Region'], item.get('InstanceType'))
+            pool_scores['interruption'][key] = float(item['Interruption_free_score'])
+    except Exception as e:
+        print(f"Error fetching pool scores, placements are weighted by price only: {e}")
+
+    return pool_scores
+
+
+def pool_score(scores, key, max_score):
+    """
+    Scale a pool's score to [0, 1]. Rows written before scores were stored per instance type are
+    looked up without the instance type.
+    """
+    score = scores.get(key, scores.get((key[0], None)))
+    return NEUTRAL_SCORE if score is None else min(float(score) / max_score, 1.0)
+
+
+def placement_weights(items, pool_scores=None, spread=DEFAULT_SPREAD):
+    """
+    Pick the cheapest pools and weight them.
+
+    The weight of a pool is (cheapest price / pool price) * scaled SPS * scaled interruption-free score,
+    so a slightly more expensive pool with better capacity can still get the larger share.
+
+    :param items: Spot price items (availability_zone, region, price and optionally instance_type)
+    :param pool_scores: Result of fetch_pool_scores, None weights by price only
+    :param spread: Number of cheapest pools to spread over
+    :return: List of (item, weight) tuples, cheapest pool first
+    """
+    candidates = sorted(items, key=lambda x: float(x['price']))[:max(spread, 1)]
+    if not candidates:
+        return []
+
+    pool_scores = pool_scores or {'sps': {}, 'interruption': {}}
+    cheapest_price = max(float(candidates[0]['price']), 1e-6)
+
+    weighted = []
+    for item in candidates:
+        instance_type = item.get('instance_type')
+        price_weight = cheapest_price / max(float(item['price']), 1e-6)
+        sps_weight = pool_score(pool_scores['sps'], (item['availability_zone'], instance_type), MAX_SPS_SCORE)
+        interruption_weight = pool_score(pool_scores['interruption'], (item['region'], instance_type),
+                                         MAX_INTERRUPTION_FREE_SCORE)
+        weighted.append((item, price_weight * sps_weight * interruption_weight))
+
+    return weighted
+
+
+def allocate_instances(weighted_items, count):
+    """
+    Split a number of instances over weighted pools.
+
+    Every pool gets the whole part of its proportional share. The instances that are left are drawn
+    by weight, so single-instance launches (replacements) are spread over the pools too.
+
+    :param weighted_items: List of (item, weight) tuples from placement_weights
+    :param count: Number of instances to place
+    :return: List of (item, number of instances) tuples, pools without instances are left out
+    """
+    if count <= 0 or not weighted_items:
+        return []
+
+    total_weight = sum(weight for _, weight in weighted_items)
+    if total_weight <= 0:
+        # No pool has a usable weight, fall back to an even split
+        weighted_items = [(item, 1.0) for item, _ in weighted_items]
+        total_weight = float(len(weighted_items))
+
+    shares = [count * weight / total_weight for _, weight in weighted_items]
+    allocated = [int(share) for share in shares]
+
+    # Draw the remaining instances without replacement, by weight
+    remaining_indexes = list(range(len(weighted_items)))
+    for _ in range(count - sum(allocated)):
+        index = random.choices(remaining_indexes, weights=[weighted_items[i][1] or 1e-9 for i in remaining_indexes])[0]
+        allocated[index] += 1
+        remaining_indexes.remove(index)
+
+    return [(item, n) for (item, _), n in zip(weighted_items, allocated) if n > 0]
+
+
+def launch_across_pools(allocations, launch_fn):
+    """
+    Issue the request of every pool at the same time.
+    :param allocations: List of (item, number of instances) tuples from allocate_instances
+    :param launch_fn: Function (item, number of instances) -> result, called once per pool
+    :return: List of (item, number of instances, result) tuples; result is the raised exception
+             when the pool failed
+    """
+    if not allocations:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(allocations)) as executor:
+        futures = {executor.submit(launch_fn, item, n): (item, n) for item, n in allocations}
+
+        results = []
+        for future in concurrent.futures.as_completed(futures):
+            item, n = futures[future]
+            try:
+                results.append((item, n, future.result()))
+            except Exception as e:
+                print(f"Launch in {item['availability_zone']} failed: {e}")
+                results.append((item, n, e))
+
+    return results
@@ -0,0 +1,125 @@
+"""
+Region scoring
+
+Reads the SPS and interruption-free scores of every region in one paginated pass per table,
+instead of one filtered Scan per region and per table. DynamoDB resources come from the shared client
+pool, so they are created once per container and reused by warm invocations.
+
+The same file is shipped with the launcher and with every Lambda that evaluates regions or places
+instances (placement_engine.py scans its tables with scan_all_items).
+"""
+
+from client_pool import get_table
+
+SPS_TABLE_NAME = 'SpotPlacementScoreTable'
+INTERRUPTION_TABLE_NAME = 'SpotInterruptionRatioTable'
+
+
+def scan_all_items(table, attributes):
+    """
+    Scan a whole table, following LastEvaluatedKey, and return only the requested attributes.
+    :param table: DynamoDB Table resource
+    :param attributes: List of attribute names to project
+    :return: List of items
+    """
+    # 'Region' is a DynamoDB reserved word, so every attribute goes through a placeholder
+    names = {f"#a{i}": attribute for i, attribute in enumerate(attributes)}
+    scan_kwargs = {
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names,
+    }
+
+    items = []
+    while True:
+        response = table.scan(**scan_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def is_wanted(item, regions, instance_types):
+    """
+    Check if a score item belongs to one of the given regions and instance types.
+    Items written before scores were stored per instance type have no InstanceType and are always kept.
+    """
+    if regions is not None and item['Region'] not in regions:
+        return False
+    return instance_types is None or item.get('InstanceType', instance_types[0]) in instance_types
+
+
+def fetch_all_sps_scores(region_name, regions=None, instance_types=None) -> dict:
+    """
+    Fetch the highest SPS score of every region from the SpotPlacementScoreTable.
+
+    :param region_name: Region of the SpotPlacementScoreTable
+    :param regions: Optional list of regions to keep (None keeps every region)
+    :param instance_types: Optional list of instance types to consider (None considers every type)
+    :return: A dictionary with regions as keys and the highest SPS score as values.
+    """
+    sps_scores = {}
+    try:
+        for item in scan_all_items(get_table(SPS_TABLE_NAME, region_name), ['Region', 'SPS', 'InstanceType']):
+            region = item['Region']
+            if is_wanted(item, regions, instance_types):
+                sps_scores[region] = max(sps_scores.get(region, 0), int(item['SPS']))
+    except Exception as e:
+        print(f"Error fetching SPS scores: {e}")
+
+    print(f"Fetched SPS scores: {sps_scores}")
+    return sps_scores
+
+
+def fetch_all_interruption_free_scores(region_name, regions=None, instance_types=None) -> dict:
+    """
+    Fetch the highest Interruption_free_score of every region from the SpotInterruptionRatioTable.
+
+    :param region_name: Region of the SpotInterruptionRatioTable
+    :param regions: Optional list of regions to keep (None keeps every region)
+    :param instance_types: Optional list of instance types to consider (None considers every type)
+    :return: A dictionary with regions as keys and the Interruption_free_score as values.
+    """
+    interruption_scores = {}
+    try:
+        items = scan_all_items(get_table(INTERRUPTION_TABLE_NAME, region_name),
+                               ['Region', 'Interruption_free_score', 'InstanceType'])
+        for item in items:
+            region = item['Region']
+            if is_wanted(item, regions, instance_types):
+                # One row per instance type, a region scores as well as its best instance type
+                score = int(item['Interruption_free_score'])
+                interruption_scores[region] = max(interruption_scores.get(region, 0), score)
+    except Exception as e:
+        print(f"Error fetching Interruption Free Scores: {e}")
+
+    print(f"Fetched Interruption Free Scores: {interruption_scores}")
+    return interruption_scores
+
+
+def fetch_region_scores(regions, region_for_sps, region_for_interruption, instance_types=None, cache=None) -> dict:
+    """
+    Fetch the total score (SPS + interruption-free score) of every candidate region.
+
+    :param regions: List of candidate regions
+    :param region_for_sps: Region of the SpotPlacementScoreTable
+    :param region_for_interruption: Region of the SpotInterruptionRatioTable
+    :param instance_types: Optional list of instance types to consider (None considers every type)
+    :param cache: Optional TTLCache; warm invocations then skip DynamoDB until the entries expire
+    :return: A dictionary with regions as keys and their total score as values.
+    """
+    regions_key = tuple(sorted(regions))
+    types_key = tuple(sorted(instance_types)) if instance_types else None
+
+    def load_sps_scores():
+        return fetch_all_sps_scores(region_for_sps, regions, instance_types)
+
+    def load_interruption_scores():
+        return fetch_all_interruption_free_scores(region_for_interruption, regions, instance_types)
+
+    if cache is None:
+        sps_scores = load_sps_scores()
+        interruption_scores = load_interruption_scores()
+    else:
+        sps_scores = cache.get((SPS_TABLE_NAME, regions_key, types_key), load_sps_scores)
+        interruption_scores = cache.get((INTERRUPTION_TABLE_NAME, regions_key, types_key), load_interruption_scores)
+    return {region: sps_scores.get(region, 0) + interruption_scores.get(region, 0) for region in regions}
@@ -0,0 +1,92 @@
+"""
+Spot price data access
+
+Reads SpotPriceCostTable through its RegionPriceIndex (region -> price) instead of scanning the
+whole table. A region's AZs come back already sorted by price, and every read follows
+LastEvaluatedKey so results are never cut off at 1MB. Rows are stored per AZ and instance type, so
+readers can pick the cheapest type/AZ pair among the instance types that meet their requirements.
+
+The same file is shipped with the launcher and with every Lambda that reads spot prices.
+"""
+
+from boto3.dynamodb.conditions import Attr, Key
+
+SPOT_PRICE_TABLE_NAME = 'SpotPriceCostTable'
+REGION_PRICE_INDEX_NAME = 'RegionPriceIndex'
+
+
+def query_region_prices(table, region, limit=None, instance_types=None):
+    """
+    Fetch the AZ/instance type price items of a region, cheapest first.
+    :param table: DynamoDB Table resource of SpotPriceCostTable
+    :param region: Region name (e.g. us-east-1)
+    :param limit: Maximum number of items to return (None returns all of them)
+    :param instance_types: Optional list of instance types to keep (None keeps every type)
+    :return: List of items sorted by price in ascending order
+    """
+    items = []
+    query_kwargs = {
+        'IndexName': REGION_PRICE_INDEX_NAME,
+        'KeyConditionExpression': Key('region').eq(region),
+        'ScanIndexForward': True,
+    }
+    if limit:
+        query_kwargs['Limit'] = limit
+    if instance_types:
+        query_kwargs['FilterExpression'] = Attr('instance_type').is_in(list(instance_types))
+
+    while True:
+        response = table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if not last_evaluated_key or (limit and len(items) >= limit):
+            break
+        query_kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+    return items[:limit] if limit else items
+
+
+def query_prices_for_regions(table, regions, limit=None, instance_types=None):
+    """
+    Fetch the AZ/instance type price items of several regions, cheapest first within each region.
+    :param table: DynamoDB Table resource of SpotPriceCostTable
+    :param regions: List of region names
+    :param limit: Maximum number of items to return per region (None returns all of them)
+    :param instance_types: Optional list of instance types to keep (None keeps every type)
+    :return: Dictionary of region to its list of items sorted by price
+    """
+    return {region: query_region_prices(table, region, limit, instance_types) for region in regions}
+
+
+def cheapest_items(items_by_region):
+    """
+    Merge per-region price items into one list sorted by price.
+    :param items_by_region: Dictionary of region to list of items
+    :return: List of items sorted by price in ascending order
+    """
+    items = [item for region_items in items_by_region.values() for item in region_items]
+    return sorted(items, key=lambda x: float(x['price']))
+
+
+def filter_instance_types_by_requirements(ec2_client, instance_types, min_vcpus=0, min_memory_gib=0):
+    """
+    Keep the instance types that have at least the requested vCPUs and memory.
+    All instance types are described in a single call.
+    :param ec2_client: EC2 client of any region (instance type specs are the same everywhere)
+    :param instance_types: List of candidate instance types
+    :param min_vcpus: Minimum number of vCPUs (0 means no requirement)
+    :param min_memory_gib: Minimum memory in GiB (0 means no requirement)
+    :return: List of instance types that satisfy the requirement, in the given order
+    """
+    if not min_vcpus and not min_memory_gib:
+        return list(instance_types)
+
+    response = ec2_client.describe_instance_types(InstanceTypes=list(instance_types))
+    eligible = {
+        info['InstanceType']
+        for info in response['InstanceTypes']
+        if info['VCpuInfo']['DefaultVCpus'] >= min_vcpus and info['MemoryInfo']['SizeInMiB'] >= min_memory_gib * 1024
+    }
+    print(f"Instance types with at least {min_vcpus} vCPUs and {min_memory_gib} GiB: {sorted(eligible)}")
+    return [instance_type for instance_type in instance_types if instance_type in eligible]
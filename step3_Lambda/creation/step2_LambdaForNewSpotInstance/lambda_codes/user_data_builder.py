@@ -0,0 +1,210 @@
+"""
+User-data builder
+
+Builds the user data of every spot instance from one template, shared by the launcher and the Lambdas:
+
+- preamble: exports the credentials and sends the output to /var/log/user-data.log;
+- before_workload: an optional snippet, e.g. the standby-pool wait;
+- workload phase: one of WORKLOAD_PHASES (sleep, galaxy or checkpoint), new ones are added with @workload_phase;
+- completion phase: completion_reporter.py reports the instance and terminates it.
+
+The Python modules a script needs are written to MODULE_DIR by a cloud-config part, and the whole MIME multipart
+message is gzipped, which cloud-init unpacks. That keeps even the checkpoint workload, which ships three modules,
+under the 16 KB user-data limit.
+
+A UserDataConfig is hashable, and render_user_data caches the encoded user data per config, so it is built once
+per process instead of on every spot request.
+"""
+
+import base64
+import functools
+import gzip
+import textwrap
+from dataclasses import dataclass
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from pathlib import Path
+from typing import Tuple
+
+MODULE_DIR = '/opt/spotverse'
+USER_DATA_LIMIT = 16 * 1024
+
+# Exit code of a work-queue worker stopped by the checkpoint agent (STOPPED_EXIT_CODE of work_queue.py)
+WORKER_STOPPED_EXIT_CODE = 143
+
+# Workload name -> (function rendering the bash of the phase, modules it needs on the instance)
+WORKLOAD_PHASES = {}
+
+
+@dataclass(frozen=True)
+class UserDataConfig:
+    """
+    Everything the user data depends on; equal configs render the same user data.
+    """
+    aws_access_key_id: str
+    aws_secret_access_key: str
+    complete_bucket_name: str
+    workload: str = 'sleep'
+    workload_options: Tuple[Tuple[str, object], ...] = ()
+    ledger_region: str = ''
+    before_workload: str = ''
+
+    @property
+    def options(self):
+        return dict(self.workload_options)
+
+
+def user_data_config(aws_credentials, complete_bucket_name, workload='sleep', ledger_region='', before_workload='',
+                     **workload_options):
+    """
+    :param aws_credentials: Dictionary with AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+    :param complete_bucket_name: Bucket the completion records are written to
+    :param workload: Name of a registered workload phase
+    :param ledger_region: Region of SpotRequestLedgerTable, if the spot requests are tracked in the ledger
+    :param before_workload: Bash run before the workload
+    :param workload_options: Options of the workload phase
+    :return: UserDataConfig
+    """
+    if workload not in WORKLOAD_PHASES:
+        raise ValueError(f"Unknown workload '{workload}', expected one of {sorted(WORKLOAD_PHASES)}")
+    return UserDataConfig(aws_credentials['AWS_ACCESS_KEY_ID'], aws_credentials['AWS_SECRET_ACCESS_KEY'],
+                          complete_bucket_name, workload, tuple(sorted(workload_options.items())), ledger_region,
+                          before_workload)
+
+
+def workload_phase(name, modules=()):
+    """
+    Register a function that renders the bash of a workload from the workload options.
+    :param name: Workload name
+    :param modules: Modules, next to this file, the workload needs on the instance
+    """
+    def register(render):
+        WORKLOAD_PHASES[name] = (render, tuple(modules))
+        return render
+    return register
+
+
+@workload_phase('sleep')
+def sleep_phase(sleep_time):
+    return f"""
+        # Placeholder workload, replace it with the actual one
+        echo "Sleeping for {sleep_time} seconds..."
+        sleep {sleep_time}
+    """
+
+
+def _galaxy_server():
+    return """
+        # Set the HOME environment variable
+        export HOME=/home/ec2-user
+        git config --global --add safe.directory /home/ec2-user/galaxy
+
+        # Run the Galaxy server in the background
+        GALAXY_LOG="/var/log/galaxy-server.log"
+        sh $HOME/galaxy/run.sh > $GALAXY_LOG 2>&1 &
+        echo "Running the Galaxy server in the background... Output is being logged to $GALAXY_LOG"
+
+        echo "Sleeping for 5 minutes to allow the server to start..."
+        sleep 300
+    """
+
+
+@workload_phase('galaxy')
+def galaxy_phase(batch_command='./run_all_batches.sh'):
+    return _galaxy_server() + f"""
+        cd /home/ec2-user/ngs_analysis || exit
+        {batch_command}
+    """
+
+
+@workload_phase('checkpoint', modules=('work_queue.py', 'checkpoint_agent.py'))
+def checkpoint_phase(region, lease_seconds, batch_command, checkpoint_bucket, output_dir, flush_interval,
+                     max_attempts=3, retry_backoff_seconds=60):
+    return _galaxy_server() + f"""
+        cd /home/ec2-user/ngs_analysis || exit
+
+        # Resume orphaned batches and take pending ones from the work queue
+        export WORK_QUEUE_REGION={region}
+        python3 {MODULE_DIR}/work_queue.py --region {region} --lease-seconds {lease_seconds} \\
+          --max-attempts {max_attempts} --retry-backoff-seconds {retry_backoff_seconds} run \\
+          --worker-id "$(ec2-metadata -i | cut -d " " -f 2)" --command "{batch_command}" &
+        WORKER_PID=$!
+
+        # Flush the running batch to S3 and hand it back when the interruption notice arrives
+        python3 {MODULE_DIR}/checkpoint_agent.py watch --region {region} --bucket {checkpoint_bucket} \\
+          --worker-pid $WORKER_PID --output-dir "{output_dir}" --flush-interval {flush_interval} \\
+          > /var/log/checkpoint_agent.log 2>&1 &
+
+        wait $WORKER_PID
+        if [ $? -eq {WORKER_STOPPED_EXIT_CODE} ]; then
+            echo "Stopped by the interruption notice, the batch was handed back to the work queue."
+            exit 0
+        fi
+    """
+
+
+def render_script(config):
+    """
+    :return: The bash script of the user data
+    """
+    render_workload, _ = WORKLOAD_PHASES[config.workload]
+    ledger_option = f" --ledger-region {config.ledger_region}" if config.ledger_region else ''
+    phases = [
+        f"""
+        export AWS_ACCESS_KEY_ID="{config.aws_access_key_id}"
+        export AWS_SECRET_ACCESS_KEY="{config.aws_secret_access_key}"
+
+        # Send all output to the log file
+        echo "Starting script" >/var/log/user-data.log
+        exec > >(tee -a /var/log/user-data.log) 2>&1
+
+        python3 -c "import boto3" 2>/dev/null || pip3 install --quiet boto3
+        """,
+        config.before_workload,
+        render_workload(**config.options),
+        f"""
+        # Report the completion and terminate the instance
+        python3 {MODULE_DIR}/completion_reporter.py --complete-bucket {config.complete_bucket_name}{ledger_option}
+        """,
+    ]
+    return '#!/bin/bash\n' + '\n\n'.join(textwrap.dedent(phase).strip('\n') for phase in phases if phase) + '\n'
+
+
+def required_modules(config):
+    _, modules = WORKLOAD_PHASES[config.workload]
+    modules = ('completion_reporter.py',) + modules
+    if config.ledger_region:
+        modules += ('spot_request_ledger.py',)
+    return modules
+
+
+def render_cloud_config(modules):
+    """
+    :return: cloud-config that writes the modules to MODULE_DIR
+    """
+    lines = ['#cloud-config', 'write_files:']
+    for module in modules:
+        source = (Path(__file__).parent / module).read_text()
+        lines += [f"  - path: {MODULE_DIR}/{module}", "    permissions: '0644'", '    content: |',
+                  textwrap.indent(source, ' ' * 6).rstrip('\n')]
+    return '\n'.join(lines) + '\n'
+
+
+@functools.lru_cache(maxsize=8)
+def render_user_data(config):
+    """
+    Build the user data of a config: a gzipped MIME multipart message with the modules and the script.
+    :return: Base64 encoded user data
+    """
+    message = MIMEMultipart()
+    for content, subtype, filename in [(render_cloud_config(required_modules(config)), 'cloud-config', 'modules.cfg'),
+                                       (render_script(config), 'x-shellscript', 'user-data.sh')]:
+        part = MIMEText(content, subtype)
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        message.attach(part)
+
+    user_data = gzip.compress(message.as_bytes())
+    if len(user_data) > USER_DATA_LIMIT:
+        raise ValueError(f"User data is {len(user_data)} bytes after compression, over the {USER_DATA_LIMIT} limit")
+    print(f"Rendered {config.workload} user data: {len(user_data)} bytes")
+    return base64.b64encode(user_data).decode()
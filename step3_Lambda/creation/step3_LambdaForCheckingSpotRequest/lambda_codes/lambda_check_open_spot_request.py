@@ -1,11 +1,16 @@
-import base64
+import concurrent.futures
 import configparser
 import re
-import time
-from decimal import Decimal
 
-import boto3
-from boto3.dynamodb.conditions import Attr
+from client_pool import get_client, get_table, report_throttles
+from launch_backends import SPOT_REQUEST_BACKEND, get_launch_backend
+from region_scores import fetch_region_scores
+from spot_price_store import SPOT_PRICE_TABLE_NAME, cheapest_items, filter_instance_types_by_requirements, \
+    query_prices_for_regions
+from spot_request_ledger import COMPLETED, FAILED, LEDGER_TABLE_NAME, OPEN, SUCCESSFUL, SpotRequestLedger
+from standby_pool import request_replenishment
+from ttl_cache import TTLCache
+from user_data_builder import render_user_data, user_data_config
 
 # Initialize the parser and read the ini file
 config = configparser.ConfigParser()
@@ -19,28 +24,61 @@ interrupt_s3_bucket_name = config.get('settings', 'interrupt_s3_bucket_name')
 sleep_time = int(config.get('settings', 'sleep_time'))
 # factor = Decimal(config.getfloat('settings', 'spot_price_factor'))
 instance_type = config.get('settings', 'instance_type')
+# Candidate instance types, the cheapest AZ/type pair that meets the requirements is launched
+instance_types = [t.strip() for t in config.get('settings', 'instance_types', fallback=instance_type).split(',')]
+min_vcpus = config.getint('settings', 'min_vcpus', fallback=0)
+min_memory_gib = config.getfloat('settings', 'min_memory_gib', fallback=0)
 key_name = config.get('settings', 'key_name')
 spot_tracking_s3_bucket_name = config.get('settings', 'spot_tracking_s3_bucket_name')
 Region_DynamodbForSpotPrice = config.get('settings', 'Region_DynamodbForSpotPrice')
+Region_DynamoForSpotRequestLedger = config.get('settings', 'Region_DynamoForSpotRequestLedger',
+                                               fallback=Region_DynamodbForSpotPrice)
 on_demand_price = float(config.get('settings', 'on_demand_price'))
+launch_backend = get_launch_backend(config.get('settings', 'launch_backend', fallback=SPOT_REQUEST_BACKEND),
+                                    on_demand_price, SLEEP_TIME_SPOT_REQUEST,
+                                    config.get('settings', 'fleet_allocation_strategy',
+                                               fallback='price-capacity-optimized'))
 Region_DynamoDBForSpotPlacementScore = config.get('settings', 'Region_DynamoForSpotPlacementScore')
 Region_DynamoDBForStabilityScore = config.get('settings', 'Region_DynamoForSpotInterruptionRatio')
+# The updater Lambdas refresh the score and price tables at the top of every hour (step5_CloudWatch); cached
+# reads expire once they are done (SCORE_REFRESH_LAG seconds past the hour), or after SCORE_CACHE_TTL seconds
+SCORE_CACHE_TTL = config.getint('settings', 'score_cache_ttl', fallback=3600)
+SCORE_REFRESH_PERIOD = 3600
+SCORE_REFRESH_LAG = config.getint('settings', 'score_refresh_lag', fallback=300)
+# Every run tops the warm-standby pool up through the new-instance Lambda, when the pool is enabled
+standby_pool_max_size = config.getint('settings', 'standby_pool_max_size', fallback=0)
+Region_LambdaForNewSpotInstance = config.get('settings', 'Region_LambdaForNewSpotInstance', fallback=target_regions[0])
 
 print(f"Target_regions: {target_regions}")
 # print(f"Factor from conf.ini: {factor}")
 print(f"sleep_time: {sleep_time}")
 print(f"instance_type: {instance_type}")
+print(f"instance_types: {instance_types} (min vCPUs: {min_vcpus}, min memory: {min_memory_gib} GiB)")
 print(f"key_name: {key_name}")
 print(f"complete_bucket_name: {complete_bucket_name}")
 print(f"interrupt_bucket_name: {interrupt_s3_bucket_name}")
 print("SLEEP_TIME_SPOT_REQUEST: ", SLEEP_TIME_SPOT_REQUEST)
 print(f"spot_status_bucket_name: {spot_tracking_s3_bucket_name}")
 print(f"Region_DynamodbForSpotPrice: {Region_DynamodbForSpotPrice}")
+print(f"Region_DynamoForSpotRequestLedger: {Region_DynamoForSpotRequestLedger}")
 print(f"on_demand_price: {on_demand_price}")
+print(f"SCORE_CACHE_TTL: {SCORE_CACHE_TTL}")
+print(f"SCORE_REFRESH_LAG: {SCORE_REFRESH_LAG}")
+print(f"launch_backend: {launch_backend.name}")
 
-s3_client = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb', region_name=Region_DynamodbForSpotPrice)
-table = dynamodb.Table('SpotPriceCostTable')
+# Clients and resources come from the shared pool and survive between invocations of a warm container
+s3_client = get_client('s3')
+table = get_table(SPOT_PRICE_TABLE_NAME, Region_DynamodbForSpotPrice)
+ledger = SpotRequestLedger(get_table(LEDGER_TABLE_NAME, Region_DynamoForSpotRequestLedger))
+# Survives between invocations of a warm container
+score_cache = TTLCache(SCORE_CACHE_TTL, SCORE_REFRESH_PERIOD, SCORE_REFRESH_LAG)
+
+# Spot request IDs per describe call, and upper bound of regions checked at the same time
+DESCRIBE_BATCH_SIZE = 100
+MAX_REGION_WORKERS = 8
+
+# Status code of a spot request closed because its instance terminated itself after reporting its completion
+INSTANCE_TERMINATED_BY_USER = 'instance-terminated-by-user'
 
 
 def extract_value(pattern, content):
@@ -70,260 +108,63 @@ def get_values_from_file(filename):
 
 
 def generate_user_data_script(aws_credentials, sleep_time, complete_bucket_name):
-    script = f"""#!/bin/bash
-
-                # Exporting AWS credentials for use in subsequent AWS CLI commands
-                export AWS_ACCESS_KEY_ID="{aws_credentials['AWS_ACCESS_KEY_ID']}"
-                export AWS_SECRET_ACCESS_KEY="{aws_credentials['AWS_SECRET_ACCESS_KEY']}"
-
-                # Initializing the log file to capture the output of this script
-                echo "Starting script" >/var/log/user-data.log
-
-                # Redirecting all stdout and stderr to the log file for debugging purposes
-                exec > >(tee -a /var/log/user-data.log) 2>&1
-
-                # Placeholder sleep command for testing purposes
-                # You can remove or replace this line with actual script logic in production
-                echo "Sleeping for {sleep_time} seconds..."
-                sleep {sleep_time}
-
-                # Retrieve the instance ID using the ec2-metadata command
-                echo "Retrieving the instance ID using ec2-metadata..."
-                INSTANCE_ID=$(ec2-metadata -i | cut -d " " -f 2)
-                echo "Instance ID retrieved: $INSTANCE_ID"
-
-                # Retrieve the Spot Instance Request ID associated with this instance
-                SPOT_REQUEST_ID=$(aws ec2 describe-instances --instance-id $INSTANCE_ID --query "Reservations[0].Instances[0].SpotInstanceRequestId" --output text)
-                echo "Spot Instance Request ID retrieved: $SPOT_REQUEST_ID"
-
-                # Extract the region from the Availability Zone using ec2-metadata
-                REGION=$(ec2-metadata -z | cut -d " " -f 2 | sed 's/.$//')
-                echo "Region retrieved: $REGION"
-
-                # Check if the specific file exists in the S3 bucket for spot instance interruptions
-                CHECK_KEY="open/${{REGION}}|${{SPOT_REQUEST_ID}}.txt"
-                echo "Checking if file $CHECK_KEY exists in bucket {spot_tracking_s3_bucket_name}..."
-                if aws s3api head-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY" 2>/dev/null; then
-                    echo "File $CHECK_KEY exists in bucket. No further action required."
-                    aws s3api delete-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY"
-                else
-                    echo "File $CHECK_KEY does not exist in bucket {spot_tracking_s3_bucket_name}. Skipping..."
-                fi
-
-                # Retrieve instance details such as instance type, availability zone, and launch time
-                INSTANCE_TYPE=$(ec2-metadata -t | cut -d " " -f 2)
-                AVAILABILITY_ZONE=$(ec2-metadata -z | cut -d " " -f 2)
-                LAUNCH_TIME=$(aws ec2 describe-instances \
-                  --instance-id $INSTANCE_ID \
-                  --query "Reservations[0].Instances[0].LaunchTime" \
-                  --output text)
-                # Fetch the current spot price for the instance type in the specific availability zone
-                CURRENT_SPOT_PRICE=$(aws ec2 describe-spot-price-history \
-                  --instance-types $INSTANCE_TYPE \
-                  --availability-zone $AVAILABILITY_ZONE \
-                  --product-descriptions "Linux/UNIX" \
-                  --max-results 1 \
-                  --query "SpotPriceHistory[0].SpotPrice" \
-                  --output text)
-                CURRENT_TIME=$(date --utc +'%Y-%m-%dT%H:%M:%S+00:00')
-
-                # Write all the retrieved information to a temporary file
-                echo "Instance ID: $INSTANCE_ID" > /tmp/instance_info.txt
-                echo "Availability Zone: $AVAILABILITY_ZONE" >> /tmp/instance_info.txt
-                echo "Instance Launch Time: $LAUNCH_TIME" >> /tmp/instance_info.txt
-                echo "Current Time: $CURRENT_TIME" >> /tmp/instance_info.txt
-                echo "Current Spot Price: $CURRENT_SPOT_PRICE" >> /tmp/instance_info.txt
-
-                # Define the S3 object key as the instance ID followed by .txt
-                KEY="$INSTANCE_ID.txt"
-
-                # Check if the S3 bucket for completed instance information exists, create it if not
-                echo "Checking if bucket {complete_bucket_name} exists..."
-                if aws s3api head-bucket --bucket "{complete_bucket_name}" &>/dev/null; then
-                  echo "Bucket {complete_bucket_name} exists"
-                else
-                  echo "Bucket {complete_bucket_name} does not exist. Creating..."
-                  aws s3api create-bucket --bucket "{complete_bucket_name}"
-                  echo "Bucket {complete_bucket_name} created."
-                fi
-
-                # Upload the instance information file to the S3 bucket
-                echo "Uploading the file with the name $INSTANCE_ID.txt to the S3 bucket {complete_bucket_name}..."
-                aws s3api put-object --bucket {complete_bucket_name} --key $KEY --body /tmp/instance_info.txt
-                # Remove the temporary file after uploading
-                rm -f /tmp/instance_info.txt
-                echo "Upload completed. Please check the S3 bucket for the file."
-
-                # Terminate the instance after completing all tasks
-                echo "Terminating instance $INSTANCE_ID"
-                aws ec2 terminate-instances --instance-ids $INSTANCE_ID
-
-                """
-    # Return the generated script, base64 encoded for use in the EC2 user data
-    return base64.b64encode(script.encode()).decode()
-
-
-def save_spot_request_to_s3(s3_client, bucket_name, folder, request_id, region, check_count=0):
-    """
-    Save the spot request ID to the specified folder in the bucket with region information in the filename.
-    Include the check count in the object's metadata.
-    """
-    try:
-        s3_key = f"{folder}/{region}|{request_id}.txt"
-        metadata = {'check_count': str(check_count)}
-        s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=request_id, Metadata=metadata)
-        print(
-            f"Spot request {request_id} (Region: {region}) saved to {folder} in S3 bucket {bucket_name} with check count {check_count}.")
-    except Exception as e:
-        print(
-            f"Error saving spot request {request_id} (Region: {region}) to {folder} in S3 bucket {bucket_name}. Error: {e}")
-
-
-def handle_spot_request_status(ec2_client, request_id, region):
-    """
-    Waits for the spot instance request to be fulfilled and handles various states.
-    """
-    try:
-        response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-        state = response['SpotInstanceRequests'][0]['State']
-
-        # Active State
-        if state == 'active':
-            instance_id = response['SpotInstanceRequests'][0]['InstanceId']
-            save_spot_request_to_s3(s3_client, spot_tracking_s3_bucket_name, 'successful', request_id, region)
-            print(f"Spot request {request_id} is active with instance ID: {instance_id}.")
-            print(f"Saved to S3 bucket {spot_tracking_s3_bucket_name} with successful folder .")
-            return 'active', instance_id
-
-        elif state == 'open':
-            save_spot_request_to_s3(s3_client, spot_tracking_s3_bucket_name, 'open', request_id, region)
-            print(f"Spot request {request_id} is open. Saved to S3.")
-            return 'open', request_id
-
-        elif state == 'failed':
-            print(f"Spot request {request_id} has failed.")
-            # save_spot_request_to_s3(s3_client, spot_tracking_s3_bucket_name, 'failed', request_id, region)
-            # print(f"Saved to S3 bucket {spot_tracking_s3_bucket_name} with failed folder .")
-            ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-            return 'failed', None
-
-        elif state == 'cancelled':
-            print(f"Spot request {request_id} has been cancelled already. No further action required.")
-            # save_spot_request_to_s3(s3_client, spot_tracking_s3_bucket_name, 'failed', request_id, region)
-            # print(f"Saved to S3 bucket {spot_tracking_s3_bucket_name} with failed folder .")
-            return 'cancelled', None
-
-        elif state in ['closed', 'marked-for-termination']:
-            print(f"Spot request {request_id} is {state}. No further action required.")
-            return state, None
+    return render_user_data(user_data_config(aws_credentials, complete_bucket_name, sleep_time=sleep_time,
+                                             ledger_region=Region_DynamoForSpotRequestLedger))
 
-        else:
-            # save_spot_request_to_s3(s3_client, spot_tracking_s3_bucket_name, 'failed', request_id, region)
-            # print(f"Saved to S3 bucket {spot_tracking_s3_bucket_name} with failed folder .")
-            print(f"Spot request {request_id} is in an unexpected state: {state}.")
-            return state, None
-
-    except Exception as e:
-        print(f"Error while handling spot request {request_id}: {e}")
-        return 'error', None
 
-
-def move_to_folder(request_id, region, source_folder, destination_folder):
+def record_launch_result(ec2_client, result, region):
     """
-    Moves an S3 object from the source folder to the destination folder.
-
-    Parameters:
-    - request_id (str): ID of the spot instance request.
-    - region (str): AWS region of the request.
-    - source_folder (str): Source folder (or prefix) within the S3 bucket.
-    - destination_folder (str): Destination folder (or prefix) within the S3 bucket.
+    Record the spot requests of a launch in the ledger and cancel the ones that failed.
+    :param ec2_client: EC2 client of the region the instances were launched in
+    :param result: LaunchResult of the launch backend
+    :param region: Region of the launch
+    :return: Number of active plus open requests
     """
-    source_key = f"{source_folder}/{region}|{request_id}.txt"
-    destination_key = f"{destination_folder}/{region}|{request_id}.txt"
-
-    # Log the action
-    print(f"Moving {source_key} to {destination_key} in S3 bucket {spot_tracking_s3_bucket_name}...")
-
-    # Copy the object to the destination folder
-    s3_client.copy_object(
-        Bucket=spot_tracking_s3_bucket_name,
-        CopySource={'Bucket': spot_tracking_s3_bucket_name, 'Key': source_key},
-        Key=destination_key
-    )
-
-    # Log the successful move
-    print(f"Moved {source_key} to {destination_key} in S3 bucket {spot_tracking_s3_bucket_name}...")
+    # One batched ledger write for every request of the launch
+    ledger.record_many(
+        [(request_id, region, SUCCESSFUL, instance_id) for request_id, instance_id in result.active.items()]
+        + [(request_id, region, OPEN, None) for request_id in result.open_request_ids]
+        + [(request_id, region, FAILED, None) for request_id in result.failed_request_ids])
+
+    if result.failed_request_ids:
+        print(f"Spot requests {result.failed_request_ids} have failed.")
+        try:
+            ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=result.failed_request_ids)
+        except Exception as e:
+            print(f"Error cancelling failed spot requests {result.failed_request_ids}: {e}")
 
-    # Delete the original object from the source folder
-    s3_client.delete_object(Bucket=spot_tracking_s3_bucket_name, Key=source_key)
+    return result.n_active + result.n_open
 
 
-def fetch_highest_sps_score(region: str) -> int:
+def get_eligible_instance_types():
     """
-    Fetch the highest SPS score for a given region from the SpotPlacementScoreTable.
-
-    :param region: The region to fetch the score.
-    :return: The highest SPS score as an integer.
+    Return the configured instance types that meet the vCPU and memory requirements.
+    The answer only depends on conf.ini, so it is cached like the score data.
     """
-    dynamodb = boto3.resource('dynamodb',
-                              region_name=Region_DynamoDBForSpotPlacementScore)  # Replace with the correct region
-    table = dynamodb.Table('SpotPlacementScoreTable')
 
-    print(f"Fetching the highest SPS score for region {region} from SpotPlacementScoreTable...")
+    def load_instance_types():
+        ec2 = get_client('ec2', Region_DynamodbForSpotPrice)
+        return filter_instance_types_by_requirements(ec2, instance_types, min_vcpus, min_memory_gib)
 
-    try:
-        # Scan the table for the specific region
-        response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr('Region').eq(region)
-        )
-        items = response.get('Items', [])
-        if items:
-            # If there are multiple items, find the highest score
-            highest_score = max(int(item['SPS']) for item in items)
-            # print(f"Found items: {items}")
-            print(f"Highest SPS Score: {highest_score}")
-            return highest_score
-        else:
-            print(f"No matching items found for region: {region} in SpotPlacementScoreTable.")
-            return 0
-
-    except Exception as e:
-        print(f"Error fetching SPS score for region {region}: {e}")
-        return 0
+    return score_cache.get('eligible_instance_types', load_instance_types)
 
 
-def fetch_interruption_free_score(region: str) -> int:
+def get_cached_prices_for_regions(regions):
     """
-    Fetch the Interruption_free_score for a given region from the SpotInterruptionRatioTable.
+    Fetch the price items of the given regions, reusing the warm-container cache when possible.
+    Only eligible instance types are kept and regions without price data are left out.
 
-    :param region: The region to fetch the score.
-    :return: The Interruption_free_score as an integer.
+    :param regions: List of region names
+    :return: Dictionary of region to its list of items sorted by price
     """
-    dynamodb = boto3.resource('dynamodb',
-                              region_name=Region_DynamoDBForStabilityScore)  # Replace with the correct region
-    table = dynamodb.Table('SpotInterruptionRatioTable')
 
-    print(f"Fetching Interruption_free_score for region {region} from SpotInterruptionRatioTable...")
+    eligible_types = get_eligible_instance_types()
 
-    try:
-        # Scan the table for the specific region
-        response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr('Region').eq(region)
-        )
-        items = response.get('Items', [])
-        if items:
-            # Since we assume Region is unique, take the score directly
-            score = int(items[0]['Interruption_free_score'])
-            # print(f"Found item: {items[0]}")
-            print(f"Interruption Free Score: {score}")
-            return score
-        else:
-            print(f"No matching items found for region: {region} in SpotInterruptionRatioTable.")
-            return 0
+    def load_prices():
+        items_by_region = query_prices_for_regions(table, regions, instance_types=eligible_types)
+        return {region: items for region, items in items_by_region.items() if items}
 
-    except Exception as e:
-        print(f"Error fetching Interruption_free_score for region {region}: {e}")
-        return 0
+    return score_cache.get((SPOT_PRICE_TABLE_NAME, tuple(sorted(regions)), tuple(eligible_types)), load_prices)
 
 
 def evaluate_regions_for_spot_instances(preferred_region_list):
@@ -335,10 +176,13 @@ def evaluate_regions_for_spot_instances(preferred_region_list):
     """
     suitable_regions = []
 
+    # One pass over each score table for all candidate regions
+    total_scores = fetch_region_scores(preferred_region_list, Region_DynamoDBForSpotPlacementScore,
+                                       Region_DynamoDBForStabilityScore,
+                                       instance_types=get_eligible_instance_types(), cache=score_cache)
+
     for region in preferred_region_list:
-        spot_placement_score = fetch_highest_sps_score(region)
-        stability_score = fetch_interruption_free_score(region)
-        total_score = spot_placement_score + stability_score
+        total_score = total_scores[region]
 
         if total_score >= 4:
             print(f"Region {region} is good for spot instances (Total Score: {total_score}).")
@@ -359,19 +203,6 @@ def batch_launch_spot_instance(aws_credentials, number_of_spot_instances):
     user_data_encoded = generate_user_data_script(aws_credentials, sleep_time, complete_bucket_name)
     print(f"Generated user data script: {user_data_encoded[:50]}...")  # Display the first 50 characters for brevity
 
-    response = table.scan()
-
-    items = response.get('Items', [])
-    print(f"Scanned items: {items}")
-    if not items:
-        print("No items found in the table.")
-        raise Exception("NoItemsAvailable: No items found in the response.")
-
-    available_items = [item for item in items if item['region'] in target_regions]
-    print(f"Filtered available items based on target regions: {available_items}")
-    if not available_items:
-        raise Exception("NoItemsAvailable: No items available in the specified target regions.")
-
     # Evaluate regions based on SPS and Interruption Free Scores
     print("Evaluating regions based on SPS and Interruption Free Scores...")
     suitable_regions = evaluate_regions_for_spot_instances(target_regions)
@@ -380,282 +211,189 @@ def batch_launch_spot_instance(aws_credentials, number_of_spot_instances):
         print("No suitable regions found after evaluation.")
         raise Exception("No suitable regions based on SPS and Interruption Free scores.")
 
-    # Filter available items to only include those in suitable regions
-    available_items = [item for item in available_items if item['region'] in suitable_regions]
-    print(f"Available items after filtering by suitable regions: {available_items}")
-    if not available_items:
+    # Query only the AZs of the suitable regions instead of scanning the whole table
+    items_by_region = get_cached_prices_for_regions(suitable_regions)
+    print(f"Available items by suitable region: {items_by_region}")
+    sorted_items = cheapest_items(items_by_region)
+    if not sorted_items:
         print("No items available in the suitable regions.")
         raise Exception("NoItemsAvailable: No items available in the suitable regions.")
 
-    sorted_items = sorted(available_items, key=lambda x: float(x['price']))
     active_instance_count = 0
 
-    for item in sorted_items:
+    if launch_backend.multi_pool:
+        # One fleet per region over all of its pools, the region with the cheapest pool first
+        regions_by_price = dict.fromkeys(item['region'] for item in sorted_items)
+        launch_groups = [[item for item in sorted_items if item['region'] == region] for region in regions_by_price]
+    else:
+        launch_groups = [[item] for item in sorted_items]
 
-        current_spot_request_ids = []
+    for pools in launch_groups:
 
-        region = item['region']
-        availability_zone = item['availability_zone']
-        spot_price = str(item['price'])
+        region = pools[0]['region']
+        # Rows written before prices were stored per instance type have no instance_type
+        pools = [{**pool, 'instance_type': pool.get('instance_type', instance_type)} for pool in pools]
 
         print(f"region: {region}")
-        print(f"Availability zone: {availability_zone}")
-        print(f"Original spot price: {str(item['price'])}")
-        # print(f"Factor: {factor}")
-        print(f"New spot price: {spot_price}")
+        print(f"Pools (availability zone, instance type, price): "
+              f"{[(pool['availability_zone'], pool['instance_type'], str(pool['price'])) for pool in pools]}")
 
-        ec2_client = boto3.client('ec2', region_name=region)
+        ec2_client = get_client('ec2', region)
         ami_id = get_values_from_file('ami_ids.txt').get(region)
         security_group_ids = [get_values_from_file('security_group_ids.txt').get(region)]
 
         remaining_instances = number_of_spot_instances - active_instance_count
 
-        print(f"Using On-Demand price: {on_demand_price}")
+        print(f"Using On-Demand price: {on_demand_price} (launch backend: {launch_backend.name})")
         try:
-            response = ec2_client.request_spot_instances(
-                # SpotPrice=spot_price,
-                SpotPrice=str(on_demand_price),
-                InstanceCount=remaining_instances,
-                Type="one-time",
-                LaunchSpecification={
-                    "ImageId": ami_id,
-                    "InstanceType": instance_type,
-                    "KeyName": key_name,
-                    "SecurityGroupIds": security_group_ids,
-                    "Placement": {
-                        "AvailabilityZone": availability_zone
-                    },
-                    'UserData': user_data_encoded
-                }
-            )
-            current_spot_request_ids.extend([x['SpotInstanceRequestId'] for x in response['SpotInstanceRequests']])
+            result = launch_backend.launch(ec2_client, pools, remaining_instances, {
+                "ImageId": ami_id,
+                "KeyName": key_name,
+                "SecurityGroupIds": security_group_ids,
+                'UserData': user_data_encoded
+            })
 
         except Exception as e:
             # If there's an error, print or log the error and continue to the next item
             print(f"Error occurred: {e}. Moving to the next item.")
             continue
 
-        print(f"Sleep for {SLEEP_TIME_SPOT_REQUEST} seconds...")
-        time.sleep(SLEEP_TIME_SPOT_REQUEST)
+        active_instance_count += record_launch_result(ec2_client, result, region)
+        print(f"Active or open requests so far: {active_instance_count}/{number_of_spot_instances}")
 
-        for spot_request_id in current_spot_request_ids:
-            status, result = handle_spot_request_status(ec2_client, spot_request_id, region)
-
-            if status in ['active', 'open']:
-                print(f"Status: {status}")
-                type_of_result = 'Instance ID' if result.startswith('i') else 'Spot Request ID'
-                print(f"Processed request {spot_request_id} successfully with {type_of_result}: {result}")
-                active_instance_count += 1
-            else:
-                print(f"Spot request {spot_request_id} not successful with status {status}. Moving to the next item.")
-
-            if active_instance_count >= number_of_spot_instances:
-                # Once the required number of instances are successfully requested, break out of the loop.
-                return
+        if active_instance_count >= number_of_spot_instances:
+            # Once the required number of instances are successfully requested, break out of the loop.
+            return
 
     raise Exception(
         "NoItemsAvailable: No items were successful after iterating through all options. -> retrying in 1 hour")
 
 
-def list_request_ids_in_open_folder(bucket_name, folder):
+def organize_requests_by_region(requests):
     """
-    Retrieve all filenames in the specified folder of an S3 bucket.
+    Organize ledger items into a dictionary with region as key and the items of that region as values.
 
     Parameters:
-    - bucket_name (str): The name of the S3 bucket.
-    - folder (str): The folder name (prefix) within the bucket.
+    - requests (list): Ledger items with request_id and region.
 
     Returns:
-    - list: List of filenames within the specified folder.
-    """
-    s3_client = boto3.client('s3')
-
-    # Ensure folder name ends with a "/"
-    if not folder.endswith('/'):
-        folder += '/'
-
-    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=folder)
-    filenames = []
-
-    # Extract filenames from the response
-    if 'Contents' in response:
-        filenames.extend(item['Key'] for item in response['Contents'] if not item['Key'].startswith(f"{folder}open/"))
-
-    # If there is "open/", exclude open/ in filenames
-    if "open/" in filenames:
-        filenames.remove("open/")
-
-    return filenames
-
-
-def organize_filenames(filenames):
-    """
-    Organize filenames into a dictionary with region as key and
-    associated spot request IDs as a list of values.
-
-    Parameters:
-    - filenames (list): List of filenames in the format {region}|{spot_request_id}.txt.
-
-    Returns:
-    - dict: Dictionary with regions as keys and associated spot request IDs (without the .txt extension) as values.
+    - dict: Dictionary with regions as keys and lists of ledger items as values.
     """
     organized_data = {}
-
-    for filename in filenames:
-        # Extracting region and spot_request_id from the filename
-        # Also, remove any folder prefixes (e.g., "open/")
-        parts = filename.split('/')[-1].split('|')
-
-        # Safety check to ensure we have both region and spot_request_id
-        if len(parts) == 2:
-            region, request_with_extension = parts
-            request_id = request_with_extension.replace('.txt', '')
-
-            # Organize the data
-            if region not in organized_data:
-                organized_data[region] = []
-            organized_data[region].append(request_id)
-
+    for request in requests:
+        organized_data.setdefault(request['region'], []).append(request)
     return organized_data
 
 
-import boto3
-
+def describe_spot_request_states(region, request_ids):
+    """
+    Fetch the states of many spot requests of one region with batched, paginated calls.
+    A filter is used instead of SpotInstanceRequestIds, so an unknown ID does not fail its whole batch.
 
-def get_spot_request_state_with_metadata(request_id, region):
+    :param region: The AWS region where the requests were made.
+    :param request_ids: List of spot request IDs.
+    :return: Dictionary of request ID to its (state, status code, instance ID); requests EC2 does not know are left out.
+    """
+    paginator = get_client('ec2', region).get_paginator('describe_spot_instance_requests')
+    states = {}
+    for i in range(0, len(request_ids), DESCRIBE_BATCH_SIZE):
+        batch = request_ids[i:i + DESCRIBE_BATCH_SIZE]
+        for page in paginator.paginate(Filters=[{'Name': 'spot-instance-request-id', 'Values': batch}]):
+            for request in page['SpotInstanceRequests']:
+                states[request['SpotInstanceRequestId']] = (request['State'], request.get('Status', {}).get('Code'),
+                                                            request.get('InstanceId'))
+    return states
+
+
+def process_open_requests_in_region(region, requests):
     """
-    Fetch the state of a given spot request ID and its check_count metadata from S3.
+    Check the open requests of one region and move them in the ledger.
 
-    :param request_id: The ID of the spot instance request.
-    :param region: The AWS region where the request was made.
-    :param bucket_name: The name of the S3 bucket.
-    :param folder: The folder in the S3 bucket where the request is stored.
-    :return: A tuple of the state of the spot request and the check_count metadata.
+    :param region: The AWS region where the requests were made.
+    :param requests: Ledger items of the open requests of the region.
+    :return: Number of requests that were moved to failed and have to be launched again.
     """
-    # Create an EC2 client
-    ec2_client = boto3.client('ec2', region_name=region)
-    # Create an S3 client
-    s3_client = boto3.client('s3', region_name=region)
+    # The pool gives every worker thread its own Table resource, resources are not thread-safe
+    region_ledger = SpotRequestLedger(get_table(LEDGER_TABLE_NAME, Region_DynamoForSpotRequestLedger))
+    print(f"[{region}] Processing {len(requests)} open request IDs")
+    states = describe_spot_request_states(region, [request['request_id'] for request in requests])
 
-    # Initialize check_count to zero
-    check_count = 0
+    launch_count = 0
+    requests_to_cancel = []
 
-    # Try to fetch the state of the spot request from EC2
-    try:
-        response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-        state = response['SpotInstanceRequests'][0].get('State') if response.get('SpotInstanceRequests') else None
-    except Exception as e:
-        print(f"Error fetching state for spot request ID {request_id}. Error: {e}")
-        state = None
+    for request in requests:
+        request_id = request['request_id']
+        check_count = int(request.get('check_count', 0))
+        # None when EC2 does not know the request
+        current_state, status_code, instance_id = states.get(request_id, (None, None, None))
+        print(f"[{region}] State for request ID {request_id}: {current_state}")
 
-    # If the request is open, then retrieve the check_count metadata from S3
-    if state == 'open':
         try:
-            s3_object_key = f"open/{region}|{request_id}.txt"
-            s3_response = s3_client.head_object(Bucket=spot_tracking_s3_bucket_name, Key=s3_object_key)
-            # Extract check_count metadata if it exists
-            check_count = int(s3_response['Metadata'].get('check_count', 0))
-        except Exception as e:
-            print(f"Error retrieving metadata for spot request ID {request_id} from S3. Error: {e}")
-
-    # Return the state and check_count
-    return state, check_count
+            # Transitions are conditional on the request still being open, so a request that the
+            # instance or another invocation already moved is neither moved nor relaunched twice
+            if current_state == 'active':
+                # The instance ID lets the instance find this request in the InstanceIndex when it completes
+                attributes = {'instance_id': instance_id} if instance_id else {}
+                region_ledger.transition(request_id, SUCCESSFUL, **attributes)
+
+            elif current_state == 'open':
+                print(f"[{region}] Request ID {request_id} is still open. Checking check count: {check_count}")
+                if check_count >= 3:
+                    # Cancel and re-request the spot instance
+                    print(f"[{region}] Since the count is {check_count}, canceling request ID {request_id}.")
+                    requests_to_cancel.append(request_id)
+
+                else:
+                    region_ledger.increment_check_count(request_id)
+
+            elif current_state == 'closed' and status_code == INSTANCE_TERMINATED_BY_USER:
+                # The instance finished and terminated itself before the request was seen active
+                region_ledger.transition(request_id, COMPLETED)
 
+            else:
+                # failed, cancelled, closed, or unknown (None)
+                print(f"[{region}] State for request ID {request_id} is {current_state}. Moving it to {FAILED}.")
+                if region_ledger.transition(request_id, FAILED):
+                    launch_count += 1
 
-def increment_check_count(request_id, region, check_count):
-    """
-    Increment the check_count metadata for the spot request object in S3.
-
-    :param s3_client: The boto3 client for S3.
-    :param bucket_name: The name of the S3 bucket.
-    :param folder: The folder in the S3 bucket where the request is stored.
-    :param request_id: The ID of the spot instance request.
-    :param region: The AWS region where the request was made.
-    :param check_count: The current check count to be incremented.
-    :return: None
-    """
-    # Increment the check count
-    new_check_count = check_count + 1
+        except Exception as e:
+            print(f"[{region}] Error processing request ID {request_id}: {e}")
 
-    # Generate the S3 object key
-    s3_object_key = f"open/{region}|{request_id}.txt"
+    if requests_to_cancel:
+        # One cancel call for every request of the region that stayed open for too long
+        get_client('ec2', region).cancel_spot_instance_requests(SpotInstanceRequestIds=requests_to_cancel)
+        for request_id in requests_to_cancel:
+            if region_ledger.transition(request_id, FAILED):
+                launch_count += 1
 
-    # Copy the object to itself in S3, updating the metadata
-    try:
-        s3_client.copy_object(
-            Bucket=spot_tracking_s3_bucket_name,
-            CopySource={'Bucket': spot_tracking_s3_bucket_name, 'Key': s3_object_key},
-            Key=s3_object_key,
-            Metadata={'check_count': str(new_check_count)},
-            MetadataDirective='REPLACE'
-        )
-        print(f"Incremented check_count to {new_check_count} for spot request {request_id}.")
-    except Exception as e:
-        print(f"Error incrementing check_count for spot request {request_id}. Error: {e}")
+    return launch_count
 
 
 def lambda_handler(event, context):  # We don't need the event and context parameters in this case.
     try:
-        open_request_ids = list_request_ids_in_open_folder(spot_tracking_s3_bucket_name, "open")
-        print(f"Retrieved open request IDs from S3: {open_request_ids}")
-
-        organized_spot_request_ids = organize_filenames(open_request_ids)
-        print(f"Organized request IDs by region: {organized_spot_request_ids}")
-        print(f"Number of regions with open request IDs: {len(organized_spot_request_ids)}")
-        print(f"Total number of open request IDs: {sum(len(v) for v in organized_spot_request_ids.values())}")
-
-        launch_count = 0  # Count of spot requests to be launched for this region
-
-        for region, request_ids in organized_spot_request_ids.items():
-            print(f"Processing request IDs for region: {region}")
-
-            for request_id in request_ids:
-                try:
-                    current_state, check_count = get_spot_request_state_with_metadata(request_id, region)
-                    print()
-                    print(f"State for request ID {request_id}: {current_state}")
-
-                    if current_state == 'active':
-                        move_to_folder(request_id, region, 'open', 'successful')
-                        print(f"Moved request ID {request_id} to 'successful' folder.")
-
-                    elif current_state == 'open':
-                        print(f"Request ID {request_id} is still open. Checking check count: {check_count}")
-                        if check_count >= 3:
-                            # Cancel and re-request the spot instance
-                            print(f"Since the count is {check_count}, "
-                                  f"canceling and incrementing check count for request ID {request_id}.")
-                            ec2_client = boto3.client('ec2', region_name=region)
-                            ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-                            move_to_folder(request_id, region, 'open', 'failed')
-                            launch_count += 1
-
-                        else:
-                            increment_check_count(request_id, region, check_count)
-                            print(f"Incremented check count for request ID {request_id}.")
-
-                    elif current_state in ['failed', 'terminated']:
-                        launch_count += 1
-                        print(f"State for request ID {request_id} is {current_state}. Moving to 'failed' folder.")
-                        move_to_folder(request_id, region, 'open', 'failed')
-
-                    elif current_state is None:  # Explicit check for None
-                        launch_count += 1
-                        print(f"State for request ID {request_id} is None. Moving to 'failed' folder.")
-                        move_to_folder(request_id, region, 'open', 'failed')
-
-                    else:
-                        launch_count += 1
-                        print(f"State for request ID {request_id} is {current_state}. No action required.")
-
-                except Exception as inner_e:
-                    if "InvalidSpotInstanceRequestID.NotFound" in str(inner_e):
-                        move_to_folder(request_id, region, 'open', 'failed')
-                        print(f"Error: Request ID {request_id} not found. Deleted from 'open' folder.")
-                    else:
-                        # If the error is of some other kind, print it
-                        print(f"Error processing request ID {request_id}: {inner_e}")
-        print(f"Deleted {launch_count} request IDs from 'open' folder.")
+        open_requests = ledger.list_by_state(OPEN)
+        print(f"Retrieved open request IDs from the ledger: {[request['request_id'] for request in open_requests]}")
+
+        organized_spot_requests = organize_requests_by_region(open_requests)
+        print(f"Number of regions with open request IDs: {len(organized_spot_requests)}")
+        print(f"Total number of open request IDs: {len(open_requests)}")
+
+        launch_count = 0  # Count of spot requests to be launched again
+
+        # Every region is checked at the same time, with a few batched calls per region
+        if organized_spot_requests:
+            max_workers = min(MAX_REGION_WORKERS, len(organized_spot_requests))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(process_open_requests_in_region, region, requests):
+                           region for region, requests in organized_spot_requests.items()}
+
+                for future in concurrent.futures.as_completed(futures):
+                    region = futures[future]
+                    try:
+                        launch_count += future.result()
+                    except Exception as e:
+                        print(f"Error processing open requests in region {region}: {e}")
+        print(f"Moved {launch_count} open request IDs to {FAILED}.")
 
         if launch_count > 0:
             print(f"{launch_count} new spot requests to be launched.")
@@ -666,8 +404,16 @@ def lambda_handler(event, context):  # We don't need the event and context param
         else:
             print("No new spot requests to be launched.")
 
-        if not open_request_ids:
-            print("No Request IDs found in 'open' folder.")
+        if not open_requests:
+            print("No open request IDs found in the ledger.")
+
+        if standby_pool_max_size > 0:
+            try:
+                request_replenishment(get_client('lambda', Region_LambdaForNewSpotInstance))
+            except Exception as e:
+                print(f"Error requesting a standby pool replenishment: {e}")
+
+        report_throttles()
 
     except Exception as e:
         print(f"Error in lambda handler: {e}")
@@ -0,0 +1,239 @@
+"""
+Spot request ledger
+
+Keeps the state of every spot request in the SpotRequestLedgerTable (one item per request ID) instead of
+S3 objects under open/, successful/ and failed/. A state change is a single conditional UpdateItem
+instead of list/head/copy/delete calls, check counts are atomic counters, and the open requests are
+read back with one Query on the StateIndex.
+
+The same file is shipped with the launcher and with every Lambda that tracks spot requests.
+"""
+
+import time
+import uuid
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+LEDGER_TABLE_NAME = 'SpotRequestLedgerTable'
+STATE_INDEX_NAME = 'StateIndex'
+INSTANCE_INDEX_NAME = 'InstanceIndex'  # Sparse, only rows with an instance_id are in it
+
+# Request states, the first three replace the S3 folders of the same name
+OPEN = 'open'
+SUCCESSFUL = 'successful'
+FAILED = 'failed'
+INTERRUPTED = 'interrupted'  # The instance of the request received a spot interruption
+COMPLETED = 'completed'  # The instance of the request finished its work
+STANDBY = 'standby'  # The instance of the request is parked in the warm-standby pool, waiting to be claimed
+
+
+def utc_now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class SpotRequestLedger:
+    """
+    DynamoDB-backed store of spot request states.
+    """
+
+    def __init__(self, table):
+        """
+        :param table: DynamoDB Table resource of SpotRequestLedgerTable
+        """
+        self.table = table
+
+    def record(self, request_id, region, state, instance_id=None):
+        """
+        Create or overwrite the entry of a new spot request.
+        :param request_id: Spot request ID
+        :param region: Region the request was made in
+        :param state: Initial state (OPEN, SUCCESSFUL or FAILED)
+        :param instance_id: Instance ID if the request is already fulfilled
+        """
+        self.record_many([(request_id, region, state, instance_id)])
+
+    def record_many(self, requests):
+        """
+        Create or overwrite the entries of several new spot requests with batched writes.
+        :param requests: List of (request ID, region, state, instance ID or None) tuples
+        :return: Stats of the batched writes (see dynamodb_batch_writer.batch_put_items)
+        """
+        # Not shipped to the instances, which only move their own request with conditional updates
+        from dynamodb_batch_writer import batch_put_items
+
+        now = utc_now()
+        items = []
+        for request_id, region, state, instance_id in requests:
+            item = {
+                'request_id': request_id,
+                'region': region,
+                'request_state': state,
+                'check_count': 0,
+                'created_at': now,
+                'updated_at': now,
+            }
+            if instance_id:
+                item['instance_id'] = instance_id
+            items.append(item)
+        stats = batch_put_items(self.table, items, overwrite_by_pkeys=['request_id'])
+        for request_id, region, state, _ in requests:
+            print(f"Spot request {request_id} (Region: {region}) recorded as {state}.")
+        return stats
+
+    def transition(self, request_id, to_state, from_states=(OPEN,), **attributes):
+        """
+        Move a request to another state, only if it is currently in one of the given states.
+        :param request_id: Spot request ID
+        :param to_state: New state
+        :param from_states: States the request must be in for the transition to happen
+        :param attributes: Extra attributes to set (e.g. instance_id)
+        :return: True if the request was moved, False if it was missing or in another state
+        """
+        values = {':to': to_state, ':now': utc_now()}
+        values.update({f":f{i}": state for i, state in enumerate(from_states)})
+        names = {'#state': 'request_state'}
+        updates = ['#state = :to', 'updated_at = :now']
+        for i, (name, value) in enumerate(attributes.items()):
+            names[f"#x{i}"] = name
+            values[f":x{i}"] = value
+            updates.append(f"#x{i} = :x{i}")
+
+        try:
+            self.table.update_item(
+                Key={'request_id': request_id},
+                UpdateExpression='SET ' + ', '.join(updates),
+                ConditionExpression=f"#state IN ({', '.join(f':f{i}' for i in range(len(from_states)))})",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            print(f"Spot request {request_id} is not in {list(from_states)}, not moved to {to_state}.")
+            return False
+
+        print(f"Spot request {request_id} moved to {to_state}.")
+        return True
+
+    def complete_instance(self, instance_id, from_states=(OPEN, SUCCESSFUL)):
+        """
+        Move the request of an instance to completed, found with one Query on the InstanceIndex, so the instance does
+        not need its spot request ID.
+        :param instance_id: Instance ID
+        :param from_states: States the request must be in for the transition to happen
+        :return: True if a request was moved
+        """
+        response = self.table.query(IndexName=INSTANCE_INDEX_NAME,
+                                    KeyConditionExpression=Key('instance_id').eq(instance_id))
+        request_ids = [item['request_id'] for item in response.get('Items', [])]
+        if not request_ids:
+            print(f"No spot request recorded for instance {instance_id}, the open-request checker will complete it.")
+            return False
+        return any([self.transition(request_id, COMPLETED, from_states) for request_id in request_ids])
+
+    def increment_check_count(self, request_id):
+        """
+        Atomically add one to the check count of an open request.
+        :param request_id: Spot request ID
+        :return: The new check count, or None if the request is not open anymore
+        """
+        try:
+            response = self.table.update_item(
+                Key={'request_id': request_id},
+                UpdateExpression='ADD check_count :one SET updated_at = :now',
+                ConditionExpression='#state = :open',
+                ExpressionAttributeNames={'#state': 'request_state'},
+                ExpressionAttributeValues={':one': 1, ':open': OPEN, ':now': utc_now()},
+                ReturnValues='UPDATED_NEW',
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            print(f"Spot request {request_id} is not open anymore, check count not incremented.")
+            return None
+
+        check_count = int(response['Attributes']['check_count'])
+        print(f"Incremented check_count to {check_count} for spot request {request_id}.")
+        return check_count
+
+    def acquire_lock(self, lock_id, lease_seconds):
+        """
+        Take a lease on a lock row of the ledger. The row has no request_state, so it is in no index.
+        A lease that is not released expires after lease_seconds.
+        :param lock_id: Key of the lock row
+        :param lease_seconds: Length of the lease
+        :return: Token to release the lock with, or None if the lock is held
+        """
+        token = str(uuid.uuid4())
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={'request_id': lock_id, 'lease_token': token, 'lease_until': now + lease_seconds},
+                ConditionExpression='attribute_not_exists(request_id) OR lease_until < :now',
+                ExpressionAttributeValues={':now': now},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            print(f"Lock {lock_id} is held by another holder.")
+            return None
+        return token
+
+    def release_lock(self, lock_id, token):
+        """
+        Release a lock taken with acquire_lock, unless its lease expired and another holder took it.
+        """
+        try:
+            self.table.delete_item(
+                Key={'request_id': lock_id},
+                ConditionExpression='lease_token = :token',
+                ExpressionAttributeValues={':token': token},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            print(f"Lock {lock_id} expired before it was released.")
+
+    def list_by_state(self, state, updated_since=None):
+        """
+        Return every request in a state with one paginated Query on the StateIndex.
+        :param state: Request state
+        :param updated_since: Optional timestamp (utc_now format), only requests moved since then are returned
+        :return: List of ledger items
+        """
+        key_condition = Key('request_state').eq(state)
+        if updated_since:
+            key_condition = key_condition & Key('updated_at').gte(updated_since)
+        query_kwargs = {
+            'IndexName': STATE_INDEX_NAME,
+            'KeyConditionExpression': key_condition,
+        }
+        items = []
+        while True:
+            response = self.table.query(**query_kwargs)
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return items
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def clear(self):
+        """
+        Delete every entry of the ledger, e.g. before a new experiment.
+        :return: Number of deleted entries
+        """
+        from dynamodb_batch_writer import batch_delete_keys
+
+        scan_kwargs = {'ProjectionExpression': 'request_id'}
+        deleted = 0
+        while True:
+            response = self.table.scan(**scan_kwargs)
+            keys = [{'request_id': item['request_id']} for item in response.get('Items', [])]
+            deleted += batch_delete_keys(self.table, keys)['written']
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        print(f"Deleted {deleted} entries from {self.table.name}.")
+        return deleted
+
@@ -0,0 +1,181 @@
+"""
+Warm-standby pool
+
+Keeps a few idle spot instances parked in the best-scored region so an interrupted instance can be
+replaced in seconds instead of waiting for a new spot request to be fulfilled and booted. Standby
+instances are ordinary spot requests in the ledger with the 'standby' state; their user data waits
+until the request leaves that state and then runs the workload like any other instance.
+
+- Claiming a standby is one conditional ledger transition (standby -> successful), so two
+  interruptions handled at the same time never get the same instance.
+- The pool size follows the measured interruption rate: it covers the interruptions expected while
+  a new standby is being brought up, plus a safety margin, between a configured minimum and maximum.
+- Replenishment runs outside of the interruption path, in an asynchronous invocation of the
+  new-instance Lambda that the interruption handler and the open-request checker trigger. A lock row
+  in the ledger lets one replenishment run at a time; the ledger rows of its standby instances are
+  only written once the launch returns, so concurrent ones would all launch the same shortfall.
+
+The same file is shipped with every Lambda that uses or replenishes the standby pool.
+"""
+
+import contextlib
+import json
+import math
+from datetime import datetime, timedelta, timezone
+
+from spot_request_ledger import INTERRUPTED, LEDGER_TABLE_NAME, STANDBY, SUCCESSFUL
+
+# Event of the asynchronous invocation that tops the pool up
+REPLENISH_EVENT_KEY = 'replenish_standby'
+
+# Lambda that launches replacement and standby instances
+NEW_SPOT_INSTANCE_FUNCTION_NAME = 'lambda_new_spot_instance'
+
+# One-sided z-score of the safety margin on the expected number of interruptions (about 95%)
+SAFETY_Z = 1.65
+
+# Seconds between two ledger reads of a parked instance
+STANDBY_POLL_SECONDS = 5
+
+# Ledger row held while the pool is replenished
+REPLENISH_LOCK_ID = 'lock#standby-pool-replenish'
+
+# Lease of the lock, the maximum Lambda run time, so a crashed replenishment cannot hold it longer
+REPLENISH_LOCK_SECONDS = 900
+
+
+def standby_target_size(interruptions_per_hour, replenish_seconds, min_size=0, max_size=0):
+    """
+    Number of standby instances needed to cover the interruptions expected while the pool is replenished.
+    Interruptions are treated as a Poisson process, so the margin grows with the square root of the mean.
+    :param interruptions_per_hour: Measured interruption rate
+    :param replenish_seconds: Time it takes to bring up a new standby instance
+    :param min_size: Smallest pool size
+    :param max_size: Largest pool size
+    :return: Target pool size
+    """
+    expected = interruptions_per_hour * replenish_seconds / 3600
+    size = math.ceil(expected + SAFETY_Z * math.sqrt(expected)) if expected > 0 else 0
+    return max(min_size, min(max_size, size))
+
+
+class StandbyPool:
+    """
+    Standby instances tracked in the spot request ledger.
+    """
+
+    def __init__(self, ledger, min_size, max_size, replenish_seconds, rate_window_hours):
+        """
+        :param ledger: SpotRequestLedger
+        :param min_size: Smallest pool size
+        :param max_size: Largest pool size (0 disables the pool)
+        :param replenish_seconds: Time it takes to bring up a new standby instance
+        :param rate_window_hours: Hours of interruption history used to measure the interruption rate
+        """
+        self.ledger = ledger
+        self.min_size = min_size
+        self.max_size = max_size
+        self.replenish_seconds = replenish_seconds
+        self.rate_window_hours = rate_window_hours
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def members(self):
+        """
+        :return: Ledger items of the parked instances, oldest first
+        """
+        return sorted(self.ledger.list_by_state(STANDBY), key=lambda item: item.get('created_at', ''))
+
+    def interruption_rate(self):
+        """
+        Interruptions per hour over the rate window, read from the ledger.
+        """
+        since = (datetime.now(timezone.utc) - timedelta(hours=self.rate_window_hours)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return len(self.ledger.list_by_state(INTERRUPTED, updated_since=since)) / self.rate_window_hours
+
+    def target_size(self):
+        rate = self.interruption_rate()
+        size = standby_target_size(rate, self.replenish_seconds, self.min_size, self.max_size)
+        print(f"Interruption rate: {rate:.2f}/hour, standby pool target size: {size}")
+        return size
+
+    def shortfall(self):
+        """
+        :return: Number of standby instances to launch to reach the target size
+        """
+        return max(0, self.target_size() - len(self.members()))
+
+    @contextlib.contextmanager
+    def replenish_lock(self):
+        """
+        Hold the replenish lock of the pool while the shortfall is read and launched.
+        :return: Context manager yielding True if the lock was taken, False if another replenishment holds it
+        """
+        token = self.ledger.acquire_lock(REPLENISH_LOCK_ID, REPLENISH_LOCK_SECONDS)
+        try:
+            yield token is not None
+        finally:
+            if token:
+                self.ledger.release_lock(REPLENISH_LOCK_ID, token)
+
+    def claim(self, members, exclude_instance_id=None):
+        """
+        Hand the oldest parked instance over to the workload.
+        :param members: Result of members()
+        :param exclude_instance_id: Instance that must not be claimed (e.g. the interrupted one)
+        :return: Ledger item of the claimed instance, or None when the pool is empty
+        """
+        for item in members:
+            if item.get('instance_id') == exclude_instance_id:
+                continue
+            # Conditional on the request still being parked, so concurrent claims never share an instance
+            if self.ledger.transition(item['request_id'], SUCCESSFUL, from_states=(STANDBY,)):
+                print(f"Claimed standby instance {item.get('instance_id')} in {item.get('region')}.")
+                return item
+        print("No standby instance available.")
+        return None
+
+
+def is_member(members, instance_id):
+    """
+    Check if an instance is one of the parked instances.
+    """
+    return any(item.get('instance_id') == instance_id for item in members)
+
+
+def request_replenishment(lambda_client, function_name=NEW_SPOT_INSTANCE_FUNCTION_NAME):
+    """
+    Ask the new-instance Lambda to top the pool up, without waiting for it.
+    :param lambda_client: Lambda client of the region of the new-instance Lambda
+    :param function_name: Name of the new-instance Lambda
+    """
+    lambda_client.invoke(FunctionName=function_name, InvocationType='Event',
+                         Payload=json.dumps({REPLENISH_EVENT_KEY: True}).encode('utf-8'))
+    print(f"Requested a standby pool replenishment from {function_name}.")
+
+
+def user_data_standby_wait(table_region):
+    """
+    Shell snippet for a user-data script that parks the instance until its spot request leaves the
+    standby state in the ledger, i.e. until it is claimed.
+    :param table_region: Region of the SpotRequestLedgerTable
+    :return: Bash snippet
+    """
+    return (
+        f"INSTANCE_ID=$(ec2-metadata -i | cut -d \" \" -f 2)\n"
+        f"SPOT_REQUEST_ID=$(aws ec2 describe-instances --instance-id $INSTANCE_ID "
+        f"--query \"Reservations[0].Instances[0].SpotInstanceRequestId\" --output text)\n"
+        f"echo \"Parked in the standby pool as spot request $SPOT_REQUEST_ID, waiting to be claimed...\"\n"
+        f"while true; do\n"
+        f"  STATE=$(aws dynamodb get-item --region {table_region} --table-name {LEDGER_TABLE_NAME} "
+        f"--key '{{\"request_id\": {{\"S\": \"'\"$SPOT_REQUEST_ID\"'\"}}}}' "
+        f"--projection-expression request_state --query 'Item.request_state.S' --output text 2>/dev/null)\n"
+        f"  if [ -n \"$STATE\" ] && [ \"$STATE\" != \"None\" ] && [ \"$STATE\" != \"{STANDBY}\" ]; then\n"
+        f"    echo \"Spot request $SPOT_REQUEST_ID is $STATE, starting the workload.\"\n"
+        f"    break\n"
+        f"  fi\n"
+        f"  sleep {STANDBY_POLL_SECONDS}\n"
+        f"done"
+    )
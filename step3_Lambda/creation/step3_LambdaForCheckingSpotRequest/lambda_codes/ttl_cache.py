@@ -0,0 +1,64 @@
+"""
+Warm-container TTL cache
+
+Lambda keeps module-level objects alive between invocations of the same container, so data that
+only changes when the updater Lambdas run (at the top of every hour) can be reused by warm
+invocations instead of being read from DynamoDB again. Entries also expire at the refresh boundary,
+so a warm container reads the new data once the updaters have written it.
+
+The same file is shipped with every Lambda that caches score or price data.
+"""
+
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Small key/value cache whose entries expire after a fixed number of seconds, or at the next refresh
+    boundary of the underlying data when that comes first.
+    """
+
+    def __init__(self, ttl, refresh_period=0, refresh_offset=0):
+        """
+        :param ttl: Lifetime of an entry in seconds (0 disables caching)
+        :param refresh_period: Seconds between two refreshes of the data, on the epoch clock (0 if unknown)
+        :param refresh_offset: Seconds after the start of a period by which the refresh has been written
+        """
+        self.ttl = ttl
+        self.refresh_period = refresh_period
+        self.refresh_offset = refresh_offset
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def expires_at(self, now):
+        """
+        :param now: Epoch seconds at which an entry is loaded
+        :return: Epoch seconds at which the entry expires
+        """
+        expires_at = now + self.ttl
+        if self.refresh_period > 0:
+            since_refresh = (now - self.refresh_offset) % self.refresh_period
+            expires_at = min(expires_at, now - since_refresh + self.refresh_period)
+        return expires_at
+
+    def get(self, key, loader):
+        """
+        Return the cached value of a key, calling the loader when it is missing or expired.
+        Empty results are not cached, so a failed or empty read is retried on the next call.
+        :param key: Hashable cache key
+        :param loader: Function without arguments that loads the value
+        :return: The cached or freshly loaded value
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                print(f"Cache hit for {key}")
+                return entry[1]
+
+        value = loader()
+        if value and self.ttl > 0:
+            with self._lock:
+                self._entries[key] = (self.expires_at(now), value)
+        return value
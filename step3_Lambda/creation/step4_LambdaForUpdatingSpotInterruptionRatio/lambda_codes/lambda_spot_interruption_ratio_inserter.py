@@ -4,11 +4,14 @@ This lambda function is used to update the spot interruption frequency table.
 import configparser
 import json
 import os
+import re
 import subprocess
 from decimal import Decimal
 
 import boto3
 
+from dynamodb_batch_writer import batch_put_items
+
 config = configparser.ConfigParser()
 config.read('./conf.ini')
 
@@ -18,7 +21,9 @@ dynamodb = boto3.resource('dynamodb', region_name=region_for_db)
 table = dynamodb.Table('SpotInterruptionRatioTable')
 
 INSTANCE_TYPE = config.get('settings', 'instance_type')
-print(f"INSTANCE_TYPE: {INSTANCE_TYPE}")
+# Comma-separated list of instance types to collect, defaults to the single instance_type
+INSTANCE_TYPES = [t.strip() for t in config.get('settings', 'instance_types', fallback=INSTANCE_TYPE).split(',')]
+print(f"INSTANCE_TYPES: {INSTANCE_TYPES}")
 
 # Interruption mapping (reversed to transform label to numeric)
 interruption_mapping = {
@@ -49,9 +54,12 @@ def make_executable(path):
 def get_spotinfo():
     spotinfo_executable = '/opt/bin/spotinfo'
 
+    # spotinfo accepts an RE2 pattern, so every instance type is fetched in a single run
+    type_pattern = '^(' + '|'.join(re.escape(instance_type) for instance_type in INSTANCE_TYPES) + ')$'
+
     command = [
         spotinfo_executable,
-        '--type', INSTANCE_TYPE,
+        '--type', type_pattern,
         '--region', 'all',
         '--output', 'json',
         '--sort', 'interruption'
@@ -90,8 +98,7 @@ def extract_relevant_info(data):
 
 
 def store_in_dynamodb(results):
-    for item in results:
-        table.put_item(Item=item)
+    return batch_put_items(table, results, overwrite_by_pkeys=['Region', 'InstanceType'])
 
 
 def lambda_handler(event, context):
@@ -103,9 +110,10 @@ def lambda_handler(event, context):
         }
 
     results = extract_relevant_info(data)
-    store_in_dynamodb(results)
+    write_stats = store_in_dynamodb(results)
 
     return {
         'statusCode': 200,
-        'body': 'Data processed and stored successfully.'
+        'body': f"Data processed and stored successfully. {write_stats['written']} items written, "
+                f"{write_stats['consumed_capacity']} WCU consumed."
     }
@@ -2,12 +2,15 @@
 This lambda function is used to update the spot placement score table.
 """
 import configparser
+import itertools
 import os
 import pickle
 import pprint
 
 import boto3
 
+from dynamodb_batch_writer import batch_put_items
+
 # Constants
 FOLDER_NAME = './'  # Change to current directory since pickle files are in the Lambda package
 OPTIMIZED_QUERIES_FILE = 'optimized_queries.pkl'
@@ -17,6 +20,8 @@ DYNAMODB_TABLE_NAME = 'SpotPlacementScoreTable'
 config = configparser.ConfigParser()
 config.read('./conf.ini')
 INSTANCE_TYPE = config.get('settings', 'instance_type')
+# Comma-separated list of instance types to collect, defaults to the single instance_type
+INSTANCE_TYPES = [t.strip() for t in config.get('settings', 'instance_types', fallback=INSTANCE_TYPE).split(',')]
 
 config = configparser.ConfigParser()
 config.read('./conf.ini')
@@ -33,21 +38,25 @@ def load_pickle(filename):
 
 
 def get_sps(optimized_queries):
-    """Fetches spot placement scores for given queries."""
+    """
+    Fetches spot placement scores for given queries.
+    A request with several instance types returns one score for the whole mix, so every instance type
+    is scored on its own, still covering all regions of a query in one call.
+    """
     session = boto3.session.Session()
     ec2 = session.client('ec2', region_name='us-east-1')
 
     sps_results = []
-    for query in optimized_queries:
+    for query, instance_type in itertools.product(optimized_queries, INSTANCE_TYPES):
         response = ec2.get_spot_placement_scores(
-            InstanceTypes=[INSTANCE_TYPE],
+            InstanceTypes=[instance_type],
             TargetCapacity=1,
             SingleAvailabilityZone=True,
             RegionNames=list(query.keys())
         )
         sps_results.extend(
             {
-                'InstanceType': INSTANCE_TYPE,
+                'InstanceType': instance_type,
                 'Region': info['Region'],
                 'AvailabilityZoneId': info['AvailabilityZoneId'],
                 'SPS': int(info['Score']),
@@ -80,10 +89,10 @@ def lambda_handler(event, context):
 
     # Insert the results into DynamoDB
     table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-    for item in sps_results:
-        table.put_item(Item=item)
+    write_stats = batch_put_items(table, sps_results, overwrite_by_pkeys=['availability_zone', 'InstanceType'])
 
     return {
         'statusCode': 200,
-        'body': 'Process Completed'
+        'body': f"Process Completed. {write_stats['written']} items written, "
+                f"{write_stats['consumed_capacity']} WCU consumed."
     }
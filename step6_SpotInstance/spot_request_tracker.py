@@ -0,0 +1,122 @@
+"""
+Spot request state tracker
+
+Polls spot instance requests with adaptive backoff instead of fixed sleeps.
+Polling starts with short intervals, backs off exponentially, and returns as soon as every
+request has settled. All request IDs of a region are described in one batched call per poll.
+
+The same file is shipped with the launcher and with every Lambda that launches spot instances.
+"""
+
+import time
+
+import botocore
+
+# States in which a spot request will not change anymore on its own
+TERMINAL_STATES = ('active', 'failed', 'cancelled', 'closed')
+
+# Status codes of an 'open' request that is still being evaluated by EC2
+PENDING_STATUS_CODES = ('pending-evaluation', 'pending-fulfillment')
+
+# describe_spot_instance_requests does not paginate when IDs are given, so keep batches small
+DESCRIBE_BATCH_SIZE = 100
+
+
+def is_settled(request):
+    """
+    Check if a spot request has reached a state that polling will not change soon.
+    An 'open' request is settled once EC2 has evaluated it (e.g. capacity-not-available).
+    :param request: Spot request dictionary from describe_spot_instance_requests
+    :return: True if the request is settled
+    """
+    state = request.get('State')
+    if state in TERMINAL_STATES:
+        return True
+    status_code = request.get('Status', {}).get('Code')
+    return state == 'open' and status_code not in PENDING_STATUS_CODES
+
+
+class SpotRequestTracker:
+    """
+    Track a set of spot requests in one region until all of them settle.
+    """
+
+    def __init__(self, ec2_client, initial_interval=1.0, max_interval=30.0, backoff_factor=2.0):
+        """
+        :param ec2_client: EC2 client of the region the requests were made in
+        :param initial_interval: First wait in seconds before polling again
+        :param max_interval: Upper bound of the wait between two polls
+        :param backoff_factor: Multiplier applied to the wait after every poll
+        """
+        self.ec2_client = ec2_client
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.callbacks = {}
+
+    def on(self, state, callback):
+        """
+        Register a callback that is called once per request when it first reaches the given state.
+        :param state: Spot request state (e.g. 'active', 'open', 'failed')
+        :param callback: Function called with the spot request dictionary
+        :return: The tracker, so calls can be chained
+        """
+        self.callbacks.setdefault(state, []).append(callback)
+        return self
+
+    def describe(self, request_ids):
+        """
+        Describe the given spot requests in batched calls.
+        Requests that EC2 does not know yet (eventual consistency) are left out of the result.
+        :param request_ids: List of spot request IDs
+        :return: Dictionary of request ID to spot request dictionary
+        """
+        requests = {}
+        for i in range(0, len(request_ids), DESCRIBE_BATCH_SIZE):
+            batch = request_ids[i:i + DESCRIBE_BATCH_SIZE]
+            try:
+                response = self.ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=batch)
+            except botocore.exceptions.ClientError as e:
+                if "InvalidSpotInstanceRequestID.NotFound" not in str(e):
+                    raise e
+                print("Spot instance request IDs not found yet, retrying on the next poll...")
+                continue
+            for request in response['SpotInstanceRequests']:
+                requests[request['SpotInstanceRequestId']] = request
+        return requests
+
+    def wait(self, request_ids, timeout=300):
+        """
+        Poll the given spot requests until every request is settled or the timeout expires.
+        :param request_ids: List of spot request IDs
+        :param timeout: Maximum time to wait in seconds
+        :return: Dictionary of request ID to the latest spot request dictionary
+        """
+        request_ids = list(request_ids)
+        deadline = time.monotonic() + timeout
+        interval = self.initial_interval
+        seen_states = {}
+        requests = {}
+
+        while True:
+            requests.update(self.describe(request_ids))
+
+            for request_id, request in requests.items():
+                state = request.get('State')
+                if seen_states.get(request_id) != state:
+                    seen_states[request_id] = state
+                    for callback in self.callbacks.get(state, []):
+                        callback(request)
+
+            pending = [request_id for request_id in request_ids
+                       if request_id not in requests or not is_settled(requests[request_id])]
+            if not pending:
+                return requests
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"Timed out waiting for {len(pending)} spot requests to settle.")
+                return requests
+
+            time.sleep(min(interval, remaining))
+            interval = min(interval * self.backoff_factor, self.max_interval)
@@ -1,21 +1,32 @@
-import base64
 import concurrent.futures
 import configparser
 import itertools
 import json
 import os
 import sys
+import threading
 import time
 from typing import List
 
-import boto3
 import botocore
-from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError
 from colorama import Fore, init
 
+from client_pool import get_client, get_resource, get_table, report_throttles
+from placement_engine import DEFAULT_SPREAD, allocate_instances, fetch_pool_scores, launch_across_pools, \
+    placement_weights
+from s3_bucket_ops import empty_bucket as delete_all_objects
+from spot_price_store import SPOT_PRICE_TABLE_NAME, filter_instance_types_by_requirements, query_region_prices
+from spot_price_warehouse import SpotPriceWarehouse
+from launch_backends import SPOT_REQUEST_BACKEND, get_launch_backend
+from spot_request_ledger import FAILED, LEDGER_TABLE_NAME, OPEN, SUCCESSFUL, SpotRequestLedger
+from user_data_builder import render_user_data, user_data_config
+
 inst_id = None
 
+# Upper bound (seconds) for a new batch of spot requests to become active, failed, or evaluated as open
+SPOT_REQUEST_SETTLE_TIMEOUT = 80
+
 import re
 
 from pathlib import Path
@@ -92,91 +103,6 @@ def count_open_spot_requests(ec2_client, request_ids):
     return open_request_count
 
 
-def upload_request_to_s3(request_ids, bucket_name, region, state_type, check_count=0):
-    """
-    Upload the spot request IDs to the specified S3 bucket.
-    """
-
-    # Loop through each request ID and upload them individually
-    for request_id in request_ids:
-        object_name = f"{state_type}/{region}|{request_id}.txt"
-        # Initialize metadata if the state type is "open"
-        metadata = {'check_count': str(check_count)} if state_type == "open" else None
-
-        try:
-            # If the state type is "open", include the metadata
-            if state_type == "open":
-                s3_client.put_object(Bucket=bucket_name, Key=object_name, Body=request_id, Metadata=metadata)
-                print(
-                    f"Spot request {request_id} (Region: {region}) saved to {state_type} folder in S3 bucket "
-                    f"{bucket_name} with check count {check_count}.")
-            else:
-                # For other state types, upload without metadata
-                s3_client.put_object(Bucket=bucket_name, Key=object_name, Body=request_id)
-
-            print(f"Successfully uploaded {request_id} to S3 bucket {bucket_name} with key {object_name}.")
-        except botocore.exceptions.ClientError as e:
-            print(f"Error uploading {request_id} to S3: {str(e)}")
-
-
-def count_spot_requests_by_state(ec2_client, request_ids):
-    """
-    Count the number of active (fulfilled) and open spot requests.
-    Also, return the request IDs that are in the 'open' state.
-    """
-    active_count = 0
-    open_count = 0
-    failed_count = 0
-    successful_request_ids = []
-    open_request_ids = []  # List to collect request IDs that are in the 'open' state
-    failed_request_ids = []  # List to collect request IDs that are in the 'failed' state
-
-    try:
-        response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=request_ids)
-
-        # Iterate through all spot requests to count active and open states
-        for request in response['SpotInstanceRequests']:
-            # print(request['State'])
-            if request['State'] == 'active':
-                active_count += 1
-                successful_request_ids.append(request['SpotInstanceRequestId'])
-            elif request['State'] == 'open':
-                open_count += 1
-                print("Appending open request ID to the list")
-                open_request_ids.append(request['SpotInstanceRequestId'])  # Add open request ID to the list
-            elif request['State'] in ['cancelled', 'failed', 'closed']:
-                failed_request_ids.append(request['SpotInstanceRequestId'])
-                failed_count += 1
-            else:
-                failed_request_ids.append(request['SpotInstanceRequestId'])
-                failed_count += 1
-
-        if successful_request_ids:
-            print(f"Successful request IDs: {successful_request_ids}")
-            print("Uploading successful request IDs to S3...")
-            upload_request_to_s3(successful_request_ids, spot_tracking_s3_bucket_name,
-                                 region_for_s3_for_checking_spot_request,
-                                 "successful")
-
-        if open_request_ids:
-            print(f"Open request IDs: {open_request_ids}")
-            print("Uploading open request IDs to S3...")
-            upload_request_to_s3(open_request_ids, spot_tracking_s3_bucket_name,
-                                 region_for_s3_for_checking_spot_request, "open")
-
-        if failed_request_ids:
-            print(f"Failed request IDs: {failed_request_ids}")
-            print("Uploading failed request IDs to S3...")
-            upload_request_to_s3(failed_request_ids, spot_tracking_s3_bucket_name,
-                                 region_for_s3_for_checking_spot_request,
-                                 "failed")
-
-    except botocore.exceptions.ClientError as e:
-        print(f"Error counting spot requests: {str(e)}")
-
-    return active_count, open_count, failed_count, open_request_ids
-
-
 def get_request_counts_by_state(ec2_client, request_ids):
     """
     Count the number of spot requests based on their state (active, open, terminated).
@@ -217,151 +143,38 @@ def cancel_open_spot_requests(ec2_client, request_ids):
         print(f"Error canceling open spot requests: {str(e)}")
 
 
-def launch_spot_instance(ec2_client, spot_price, ami_id, inst_type, key_name, security_group_ids, selected_az,
-                         number_of_instances):
+def launch_spot_instance(ec2_client, ami_id, key_name, security_group_ids, pools, number_of_instances):
     """
-    Launch a spot instance with the specified parameters.
+    Launch spot instances in the given pools with the configured launch backend.
+    The legacy backend only uses the first pool, the fleet backend lets EC2 choose among all of them.
+    :return: Tuple of (active count, open count, failed count, open request IDs)
     """
     global inst_id
 
-    user_data_script = f"""#!/bin/bash
-
-                export AWS_ACCESS_KEY_ID="{aws_credentials['AWS_ACCESS_KEY_ID']}"
-                export AWS_SECRET_ACCESS_KEY="{aws_credentials['AWS_SECRET_ACCESS_KEY']}"
-
-                # Initializing the log
-                echo "Starting script" >/var/log/user-data.log                
-
-                # Appending all standard output and error messages to the log file
-                exec > >(tee -a /var/log/user-data.log) 2>&1                                
-                
-                # This is where you can add your custom user data script
-                echo "Sleeping for {sleep_time} seconds..."
-                sleep {sleep_time}
-
-                echo "Retrieving the instance ID using ec2-metadata..."
-                INSTANCE_ID=$(ec2-metadata -i | cut -d " " -f 2)
-                echo "Instance ID retrieved: $INSTANCE_ID"
-
-                # Get the Spot Instance Request ID
-                SPOT_REQUEST_ID=$(aws ec2 describe-instances --instance-id $INSTANCE_ID --query "Reservations[0].Instances[0].SpotInstanceRequestId" --output text)
-                echo "Spot Instance Request ID retrieved: $SPOT_REQUEST_ID"
-
-                # Get the region from the Availability Zone
-                REGION=$(ec2-metadata -z | cut -d " " -f 2 | sed 's/.$//')
-                echo "Region retrieved: $REGION"
-
-                # Check if the file exists in the spot_check_interruption bucket
-                CHECK_KEY="open/${{REGION}}|${{SPOT_REQUEST_ID}}.txt"
-                echo "Checking if file $CHECK_KEY exists in bucket {spot_tracking_s3_bucket_name}..."
-                if aws s3api head-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY" 2>/dev/null; then
-                    echo "File $CHECK_KEY exists in bucket. No further action required."
-                    aws s3api delete-object --bucket "{spot_tracking_s3_bucket_name}" --key "$CHECK_KEY"
-                else
-                    echo "File $CHECK_KEY does not exist in bucket {spot_tracking_s3_bucket_name}. Skipping..."
-                fi
-
-                # Retrieve instance details and spot price information
-                INSTANCE_TYPE=$(ec2-metadata -t | cut -d " " -f 2)
-                AVAILABILITY_ZONE=$(ec2-metadata -z | cut -d " " -f 2)
-                LAUNCH_TIME=$(aws ec2 describe-instances \
-                  --instance-id $INSTANCE_ID \
-                  --query "Reservations[0].Instances[0].LaunchTime" \
-                  --output text)
-                CURRENT_SPOT_PRICE=$(aws ec2 describe-spot-price-history \
-                  --instance-types $INSTANCE_TYPE \
-                  --availability-zone $AVAILABILITY_ZONE \
-                  --product-descriptions "Linux/UNIX" \
-                  --max-results 1 \
-                  --query "SpotPriceHistory[0].SpotPrice" \
-                  --output text)
-                CURRENT_TIME=$(date --utc +'%Y-%m-%dT%H:%M:%S+00:00')
-
-                # Write the information to a file
-                echo "Instance ID: $INSTANCE_ID" > /tmp/instance_info.txt
-                echo "Availability Zone: $AVAILABILITY_ZONE" >> /tmp/instance_info.txt
-                echo "Instance Launch Time: $LAUNCH_TIME" >> /tmp/instance_info.txt
-                echo "Current Time: $CURRENT_TIME" >> /tmp/instance_info.txt
-                echo "Current Spot Price: $CURRENT_SPOT_PRICE" >> /tmp/instance_info.txt
-
-                KEY="$INSTANCE_ID.txt"
-
-                echo "Checking if bucket {complete_bucket_name} exists..."
-                if aws s3api head-bucket --bucket "{complete_bucket_name}" &>/dev/null; then
-                  echo "Bucket {complete_bucket_name} exists"
-                else
-                  echo "Bucket {complete_bucket_name} does not exist. Creating..."
-                  aws s3api create-bucket --bucket "{complete_bucket_name}"
-                  echo "Bucket {complete_bucket_name} created."
-                fi
-
-                echo "Uploading the file with the name $INSTANCE_ID.txt to the S3 bucket {complete_bucket_name}..."
-                aws s3api put-object --bucket {complete_bucket_name} --key $KEY --body /tmp/instance_info.txt
-                rm -f /tmp/instance_info.txt
-                echo "Upload completed. Please check the S3 bucket for the file."
-
-                echo "Terminating instance $INSTANCE_ID"
-                aws ec2 terminate-instances --instance-ids $INSTANCE_ID
-
-                """
-
-    # Base64 encode the user data script
-    user_data_encoded = base64.b64encode(user_data_script.encode()).decode()
-
-    print(f"Using On Demand Price: {on_demand_price}")
-    # Request spot instance
-    spot_response = ec2_client.request_spot_instances(
-        # SpotPrice=spot_price,
-        SpotPrice=str(on_demand_price),
-        InstanceCount=number_of_instances,
-        Type="one-time",  # can be "one-time" or "persistent"
-        LaunchSpecification={
-            "ImageId": ami_id,
-            "InstanceType": inst_type,
-            "KeyName": key_name,
-            "SecurityGroupIds": security_group_ids,
-            "Placement": {
-                "AvailabilityZone": selected_az  # Replace with your desired availability zone
-            },
-            'UserData': user_data_encoded
-        }
-    )
-
-    request_ids = [request['SpotInstanceRequestId'] for request in spot_response['SpotInstanceRequests']]
-
-    # Initial delay
-    print(f"Waiting 20 seconds for checking {number_of_instances} spot requests")
-    time.sleep(20)
-
-    while True:
-
-        try:
-            # Count the number of open spot requests
-            n_active, n_open, n_failed, open_request_ids = count_spot_requests_by_state(ec2_client, request_ids)
-            active_and_open_request = n_active + n_open
-            print(f"Active: {n_active}, Open: {n_open}")
-
-            if active_and_open_request == number_of_instances:
-                print("All spot requests fulfilled.")
-                return n_active, n_open, n_failed, open_request_ids
-
-            else:
-                print(
-                    f"waiting another 60 seconds to see if  {number_of_instances - active_and_open_request} "
-                    f"could change to active or open...")
-                time.sleep(60)  # Wait for 1 minute before checking again
-
-        except botocore.exceptions.ClientError as e:
-            if "InvalidSpotInstanceRequestID.NotFound" not in str(e):
-                # Some other error occurred, you might want to handle it differently or re-raise it
-                raise e
-
-            print("Spot instance request IDs not found yet, waiting for a bit and retrying...")
-            time.sleep(60)
-
-        # Get counts for each state
-        n_active, n_open, n_failed, open_request_ids = count_spot_requests_by_state(ec2_client, request_ids)
-        return n_active, n_open, n_failed, open_request_ids
+    user_data_encoded = render_user_data(user_data_config(aws_credentials, complete_bucket_name, sleep_time=sleep_time,
+                                                          ledger_region=Region_DynamoForSpotRequestLedger))
+
+    print(f"Using On Demand Price: {on_demand_price} (launch backend: {launch_backend.name})")
+    # Rows written before prices were stored per instance type have no instance_type
+    pools = [{**pool, 'instance_type': pool.get('instance_type', instance_type)} for pool in pools]
+    result = launch_backend.launch(ec2_client, pools, number_of_instances, {
+        "ImageId": ami_id,
+        "KeyName": key_name,
+        "SecurityGroupIds": security_group_ids,
+        'UserData': user_data_encoded
+    })
+
+    # One batched ledger write for every request of the launch
+    region = ec2_client.meta.region_name
+    ledger.record_many(
+        [(request_id, region, SUCCESSFUL, instance_id) for request_id, instance_id in result.active.items()]
+        + [(request_id, region, OPEN, None) for request_id in result.open_request_ids]
+        + [(request_id, region, FAILED, None) for request_id in result.failed_request_ids])
+
+    print(f"Active: {result.n_active}, Open: {result.n_open}")
+    if result.n_active + result.n_open == number_of_instances:
+        print("All spot requests fulfilled.")
+    return result.n_active, result.n_open, result.n_failed, result.open_request_ids
 
 
 def get_instance_public_ip(ec2_client, ec2_instance_id):
@@ -392,7 +205,7 @@ def cancel_spot_requests_and_terminate_instances(region_name):
     :param region_name:  Name of the region
     :return:  None
     """
-    ec2 = boto3.client('ec2', region_name=region_name)
+    ec2 = get_client('ec2', region_name)
 
     # Fetch all active/open spot instance requests
     spot_requests = ec2.describe_spot_instance_requests(
@@ -441,10 +254,8 @@ def empty_bucket(bucket_name):
         print(f"Error: Bucket {bucket_name} does not exist!")
         sys.exit(1)
 
-    bucket = s3.Bucket(bucket_name)
-    # Delete all objects in the bucket
-    for obj in bucket.objects.all():
-        obj.delete()
+    # Paginated listing, deleted in concurrent 1000-key DeleteObjects batches
+    delete_all_objects(s3_client, bucket_name, include_versions=False)
 
     print(f"Bucket {bucket_name} has been emptied!")
 
@@ -471,51 +282,11 @@ def create_bucket(bucket_name):
         sys.exit(1)
 
 
-def monitor_failed_requests(ec2_client, open_request_ids):
-    """
-    Monitors the provided spot instance request IDs for any failed requests.
-    Returns the failed spot request IDs.
-
-    Parameters:
-    - ec2_client: the EC2 client
-    - open_request_ids: the list of open request IDs to monitor
-
-    Returns:
-    - A list of failed spot request IDs
-    """
-    failed_request_ids = []
-    print("Wait for 3 minutes to see if any spot requests failed...")
-    time.sleep(180)
-
-    try:
-        response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=open_request_ids)
-        failed_request_ids.extend(
-            request['SpotInstanceRequestId']
-            for request in response['SpotInstanceRequests']
-            if request['State'] == 'failed'
-        )
-    except botocore.exceptions.ClientError as e:
-        print(f"Error monitoring spot requests: {str(e)}")
-
-    return failed_request_ids
-
-
 def get_user_input(prompt: str) -> bool:
     """Utility function to simplify user yes/no input."""
     return input(prompt).lower() == 'yes'
 
 
-def empty_spot_bucket(bucket_name, folder_name):
-    """
-    empty the specified S3 bucket.
-    """
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    for obj in bucket.objects.filter(Prefix=folder_name):
-        if obj.key != folder_name:
-            obj.delete()
-
-
 def print_info(details: dict):
     """
     Print details in a formatted way.
@@ -529,7 +300,7 @@ def print_info(details: dict):
 def update_spot_price_table():
     # Update DynamoDB table
     auto_color_print("Updating Spot Price table...")
-    lambda_client = boto3.client('lambda', region_name=Region_DynamodbForSpotPrice)
+    lambda_client = get_client('lambda', Region_DynamodbForSpotPrice)
     function_name = "lambda_for_updating_spot_price"
     payload = {"key": "value"}  # Okay to send an empty payload
     response = lambda_client.invoke(FunctionName=function_name, InvocationType='RequestResponse',
@@ -544,7 +315,7 @@ def update_interruption_table():
     # Update Spot Placement Score DynamoDB table
     # This is to prevent the Cloudwatch not being able to trigger the lambda function. Remove this if not needed
     auto_color_print("Updating DynamoDB table...")
-    lambda_client = boto3.client('lambda', region_name=Region_DynamoDBForStabilityScore)
+    lambda_client = get_client('lambda', Region_DynamoDBForStabilityScore)
     function_name = "lambda_spot_interruption_ratio_inserter"
     payload = {"key": "value"}  # Okay to send an empty payload
     response = lambda_client.invoke(FunctionName=function_name, InvocationType='RequestResponse',
@@ -559,7 +330,7 @@ def update_spot_sps_table():
     # Update Spot Placement Score DynamoDB table
     # This is to prevent the Cloudwatch not being able to trigger the lambda function. Remove this if not needed
     auto_color_print("Updating SPS table...")
-    lambda_client = boto3.client('lambda', region_name=Region_DynamoDBForSpotPlacementScore)
+    lambda_client = get_client('lambda', Region_DynamoDBForSpotPlacementScore)
     function_name = "lambda_spot_placement_score_inserter"
     payload = {"key": "value"}  # Okay to send an empty payload
     response = lambda_client.invoke(FunctionName=function_name, InvocationType='RequestResponse',
@@ -592,14 +363,9 @@ def empty_buckets():
             if get_user_input(f"Do you want to empty bucket {bucket_name}? Type 'no' to skip: "):
                 empty_bucket(bucket_name)
 
-    # Asking if the user wants to empty specific folders, with creation of the bucket if it doesn't exist
-    if get_user_input(f"Do you want to empty folders in {spot_tracking_s3_bucket_name}? Type 'no' to skip: "):
-        if not bucket_exists(spot_tracking_s3_bucket_name):
-            print(f"Bucket {spot_tracking_s3_bucket_name} does not exist. Creating it...")
-            create_bucket(spot_tracking_s3_bucket_name)
-
-        for folder_name in ['open/', 'successful/', 'failed/']:
-            empty_spot_bucket(spot_tracking_s3_bucket_name, folder_name)
+    # Asking if the user wants to forget the spot requests of previous runs
+    if get_user_input(f"Do you want to clear the spot request ledger {LEDGER_TABLE_NAME}? Type 'no' to skip: "):
+        ledger.clear()
 
 
 def cancel_spot_requests():
@@ -612,20 +378,20 @@ def cancel_spot_requests():
             cancel_spot_requests_and_terminate_instances(region)
 
 
-def fetch_spot_price_data(suitable_regions: List[str] = None) -> dict:
+def fetch_spot_price_data(suitable_regions: List[str] = None, eligible_instance_types: List[str] = None) -> dict:
     """
     Fetch spot price data from DynamoDB.
     If there are suitable regions, fetch data for those regions.
     Otherwise, fetch data for the region specified in region_for_s3_for_checking_spot_request.
 
     :param suitable_regions: List of regions that are considered suitable for spot instances.
+    :param eligible_instance_types: Instance types to keep (None keeps every instance type in the table).
     :return: Dictionary of responses for the specified regions.
     """
     response_dict = {}
     print("Fetching DynamoDB Spot Price Data...")
 
-    dynamodb = boto3.resource('dynamodb', region_name=Region_DynamodbForSpotPrice)
-    table = dynamodb.Table('SpotPriceCostTable')
+    table = get_table(SPOT_PRICE_TABLE_NAME, Region_DynamodbForSpotPrice)
 
     # Determine the regions to query for spot price data
     if suitable_regions:
@@ -633,15 +399,33 @@ def fetch_spot_price_data(suitable_regions: List[str] = None) -> dict:
     else:
         regions_to_query = [region_for_s3_for_checking_spot_request]
 
-    # Fetch data for the specified regions (suitable or fallback region)
+    # Fetch data for the specified regions (suitable or fallback region), one Query per region
     for region in regions_to_query:
-        print(f"Fetching data for region/availability zone: {region}")
-        response = table.scan(FilterExpression=Attr('availability_zone').begins_with(region))
-        response_dict[region] = response
+        print(f"Fetching data for region: {region}")
+        response_dict[region] = {'Items': query_region_prices(table, region, instance_types=eligible_instance_types)}
 
     return response_dict
 
 
+def print_price_trends(response_dict, window_hours=24):
+    """
+    Print the price trend of every candidate AZ/instance type pair whose history is in the local spot price warehouse
+    (filled by `python3 spot_price_warehouse.py sync`), next to the price it is launched at.
+    Only a diagnostic: a warehouse that cannot be read is reported and the launch goes on.
+    """
+    warehouse = SpotPriceWarehouse()
+    try:
+        for response in response_dict.values():
+            for item in response['Items']:
+                trend = warehouse.price_trend(item['availability_zone'], item['instance_type'], window_hours)
+                if trend:
+                    print(f"{item['availability_zone']} ({item['instance_type']}): price {item['price']}, "
+                          f"{window_hours}h mean {trend['mean']:.4f}, std {trend['std']:.4f} "
+                          f"(warehouse synced to {trend['latest_time']})")
+    except Exception as e:
+        print(f"Failed to read the price trends from the spot price warehouse: {e}")
+
+
 def filter_items_by_regions(items, regions):
     """Filter items based on specified regions."""
     return [item for item in items if item['region'] in regions]
@@ -675,78 +459,198 @@ def calculate_instances_to_request(region, instances_per_region, remainder, regi
     return instances_to_request, remainder
 
 
-def launch_all_spot_instances(response_dict):
-    """
-    Launch spot instances for the specified regions.
-    """
-    total_regions = len(response_dict)
-    print(f"Total regions: {total_regions}")
-    instances_per_region, remainder = divmod(number_of_instances_to_launch, total_regions)
-    print(f"Instances per region: {instances_per_region}, Remainder: {remainder}")
-    regions_received_extra_instance = set()
-    key_name = 'xxay_m1'
-
-    for region, response in response_dict.items():
-        ec2_client = boto3.client('ec2', region_name=region)
-        ami_id, security_group_ids = fetch_ami_and_security_group_ids(region)
-
-        active_request_count = 0  # Count for active spot requests
-        open_request_count = 0  # Count for open spot requests
-        open_request_ids_global = []
+class RemainingCapacityPool:
+    """
+    Thread-safe counter of instances that a region could not fulfill and handed back.
+    Region workers that still have untried AZs claim from this pool until every worker is done.
+    """
+
+    def __init__(self, number_of_workers):
+        self._condition = threading.Condition()
+        self._unassigned = 0
+        self._active_workers = number_of_workers
+        self._waiting_workers = 0
+
+    def claim(self):
+        """
+        Block until unmet instances are handed back or no other worker can hand any back.
+        :return: Number of instances the caller should now request (0 means stop).
+        """
+        with self._condition:
+            self._waiting_workers += 1
+            while self._unassigned == 0 and self._waiting_workers < self._active_workers:
+                self._condition.wait()
+            self._waiting_workers -= 1
+            claimed, self._unassigned = self._unassigned, 0
+            return claimed
+
+    def finish(self, unmet_instances):
+        """
+        Hand back the instances a worker could not fulfill and mark the worker as done.
+        :param unmet_instances: Number of instances the worker still had to request.
+        """
+        with self._condition:
+            self._unassigned += unmet_instances
+            self._active_workers -= 1
+            self._condition.notify_all()
+
+    @property
+    def unassigned(self):
+        with self._condition:
+            return self._unassigned
+
+
+def launch_spot_instances_in_region(region, response, instances_to_request, capacity_pool, key_name, pool_scores=None):
+    """
+    Launch spot instances for a single region.
+    The region's share is first spread over its cheapest AZs at once, weighted by price and scores.
+    AZs that came back short are skipped afterwards, the rest are tried one at a time from the cheapest,
+    and once its own share is fulfilled the region keeps claiming unmet instances from the shared pool
+    while it still has AZs left to try.
+    :return: Tuple of (active request count, open request count, open request IDs)
+    """
+    active_request_count = 0  # Count for active spot requests
+    open_request_count = 0  # Count for open spot requests
+    open_request_ids_global = []
 
+    try:
         if 'Items' not in response or not response['Items']:
             print(f"No items found in the table for region: {region}.")
-            continue
+            return active_request_count, open_request_count, open_request_ids_global
 
+        ec2_client = get_client('ec2', region)
+        ami_id, security_group_ids = fetch_ami_and_security_group_ids(region)
         sorted_items = sorted(response['Items'], key=lambda x: float(x['price']))
-        instances_to_request = instances_per_region
 
-        # Handle the remainder
-        if remainder > 0 and region not in regions_received_extra_instance:
-            instances_to_request += 1
-            remainder -= 1
-            regions_received_extra_instance.add(region)
-
-        while instances_to_request > 0:  # Loop until all instances are launched
-            for item in sorted_items:
-                region = item['region']
-                spot_price = str(item['price'])
-                availability_zone = item['availability_zone']
-
-                auto_color_print(f"Attempting with Availability Zone: {availability_zone}, "
-                                 f"Price: {spot_price}, Region: {region}")
-
-                print_info({"Original spot price": str(item['price']),
-                            "Updated spot price": spot_price, "Region": region,
-                            "AMI ID": ami_id, "Security Group ID": security_group_ids,
-                            "Instance type": instance_type, "Key name": key_name,
-                            "Spot price": spot_price, "Number of instances to launch": instances_to_request})
-
-                # Spot Price is not actually used but on-demand price is used
-                n_active, n_open, n_failed, open_request_ids = launch_spot_instance(
-                    ec2_client, spot_price, ami_id, instance_type, key_name,
-                    security_group_ids, availability_zone, instances_to_request
-                )
-
-                open_request_ids_global.extend(open_request_ids)
-                active_request_count += n_active
-                open_request_count += n_open
+        def launch_in_pool(item, number_of_instances):
+            spot_price = str(item['price'])
+            availability_zone = item['availability_zone']
+            # Rows written before prices were stored per instance type have no instance_type
+            item_instance_type = item.get('instance_type', instance_type)
+
+            auto_color_print(f"[{region}] Attempting with Availability Zone: {availability_zone}, "
+                             f"Instance type: {item_instance_type}, Price: {spot_price}, Region: {region}")
+
+            print_info({"Original spot price": str(item['price']),
+                        "Updated spot price": spot_price, "Region": region,
+                        "AMI ID": ami_id, "Security Group ID": security_group_ids,
+                        "Instance type": item_instance_type, "Key name": key_name,
+                        "Spot price": spot_price, "Number of instances to launch": number_of_instances})
+
+            # Spot Price is not actually used but on-demand price is used
+            return launch_spot_instance(ec2_client, ami_id, key_name, security_group_ids, [item], number_of_instances)
+
+        def record(pool_label, n_active, n_open, n_failed, open_request_ids):
+            nonlocal active_request_count, open_request_count
+            open_request_ids_global.extend(open_request_ids)
+            active_request_count += n_active
+            open_request_count += n_open
+
+            print(f"[{region}] {pool_label}: Number of Active requests: {n_active}, Number of Open requests: {n_open}")
+            print(f"[{region}] Number of Failed requests: {n_failed}")
+            print(f"[{region}] Open request IDs: {open_request_ids}")
+            print(f"[{region}] Successful requests: {active_request_count}, Open requests: {open_request_count}")
+
+        weighted_items = placement_weights(sorted_items, pool_scores, placement_spread)
+        short_pools = set()
+
+        if launch_backend.multi_pool and instances_to_request > 0:
+            # One fleet call over the region's best pools, EC2 spreads the share with its allocation strategy
+            candidate_pools = [item for item, _ in weighted_items]
+            pool_label = ', '.join(item['availability_zone'] for item in candidate_pools)
+            print(f"[{region}] Fleet pools: {pool_label}")
+            n_active, n_open, n_failed, open_request_ids = launch_spot_instance(
+                ec2_client, ami_id, key_name, security_group_ids, candidate_pools, instances_to_request)
+            record(pool_label, n_active, n_open, n_failed, open_request_ids)
+            if n_active + n_open < instances_to_request:
+                short_pools.update(id(item) for item in candidate_pools)
+            instances_to_request -= (n_active + n_open)
+        else:
+            # Spread the region's share over its best pools and request all of them at the same time
+            allocations = allocate_instances(weighted_items, instances_to_request)
+            print(f"[{region}] Placement: {[(item['availability_zone'], n) for item, n in allocations]}")
+
+            for item, n, result in launch_across_pools(allocations, launch_in_pool):
+                if isinstance(result, Exception):
+                    short_pools.add(id(item))
+                    continue
+                n_active, n_open, n_failed, open_request_ids = result
+                record(item['availability_zone'], n_active, n_open, n_failed, open_request_ids)
                 instances_to_request -= (n_active + n_open)  # Decrement the number of active/open instances
+                if n_active + n_open < n:
+                    short_pools.add(id(item))
+
+        if instances_to_request > 0:
+            print(f"[{region}] Still {instances_to_request} more requests are needed. Retrying in other AZs...")
 
-                print(f"Number of Active requests: {n_active}, Number of Open requests: {n_open}")
-                print(f"Number of Failed requests: {n_failed}")
-                print(f"Open request IDs: {open_request_ids}")
-                print(f"Successful requests: {active_request_count}, Open requests: {open_request_count}")
+        for item in sorted_items:
+            if id(item) in short_pools:
+                continue  # This pool just came back short, do not ask it again
 
-                if instances_to_request == 0:  # Break the loop if all instances are launched
-                    print("All spot requests have been successfully fulfilled (active or open).")
+            if instances_to_request == 0:
+                # Our share is done, pick up instances that other regions could not fulfill
+                instances_to_request = capacity_pool.claim()
+                if instances_to_request == 0:
                     break
+                print(f"[{region}] Took over {instances_to_request} unmet instances from other regions.")
+
+            n_active, n_open, n_failed, open_request_ids = launch_in_pool(item, instances_to_request)
+            record(item['availability_zone'], n_active, n_open, n_failed, open_request_ids)
+            instances_to_request -= (n_active + n_open)  # Decrement the number of active/open instances
 
             if instances_to_request > 0:
-                print(f"Still {instances_to_request} more requests are needed. Retrying in other AZs...")
+                print(f"[{region}] Still {instances_to_request} more requests are needed. Retrying in other AZs...")
 
         if instances_to_request > 0:
-            print(f"Could not fulfill all requests for region: {region}.")
+            print(f"[{region}] Could not fulfill {instances_to_request} requests. Handing them to other regions.")
+    finally:
+        # Always hand back unmet instances, otherwise regions waiting on the pool never wake up
+        capacity_pool.finish(instances_to_request)
+
+    return active_request_count, open_request_count, open_request_ids_global
+
+
+def launch_all_spot_instances(response_dict, pool_scores=None):
+    """
+    Launch spot instances for the specified regions concurrently.
+    Every region is launched and polled at the same time, and unmet instances of one region
+    are handed over to regions that still have spare AZs.
+    """
+    total_regions = len(response_dict)
+    print(f"Total regions: {total_regions}")
+    if total_regions == 0:
+        print("No regions to launch spot instances in.")
+        return
+
+    instances_per_region, remainder = divmod(number_of_instances_to_launch, total_regions)
+    print(f"Instances per region: {instances_per_region}, Remainder: {remainder}")
+    regions_received_extra_instance = set()
+    key_name = 'xxay_m1'
+
+    capacity_pool = RemainingCapacityPool(total_regions)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=total_regions) as executor:
+        futures = {}
+        for region, response in response_dict.items():
+            instances_to_request, remainder = calculate_instances_to_request(
+                region, instances_per_region, remainder, regions_received_extra_instance)
+            futures[executor.submit(launch_spot_instances_in_region, region, response, instances_to_request,
+                                    capacity_pool, key_name, pool_scores)] = region
+
+        active_request_count = 0
+        open_request_count = 0
+        for future in concurrent.futures.as_completed(futures):
+            region = futures[future]
+            try:
+                n_active, n_open, _ = future.result()
+                active_request_count += n_active
+                open_request_count += n_open
+            except Exception as e:
+                print(f"An error occurred while launching spot instances in {region}: {e}")
+
+    print(f"Successful requests: {active_request_count}, Open requests: {open_request_count}")
+    if capacity_pool.unassigned > 0:
+        print(f"Could not fulfill {capacity_pool.unassigned} requests across all regions.")
 
     print("Completed launching spot instances across all regions.")
 
@@ -757,9 +661,7 @@ def fetch_all_sps_scores(region_name) -> dict:
 
     :return: A dictionary with regions as keys and the highest SPS score as values.
     """
-    dynamodb = boto3.resource('dynamodb',
-                              region_name=region_name)  # Replace with the correct region
-    table = dynamodb.Table('SpotPlacementScoreTable')
+    table = get_table('SpotPlacementScoreTable', region_name)
 
     print("Fetching all SPS scores from SpotPlacementScoreTable...")
 
@@ -796,9 +698,7 @@ def fetch_all_interruption_free_scores(region_name) -> dict:
 
     :return: A dictionary with regions as keys and the Interruption_free_score as values.
     """
-    dynamodb = boto3.resource('dynamodb',
-                              region_name=region_name)  # Replace with the correct region
-    table = dynamodb.Table('SpotInterruptionRatioTable')
+    table = get_table('SpotInterruptionRatioTable', region_name)
 
     print("Fetching all Interruption_free_scores from SpotInterruptionRatioTable...")
 
@@ -813,7 +713,8 @@ def fetch_all_interruption_free_scores(region_name) -> dict:
                 region = item['Region']
                 score = int(item['Interruption_free_score'])
 
-                interruption_scores[region] = score
+                # One row per instance type, a region scores as well as its best instance type
+                interruption_scores[region] = max(interruption_scores.get(region, 0), score)
 
             print(f"Fetched Interruption Free Scores: {interruption_scores}")
         else:
@@ -885,9 +786,20 @@ preferred_regions = [region.strip() for region in config.get('settings', 'region
 # factor = Decimal(config.getfloat('settings', 'spot_price_factor'))
 region_for_s3_for_checking_spot_request = (config.get('settings', 'Region_S3ForCheckingSpotRequest'))
 instance_type = config.get('settings', 'instance_type')
+instance_types = [t.strip() for t in config.get('settings', 'instance_types', fallback=instance_type).split(',')]
+min_vcpus = config.getint('settings', 'min_vcpus', fallback=0)
+min_memory_gib = config.getfloat('settings', 'min_memory_gib', fallback=0)
+placement_spread = config.getint('settings', 'placement_spread_azs', fallback=DEFAULT_SPREAD)
+show_price_trends = config.getboolean('settings', 'show_price_trends', fallback=False)
 spot_tracking_s3_bucket_name = config.get('settings', 'spot_tracking_s3_bucket_name')
 Region_DynamodbForSpotPrice = config.get('settings', 'Region_DynamodbForSpotPrice')
+Region_DynamoForSpotRequestLedger = config.get('settings', 'Region_DynamoForSpotRequestLedger',
+                                               fallback=Region_DynamodbForSpotPrice)
 on_demand_price = float(config.get('settings', 'on_demand_price'))
+launch_backend = get_launch_backend(config.get('settings', 'launch_backend', fallback=SPOT_REQUEST_BACKEND),
+                                    on_demand_price, SPOT_REQUEST_SETTLE_TIMEOUT,
+                                    config.get('settings', 'fleet_allocation_strategy',
+                                               fallback='price-capacity-optimized'))
 available_regions = [region.strip() for region in config.get('settings', 'available_regions').split(',')]
 Region_DynamoDBForSpotPlacementScore = config.get('settings', 'Region_DynamoForSpotPlacementScore')
 Region_DynamoDBForStabilityScore = config.get('settings', 'Region_DynamoForSpotInterruptionRatio')
@@ -898,8 +810,13 @@ print(f"Number of spot instances: {number_of_instances_to_launch}")
 print(f"Preferred regions: {preferred_regions}")
 print(f"Region to for s3 of checking spot request : {region_for_s3_for_checking_spot_request}")
 print(f"Instance type: {instance_type}")
+print(f"Instance types: {instance_types} (min vCPUs: {min_vcpus}, min memory: {min_memory_gib} GiB)")
+print(f"AZs to spread each region's launch over: {placement_spread}")
+print(f"Launch backend: {launch_backend.name}")
+print(f"Show price trends: {show_price_trends}")
 print(f"Spot tracking S3 bucket name: {spot_tracking_s3_bucket_name}")
 print(f"Spot Price DynamoDB Region: {Region_DynamodbForSpotPrice}")
+print(f"Spot Request Ledger DynamoDB Region: {Region_DynamoForSpotRequestLedger}")
 print(f"Spot Placement Score DynamoDB Region: {Region_DynamoDBForSpotPlacementScore}")
 print(f"Stability Score DynamoDB Region: {Region_DynamoDBForStabilityScore}")
 print(f"On-demand price: {on_demand_price}")
@@ -915,8 +832,9 @@ else:
     print("Continuing with the process...")
 
 # Initialize the S3 client, colored print, and other variables
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
+s3 = get_resource('s3')
+s3_client = get_client('s3')
+ledger = SpotRequestLedger(get_table(LEDGER_TABLE_NAME, Region_DynamoForSpotRequestLedger))
 init()  # initialize colorama, it's for colored print
 auto_color_print("Copying AWS credentials...")  # Get AWS credentials from the file
 os.system("python3 copy_aws_credentials.py")
@@ -952,9 +870,22 @@ def main():
                                                                Region_DynamoDBForStabilityScore)
         print(f"Suitable regions from preferred regions: {suitable_regions}")
 
-    response_dict: dict = fetch_spot_price_data(suitable_regions)
+    # Launch the cheapest AZ/instance type pairs among the types that meet the requirements
+    eligible_instance_types = filter_instance_types_by_requirements(
+        get_client('ec2', Region_DynamodbForSpotPrice), instance_types, min_vcpus, min_memory_gib)
+    print(f"Eligible instance types: {eligible_instance_types}")
+
+    response_dict: dict = fetch_spot_price_data(suitable_regions, eligible_instance_types)
+    if show_price_trends:
+        print_price_trends(response_dict)
+
+    # Per-AZ SPS and per-region interruption scores weight the placement of every region's share
+    pool_scores = fetch_pool_scores(
+        get_table('SpotPlacementScoreTable', Region_DynamoDBForSpotPlacementScore),
+        get_table('SpotInterruptionRatioTable', Region_DynamoDBForStabilityScore))
 
-    launch_all_spot_instances(response_dict)
+    launch_all_spot_instances(response_dict, pool_scores)
+    report_throttles()
 
 
 print("Process completed.")
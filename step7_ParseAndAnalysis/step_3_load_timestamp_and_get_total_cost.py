@@ -2,10 +2,12 @@ import configparser
 import json
 import logging
 import os
-import pickle
 from datetime import datetime
 from pathlib import Path
 
+import numpy as np
+
+from instance_store import OUTCOMES, load_instance_records, to_epoch
 from my_logger import LoggerSetup
 
 logger = LoggerSetup.setup_logger()
@@ -16,7 +18,6 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 ON_DEMAND_COST_PER_HOUR = 0.17
 RUNNING_HOURS = 10
 DATA_DIR = 'data'
-PICKLE_FILE = 'filtered_distributions.pkl'
 
 
 def find_config_file(filename='conf.ini'):
@@ -44,20 +45,48 @@ print(f"instance_type: {INSTANCE_TYPE}")
 print(f"number_of_spot_instances: {NUMBER_OF_INSTANCES}")
 
 
-def load_distributions(file_path: str) -> dict:
-    """Load and return distributions from a pickle file."""
-    try:
-        with open(file_path, 'rb') as f:
-            return pickle.load(f)
-    except (FileNotFoundError, pickle.UnpicklingError) as e:
-        logger.error(f"Error loading distributions: {str(e)}")
-        return {}
+class SpotPriceCurve:
+    """
+    Spot price history of one availability zone as a step function: a price applies from its timestamp until the next
+    one. The history is sorted once, and the cumulative cost of running from the first timestamp is kept at every
+    timestamp, so the cost of any number of instances takes two searchsorted lookups each.
+    """
+
+    def __init__(self, spot_price_history):
+        timestamps = np.array([to_epoch(entry["Timestamp"]) for entry in spot_price_history], dtype=np.float64)
+        prices = np.array([float(entry["SpotPrice"]) for entry in spot_price_history], dtype=np.float64)
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, prices = timestamps[order], prices[order]
+
+        # Of the entries with the same timestamp, the last one sets the price
+        last = np.append(timestamps[1:] != timestamps[:-1], True)
+        self.timestamps, self.prices = timestamps[last], prices[last]
+
+        # Cost of running from the first timestamp to each timestamp
+        self.cumulative_cost = np.concatenate(([0.0], np.cumsum(self.prices[:-1] * np.diff(self.timestamps) / 3600)))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def cost_until(self, times):
+        """Cost of running from the first timestamp until each time, NaN for times before it."""
+        index = np.searchsorted(self.timestamps, times, side='right') - 1
+        known = np.maximum(index, 0)
+        cost = self.cumulative_cost[known] + self.prices[known] * (times - self.timestamps[known]) / 3600
+        return np.where(index >= 0, cost, np.nan)
 
+    def cost(self, start_times, end_times):
+        """
+        Cost of running from each start time to the matching end time.
 
-def load_all_spot_price_histories(selected_dir_path, directory_name="spot_price_history"):
-    """Load all spot price histories from the specified directory."""
-    all_spot_price_histories = {}
-    time_format = "%Y-%m-%dT%H:%M:%S%z"
+        :return: Array of costs, NaN where the history has no price at the start time or a time is missing
+        """
+        return self.cost_until(end_times) - self.cost_until(start_times)
+
+
+def load_spot_price_curves(selected_dir_path, directory_name="spot_price_history"):
+    """Load the spot price history of every availability zone from the specified directory."""
+    spot_price_curves = {}
 
     spot_price_history_dir = os.path.join(selected_dir_path, directory_name)
     logger.debug(spot_price_history_dir)
@@ -70,44 +99,36 @@ def load_all_spot_price_histories(selected_dir_path, directory_name="spot_price_
             try:
                 with open(filepath, 'r') as file:
                     spot_price_history = json.load(file)
-                    for entry in spot_price_history:
-                        entry["Timestamp"] = datetime.fromisoformat(entry["Timestamp"])
-                    all_spot_price_histories[az] = spot_price_history
-                    logging.info(f"Data loaded successfully from {filepath}")
+                if spot_price_history:
+                    spot_price_curves[az] = SpotPriceCurve(spot_price_history)
+                logging.info(f"Data loaded successfully from {filepath}")
             except (json.JSONDecodeError, FileNotFoundError) as e:
                 logging.info(f"Failed to load data from '{filepath}': {str(e)}")
     except FileNotFoundError:
         logging.info(f"No such directory: '{spot_price_history_dir}'")
 
-    return all_spot_price_histories
-
+    return spot_price_curves
 
-def calculate_cost(instance, spot_price_history):
-    """Calculate the cost for a given instance based on its spot price history."""
-    relevant_prices = [entry for entry in spot_price_history if entry["Timestamp"] <= instance.end_time]
-    relevant_prices.sort(key=lambda x: x["Timestamp"])
 
-    total_cost = 0.0
-    applicable_price_entry = next(
-        (entry for entry in relevant_prices[::-1] if entry["Timestamp"] <= instance.start_time), None)
-    if not applicable_price_entry:
-        logging.info(f"No applicable price entry found for instance starting at {instance.start_time}")
-        return None
+def calculate_costs(records, spot_price_curves):
+    """
+    Calculate the cost of every instance from the spot price history of its availability zone.
 
-    current_time = instance.start_time
-    for entry in relevant_prices:
-        if entry["Timestamp"] > instance.start_time:
-            duration = entry["Timestamp"] - current_time
-            cost_per_second = float(applicable_price_entry["SpotPrice"]) / 3600
-            total_cost += duration.total_seconds() * cost_per_second
-            current_time = entry["Timestamp"]
-        applicable_price_entry = entry
-
-    duration = instance.end_time - current_time
-    cost_per_second = float(applicable_price_entry["SpotPrice"]) / 3600
-    total_cost += duration.total_seconds() * cost_per_second
-
-    return total_cost
+    :return: Array of costs aligned with the records, NaN for the instances that cannot be priced
+    """
+    costs = np.full(len(records), np.nan)
+    for code, az in enumerate(records.zones):
+        in_zone = np.flatnonzero(records.zone == code)
+        if not len(in_zone):
+            continue
+        if az not in spot_price_curves:
+            logging.info(f"No price history available for {len(in_zone)} instances in '{az}'.")
+            continue
+        costs[in_zone] = spot_price_curves[az].cost(records.start[in_zone], records.end[in_zone])
+        unpriced = np.count_nonzero(np.isnan(costs[in_zone]))
+        if unpriced:
+            logging.info(f"Cannot estimate cost for {unpriced} instances in {az} due to lack of pricing data.")
+    return costs
 
 
 def save_results_to_file(distributions, total_cost, directory_path, filename="results.txt"):
@@ -120,9 +141,8 @@ def save_results_to_file(distributions, total_cost, directory_path, filename="re
             for filetype, content in distributions.items():
                 file.write(f"\n{filetype}:\n")
                 for key, value in content.items():
-                    if key != "instances":
-                        file.write(f"  {key}: {value}\n")
-                if filetype == 'complete':
+                    file.write(f"  {key}: {value}\n")
+                if filetype == 'complete' and content['global_min_start_time']:
                     total_duration = (content['global_max_end_time'] - content[
                         'global_min_start_time']).total_seconds() / 3600
                     file.write(f"\nTotal completion time in hours: {total_duration:.3f}\n")
@@ -137,25 +157,16 @@ def save_results_to_file(distributions, total_cost, directory_path, filename="re
 def main():
     selected_dir_path = os.path.join(os.getcwd(), DATA_DIR)
     logger.info(f"Selected directory path: {selected_dir_path}")
-    loaded_distributions = load_distributions(os.path.join(selected_dir_path, PICKLE_FILE))
-
-    all_spot_price_histories = load_all_spot_price_histories(selected_dir_path)
-
-    total_all_instances_cost = 0.0
-    for filetype, content in loaded_distributions.items():
-        for instance_id, instance_data in content["instances"].items():
-            az = instance_data.availability_zone
-            if az in all_spot_price_histories:
-                cost = calculate_cost(instance_data, all_spot_price_histories[az])
-                if cost is not None:
-                    total_all_instances_cost += cost
-                else:
-                    logging.info(f"Cannot estimate cost for instance {instance_id} ({az}) due to lack of pricing data.")
-            else:
-                logging.info(f"No price history available for instance {instance_id} ({az}).")
+    records = load_instance_records(selected_dir_path)
+    if records is None:
+        return
+
+    spot_price_curves = load_spot_price_curves(selected_dir_path)
+    total_all_instances_cost = float(np.nansum(calculate_costs(records, spot_price_curves)))
 
     logging.info(f"\nTotal estimated cost for all instances: ${total_all_instances_cost:.3f}")
-    save_results_to_file(loaded_distributions, total_all_instances_cost, selected_dir_path)
+    distributions = {file_type.value: records.select(file_type).summary() for file_type in OUTCOMES}
+    save_results_to_file(distributions, total_all_instances_cost, selected_dir_path)
 
 
 if __name__ == "__main__":